@@ -7,8 +7,10 @@ To be honest, this was implemented primarily for educational purposes.
 import datetime
 import functools
 import hashlib
+import os
+import weakref
 from collections.abc import Callable
-from typing import Any
+from typing import Any, ClassVar
 
 Func = Callable[..., Any]
 
@@ -69,8 +71,13 @@ class cached:  # noqa: N801
     Decorator instance is one per decorated function/method, so we do not need to take into account
     function and object name (if this is object method), because for other functions/methods it will
     be other decorator instance.
+
+    Caches of all decorator instances are cleared in the child process after fork,
+    so forked web-server workers do not share state inherited from the parent.
     """
 
+    instances: ClassVar[weakref.WeakSet["cached"]] = weakref.WeakSet()
+
     def __init__(  # noqa: PLR0913
         self,
         func: Func | None = None,
@@ -100,6 +107,10 @@ class cached:  # noqa: N801
         self.cache_none = cache_none
         self.cache: dict[str, dict[str, Any]] = {}
         self.func = func
+        self.name = ""  # qualified name of the decorated function
+        self.hits = 0
+        self.misses = 0
+        cached.instances.add(self)
 
         if func:
             # @cached without arguments
@@ -135,6 +146,12 @@ class cached:  # noqa: N801
         """Clear the cache."""
         self.cache = {}
 
+    @classmethod
+    def clear_all_caches(cls) -> None:
+        """Clear caches of all decorated functions."""
+        for instance in list(cls.instances):
+            instance.clear_cache()
+
     def decorate(self, func: Func) -> Func:
         """Decorate function."""
 
@@ -153,7 +170,7 @@ class cached:  # noqa: N801
             now = datetime.datetime.now()
             for item in list(self.cache):  # we have to keep cache clean
                 if (now - self.cache[item]["time"]).total_seconds() > self.cache_time_seconds:
-                    del self.cache[item]
+                    self.cache.pop(item, None)  # could be already removed in other thread
             today = now.replace(hour=0, minute=0, second=0, microsecond=0)
             if obj_hash in self.cache and (
                 today
@@ -163,14 +180,22 @@ class cached:  # noqa: N801
                 # cache hit and the day the same of no need to track day change
                 if not self.cache_none and self.cache[obj_hash]["value"] is None:
                     # Re-evaluate the function if cache_none is False and cached value is None
+                    self.misses += 1
                     self.cache[obj_hash] = {"value": func(*args, **kw), "time": now}
-                elif self.print_if_cached:
-                    print(self.print_if_cached.format(time=self.cache[obj_hash]["time"]))
+                else:
+                    self.hits += 1
+                    if self.print_if_cached:
+                        print(self.print_if_cached.format(time=self.cache[obj_hash]["time"]))
             else:
+                self.misses += 1
                 self.cache[obj_hash] = {"value": func(*args, **kw), "time": now}
             return self.cache[obj_hash]["value"]
 
         self.func = cached_func
+        self.name = func.__qualname__
+        # Keep name and module of the decorated function so it could be pickled by reference,
+        # for example to run it in a process pool
+        functools.update_wrapper(cached_func, func)
         cached_func._original_func = (  # type: ignore  # noqa: SLF001
             func  # Store the original function to be sure we decorate class
         )
@@ -184,3 +209,6 @@ class cached:  # noqa: N801
         To automatically bind the decorator's call to the object instance.
         """
         return functools.partial(self.__call__, obj)
+
+
+os.register_at_fork(after_in_child=cached.clear_all_caches)
@@ -6,45 +6,94 @@ Usage
 """
 
 import contextlib
-import io
+import copy
+import math
 import os
+import threading
+from collections import OrderedDict, namedtuple
+from collections.abc import Collection, Hashable, Iterator
 from datetime import datetime, timedelta
-from typing import Any
+from io import BytesIO
+from typing import Any, Literal, NamedTuple
 
 import matplotlib
 import matplotlib.font_manager
-import matplotlib.style
-
-from models import WeatherData, WeatherLabel
-
-# !!! that should be before importing pyplot
-with contextlib.suppress(ImportError):
-    import tkinter  # noqa: F401  # pylint: disable=unused-import  # check if tkinter is installed
-
-    matplotlib.use("TkAgg")  # in MacOS we should have tkinter installed and use it as backend
-
-from collections import namedtuple
-from io import BytesIO
-
-import matplotlib.pyplot as plt  # pylint: disable=ungrouped-imports
 import numpy as np
+import numpy.typing as npt
 import PIL.Image
 from matplotlib import patches
+from matplotlib.artist import Artist
 from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.dates import DateFormatter, date2num
+from matplotlib.figure import Figure
+from matplotlib.path import Path
+from matplotlib.text import Text
+from matplotlib.textpath import TextToPath
 from matplotlib.ticker import MaxNLocator
+from matplotlib.transforms import Bbox
 
 from cached_decorator import cached
+from eink import EINK_MODES, EINK_OFF, to_eink
 from image_loader import ImageLoader
+from metrics import stage
+from models import WeatherData, WeatherLabel
+from pie_raster import PiesRaster, overlaps
+from render_profiler import profile_render, profiled
+from sprite_atlas import Extent, Icon, SpriteAtlas
+from style_registry import STYLES
 
 IMAGE_CACHED_SECONDS = 60 * 60 * 24 * 30
-ImageParams = namedtuple("ImageParams", "dashboard format style xkcd rotate")
+PIES_MATPLOTLIB = "matplotlib"  # weeks grid pies and images drawn by matplotlib
+PIES_NUMPY = "numpy"  # drawn by `PiesRaster` directly into the figure pixels
+DEFAULT_DEVICE = "kindle"
+ENCODE_DEFAULT = "default"
+ImageParams = namedtuple(
+    "ImageParams",
+    "dashboard format style xkcd rotate pies target eink compression",
+    defaults=(PIES_MATPLOTLIB, DEFAULT_DEVICE, EINK_OFF, ENCODE_DEFAULT),
+)
+# (format, compression) of the image encoded from the drawn figure
+Encoding = tuple[str, str]
+
+# `compression` of ImageParams: save options by PIL format, formats without options use defaults
+ENCODER_PROFILES: dict[str, dict[str, dict[str, Any]]] = {
+    ENCODE_DEFAULT: {},
+    "fast": {  # the least CPU, larger files
+        "PNG": {"compress_level": 1},
+        "WEBP": {"method": 0},
+    },
+    "small": {  # the smallest files, for slow networks
+        "PNG": {"optimize": True},
+        "GIF": {"optimize": True},
+        "JPEG": {"optimize": True},
+        "WEBP": {"method": 6},
+    },
+}
 
 WEEKS = 4
 
-dpi = 100
-picture_width = 800 // dpi
-picture_height = 600 // dpi
+dpi = 100  # of the layout sizes in pixels, like `FOOTPRINT_PADDING`
+
+
+class DeviceProfile(NamedTuple):
+    """Image size in pixels before rotation, and dpi that scales texts and lines with it."""
+
+    width: int
+    height: int
+    dpi: float
+
+    @property
+    def figsize(self) -> tuple[float, float]:
+        """Figure size in inches."""
+        return self.width / self.dpi, self.height / self.dpi
+
+
+DEVICES = {  # `target` of the image params
+    "kindle": DeviceProfile(800, 600, 100),  # original Kindle 600 x 800 with rotate=90
+    "paperwhite": DeviceProfile(1448, 1072, 179),  # Kindle Paperwhite 1072 x 1448
+    "desktop": DeviceProfile(1600, 1200, 200),  # browsers on high density displays
+}
 
 left_gap = 0.01
 pies_height = 3.5 / 6  # vertical proportion between weeks grid and plot above it
@@ -57,6 +106,9 @@ pie_col_header_height = (pies_height / WEEKS) / 5
 pie_height = (pies_height - pie_col_header_height) / WEEKS
 pie_scale = 0.9
 
+PIE_EXPLODE = 0.007  # gap between the pie wedges
+WEATHER_ICON_EXTENT = (0.15, 0.85, 0.15, 0.85)  # in the weather axes
+
 legend_image_sz = 0.2  # size of legend icons in 1 x 1
 
 width_aspect = 1.282  # horizontal scale to fill full width of weeks grid
@@ -71,82 +123,560 @@ plot_width = 1 - watch_width - 0.025  # -0.02 to remove padding - tight layout d
 plot_height = 1 - pies_height - 0.125
 plot_bottom = 1 - plot_height - 0.025
 
+# left, bottom, width, height, in fractions of figure width and height
+WEATHER_RECT = (0, plot_bottom, plot_left * 0.8, plot_height)
+PLOT_RECT = (plot_left, plot_bottom, plot_width, plot_height)
+PIES_RECT = (left_gap, 0, 1, pies_height)
+# above the weeks grid, with the plot ticks and labels that are outside of the plot axes
+PLOT_PANEL_RECT = (0, pies_height, 1, 1 - pies_height)
+
+FIGURE_POOL_SIZE = 8  # figures of (dashboard, style, xkcd) kept between renders, for all devices
+TEXT_PATHS_CACHE_SIZE = 1024  # glyph outlines of texts kept by a figure
+# around the artist bbox: antialiasing, xkcd wiggles and white stroke of the lines,
+# in pixels at `dpi`
+FOOTPRINT_PADDING = 8
+
+ROTATIONS = {  # 90 degrees counterclockwise rotations
+    1: PIL.Image.Transpose.ROTATE_90,
+    2: PIL.Image.Transpose.ROTATE_180,
+    3: PIL.Image.Transpose.ROTATE_270,
+}
+
+# matplotlib rcParams are global for the process, and artists take the style from them on creation
+# so only one thread at a time can draw in its style.
+STYLE_LOCK = threading.RLock()
 
-def get_daily_max(grid: list[list[dict[str, list[int]]]]) -> int:
+
+def get_daily_max(grid: list[list[dict[str, Any]]]) -> int:
     """Maximum sum of 'values' for a day."""
     return max((sum(day["values"]) for week in grid for day in week), default=0)
 
 
-def draw_day_headers(grid: list[list[dict[str, Any]]]) -> None:
+def regions_mask(
+    regions: list[Bbox],
+    shape: tuple[int, ...],
+) -> npt.NDArray[np.bool_]:
+    """Pixels [row][column] (rows from the top) covered by the display regions."""
+    height, width = shape
+    mask = np.zeros((height, width), dtype=bool)
+    for region in regions:
+        left, right = max(math.floor(region.x0), 0), min(math.ceil(region.x1), width)
+        top, bottom = (
+            max(height - math.ceil(region.y1), 0),
+            min(height - math.floor(region.y0), height),
+        )
+        if left < right and top < bottom:
+            mask[top:bottom, left:right] = True
+    return mask
+
+
+class TextPathCache(TextToPath):
+    """`TextToPath` that keeps the outlines of the recently drawn texts.
+
+    Agg draws texts as bitmaps, but the texts with path effects (xkcd style) are drawn
+    as vector paths of the glyphs, and it is the same labels and numbers on each render.
+    """
+
+    def __init__(self, size: int = TEXT_PATHS_CACHE_SIZE) -> None:
+        """Init."""
+        super().__init__()
+        self.size = size
+        self.paths: OrderedDict[Hashable, list[npt.NDArray[Any]]] = OrderedDict()
+
+    def get_text_path(
+        self,
+        prop: matplotlib.font_manager.FontProperties,
+        s: str,
+        ismath: bool | Literal["TeX"] = False,
+        *,
+        features: tuple[str] | None = None,
+        language: str | list[tuple[str, int, int]] | None = None,
+    ) -> list[npt.NDArray[Any]]:
+        """Vertices and codes of the text path, calculated on the first call."""
+        key = (hash(prop), s, ismath, features, repr(language))
+        if key not in self.paths:
+            vertices, codes = super().get_text_path(
+                prop,
+                s,
+                ismath=ismath,
+                features=features,
+                language=language,
+            )
+            path: list[npt.NDArray[Any]] = [
+                np.array(vertices, dtype=np.float64).reshape(-1, 2),
+                np.array(codes, dtype=Path.code_type),
+            ]
+            for array in path:  # shared by the renders
+                array.setflags(write=False)
+            self.paths[key] = path
+            if len(self.paths) > self.size:
+                self.paths.popitem(last=False)
+        self.paths.move_to_end(key)
+        return self.paths[key]
+
+
+def diff_parts(
+    previous: dict[Hashable, Any],
+    inputs: dict[Hashable, Any],
+) -> set[Hashable] | None:
+    """Parts of the data that differ, None if the whole figure has to be redrawn.
+
+    :param inputs: data by part, "figure" is for data that needs the whole figure redrawn,
+        (week, day) for the weeks grid cells
+    """
+    if previous.keys() != inputs.keys():
+        return None
+    changed = {part for part, data in inputs.items() if data != previous[part]}
+    return None if "figure" in changed else changed
+
+
+class DeviceRaster:
+    """Pixels of the dashboard figure for a device, and what they were drawn for."""
+
+    def __init__(self, figure: Figure, device: DeviceProfile) -> None:
+        """Init, the new canvas becomes the canvas of the figure."""
+        self.device = device
+        self.canvas = FigureCanvasAgg(figure)
+        # pixels of the layout without data and the layout state they were drawn for
+        self.background: tuple[Hashable, Any] | None = None
+        self.inputs: dict[Hashable, Any] = {}  # data of the last frame by part
+        self.frame: npt.NDArray[np.uint8] | None = None  # pixels of the last render
+        self.drawn: set[Artist] = set()  # data artists of the last frame
+        self.footprints: dict[Artist, Bbox] = {}  # display areas of the drawn artists
+        # display areas to redraw, None to draw the whole figure
+        self.dirty: list[Bbox] | None = None
+
+
+class DashboardFigure:
+    """Dashboard figure reused between renders.
+
+    Keeps the layout: axes, weeks grid headers and today highlight.
+    Each render removes only the artists with data (pies, images, stackplot, texts)
+    and draws new ones.
+
+    If only some parts of the data changed (weather, plot, weeks grid cells),
+    only their artists are replaced, and only the regions they cover are redrawn
+    over the pixels of the previous render.
+    Create in the matplotlib style of the dashboard, the axes get it on creation.
+
+    The artists are the same for all devices, each device has its own `DeviceRaster`
+    with the figure pixels in its size, see `use_device()`.
+
+    The figure is not managed by pyplot and has its own Agg canvases,
+    so figures can be drawn in different threads.
+    """
+
+    def __init__(self, device: DeviceProfile = DEVICES[DEFAULT_DEVICE]) -> None:
+        """Init."""
+        self.figure = Figure(figsize=device.figsize, dpi=device.dpi, facecolor="white")
+        self.raster = DeviceRaster(self.figure, device)
+        self.rasters = {device: self.raster}
+        self.weather_axes = self.figure.add_axes(WEATHER_RECT)
+        configure_axes(self.weather_axes, xlim=(-0.03, 1.03), ylim=(-0.03, 1.03))
+        self.plot_axes = self.figure.add_axes(PLOT_RECT)
+        self.reset_plot()
+        self.labels_axes = self.figure.add_axes(PLOT_RECT, label="labels")
+        configure_axes(self.labels_axes, xlim=(0, 1 / plot_height), ylim=(0, 1))
+        self.pies_axes = self.figure.add_axes(PIES_RECT, autoscale_on=False)
+        configure_axes(self.pies_axes, xlim=(0, width_aspect), ylim=(0, pies_height))
+        self.pies_axes.set_frame_on(False)
+        self.pies_axes.set_aspect("equal")
+        self.day_headers: list[Text] | None = None
+        self.week_headers: list[Text] | None = None
+        self.highlight: patches.Rectangle | None = None
+        self.layout = {
+            artist
+            for axes in (self.weather_axes, self.labels_axes, self.pies_axes)
+            for artist in axes.get_children()
+        }
+        self.sprites = SpriteAtlas()
+        self.text_paths = TextPathCache()
+        self.inputs: dict[Hashable, Any] = {}  # data of the artists by part
+        self.cells: dict[tuple[int, int], list[Artist]] = {}  # weeks grid artists by cell
+        self.artist_cells: dict[Artist, tuple[int, int]] = {}
+
+    def reset_plot(self) -> None:
+        """Clear the plot axes.
+
+        Limits, units and ticks of the plot depend on the data so it is not reused.
+        """
+        self.plot_axes.cla()
+        self.plot_axes.dataLim.set(Bbox.null())  # cla() keeps the data limits
+        self.plot_axes.xaxis.set_major_locator(MaxNLocator(6))
+        self.plot_axes.patch.set_visible(False)  # type: ignore[union-attr]
+
+    def use_device(self, device: DeviceProfile) -> None:
+        """Draw the figure in the size and dpi of the device, on the canvas of the device."""
+        if device == self.raster.device:
+            return
+        if device not in self.rasters:
+            self.rasters[device] = DeviceRaster(self.figure, device)
+        self.raster = self.rasters[device]
+        self.figure.set_canvas(self.raster.canvas)
+        self.figure.set_dpi(device.dpi)
+        self.figure.set_size_inches(device.figsize, forward=False)
+        self.sprites.snap(self.figure)
+
+    def changed_parts(self, inputs: dict[Hashable, Any]) -> set[Hashable] | None:
+        """Parts of the data that changed since the artists were created, None for all.
+
+        :param inputs: data by part, see `diff_parts()`
+        """
+        previous, self.inputs = self.inputs, copy.deepcopy(inputs)
+        return diff_parts(previous, inputs)
+
+    def clear_data(self, changed: Collection[Hashable] | None = None) -> None:
+        """Remove artists of the previous render, keep the layout.
+
+        :param changed: parts of the data to remove, see `changed_parts()`, all by default
+        """
+        if changed is None:
+            for axes in (self.weather_axes, self.labels_axes, self.pies_axes):
+                for artist in axes.get_children():
+                    if artist not in self.layout:
+                        artist.remove()
+            # imshow makes the aspect equal
+            self.weather_axes.set_aspect("auto")
+            self.labels_axes.set_aspect("auto")
+            self.reset_plot()
+            self.cells.clear()
+            self.artist_cells.clear()
+            return
+
+        for artist in self.parts_artists(changed):
+            self.artist_cells.pop(artist, None)
+            if artist is not self.plot_axes:
+                artist.remove()
+        if "weather" in changed:
+            self.weather_axes.set_aspect("auto")
+        if "plot" in changed:
+            self.labels_axes.set_aspect("auto")
+            self.reset_plot()
+
+    def parts_artists(self, parts: Collection[Hashable]) -> list[Artist]:
+        """Data artists of the parts, see `changed_parts()`, the plot axes for the plot."""
+        artists = []
+        if "weather" in parts:
+            artists += self.data_artists(self.weather_axes)
+        if "plot" in parts:
+            artists += [self.plot_axes, *self.data_artists(self.labels_axes)]
+        for part in parts:
+            if isinstance(part, tuple):
+                artists += self.cells.get(part, [])
+        return artists
+
+    def add_cell_artists(self, week: int, day: int) -> None:
+        """Mark the new artists of the weeks grid as drawn for the cell."""
+        self.cells[week, day] = [
+            artist
+            for artist in self.data_artists(self.pies_axes)
+            if artist not in self.artist_cells
+        ]
+        for artist in self.cells[week, day]:
+            self.artist_cells[artist] = (week, day)
+
+    def footprint(self, artist: Artist) -> Bbox:
+        """Display area of the data artist on the current device.
+
+        The plot axes cover the plot panel with ticks and labels, the weeks grid artists
+        cover their cell.
+        """
+        footprints = self.raster.footprints
+        if artist not in footprints:
+            if artist is self.plot_axes:
+                footprints[artist] = Bbox.from_bounds(*PLOT_PANEL_RECT).transformed(
+                    self.figure.transFigure,
+                )
+            elif artist in self.artist_cells:
+                footprints[artist] = self.cell_footprint(*self.artist_cells[artist])
+            else:
+                bbox = artist.get_window_extent(self.raster.canvas.get_renderer())
+                footprints[artist] = bbox.padded(self.padding())
+        return footprints[artist]
+
+    def padding(self) -> float:
+        """`FOOTPRINT_PADDING` in the pixels of the current device."""
+        return FOOTPRINT_PADDING * self.figure.dpi / dpi
+
+    def cell_footprint(self, week: int, day: int) -> Bbox:
+        """Display area of the weeks grid cell."""
+        left = (pie_row_header_width + day * pie_width) * width_aspect
+        return Bbox.from_extents(
+            *self.pies_axes.transData.transform(
+                [
+                    (left, week * pie_height),
+                    (left + pie_width * width_aspect, (week + 1) * pie_height),
+                ],
+            ).flatten(),
+        ).padded(self.padding())
+
+    def update_layout(self, grid: list[list[dict[str, Any]]], today: datetime) -> None:
+        """Set weeks grid headers and move today highlight, create them on the first call."""
+        self.highlight = highlight_today(self.pies_axes, grid, today, self.highlight)
+        self.day_headers = draw_day_headers(self.pies_axes, grid, self.day_headers)
+        self.week_headers = draw_week_headers(self.pies_axes, grid, self.week_headers)
+        self.layout.update([self.highlight, *self.day_headers, *self.week_headers])
+
+    def data_artists(self, axes: Axes) -> list[Artist]:
+        """Artists of the current render in the axes, in the drawing order."""
+        return [
+            artist
+            for artist in sorted(axes.get_children(), key=lambda artist: artist.get_zorder())
+            if artist not in self.layout
+        ]
+
+    def layout_key(self) -> Hashable:
+        """State of the layout: weeks grid headers and today position."""
+        return (
+            tuple(header.get_text() for header in self.day_headers or []),
+            tuple(header.get_text() for header in self.week_headers or []),
+            tuple(self.highlight.get_xy()) if self.highlight is not None else None,
+        )
+
+    def draw(self) -> None:
+        """Draw the figure on the canvas of the current device.
+
+        The layout is drawn without data only if it changed, and the pixels are kept
+        as the background. Each render restores the background and draws the data over it.
+        If the device has the frame of a previous render, only the artists in the regions
+        that changed since then are drawn, `keep_frame()` takes the rest of the pixels
+        from that frame.
+        """
+        raster = self.raster
+        # the plot axes are redrawn whole: ticks and limits depend on the data
+        data = {
+            axes: [axes] if axes is self.plot_axes else self.data_artists(axes)
+            for axes in self.figure.axes  # in the drawing order
+        }
+        drawn = [artist for artists in data.values() for artist in artists]
+        changed = diff_parts(raster.inputs, self.inputs) if raster.frame is not None else None
+        raster.inputs = self.inputs
+        renderer = raster.canvas.get_renderer()
+        renderer._text2path = self.text_paths  # noqa: SLF001
+        key = self.layout_key()
+        if raster.background is None or raster.background[0] != key:
+            for artist in drawn:
+                artist.set_visible(False)
+            try:
+                raster.canvas.draw()
+            finally:
+                for artist in drawn:
+                    artist.set_visible(True)
+            raster.background = (key, raster.canvas.copy_from_bbox(self.figure.bbox))
+            changed = None
+        else:
+            raster.canvas.restore_region(raster.background[1])
+        for axes in data:
+            axes.apply_aspect()  # imshow() changes the aspect of the weather and labels axes
+        raster.dirty = None if changed is None else self.changed_regions(changed, drawn)
+        for artist in drawn:
+            if raster.dirty is None or overlaps(self.footprint(artist), raster.dirty):
+                artist.draw(renderer)
+        # to redraw the place of the artists after they are removed
+        raster.footprints = {artist: self.footprint(artist) for artist in drawn}
+        raster.drawn = set(drawn)
+
+    def changed_regions(self, changed: Collection[Hashable], drawn: list[Artist]) -> list[Bbox]:
+        """Display areas that changed since the last frame of the device.
+
+        :param changed: parts of the data, see `changed_parts()`
+        :param drawn: data artists of the current render
+        """
+        raster = self.raster
+        current = set(drawn)
+        regions = [self.cell_footprint(*part) for part in changed if isinstance(part, tuple)]
+        if "plot" in changed:
+            regions.append(self.footprint(self.plot_axes))
+        regions += [raster.footprints[artist] for artist in raster.drawn - current]
+        regions += [self.footprint(artist) for artist in current - raster.drawn]
+        return regions
+
+    def keep_frame(self) -> None:
+        """Keep the pixels of the render, outside the dirty regions they are from the previous one.
+
+        Call after all drawing on the canvas.
+        """
+        raster = self.raster
+        pixels = np.asarray(raster.canvas.buffer_rgba())
+        if raster.dirty is not None and raster.frame is not None:
+            outside = ~regions_mask(raster.dirty, pixels.shape[:2])
+            pixels[outside] = raster.frame[outside]
+        raster.frame = pixels.copy()
+
+    def close(self) -> None:
+        """Remove all artists."""
+        self.figure.clear()
+
+
+class FigurePool:
+    """Dashboard figures by (dashboard, style, xkcd).
+
+    A figure is taken from the pool for a render, so a render in other thread
+    with the same key gets a new figure instead of drawing on the same one.
+    The least recently used figures are closed if there are more than `size`.
+    """
+
+    def __init__(self, size: int = FIGURE_POOL_SIZE) -> None:
+        """Init."""
+        self.size = size
+        self.figures: OrderedDict[tuple[str, str, bool], DashboardFigure] = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def use(self, params: "ImageParams") -> Iterator[DashboardFigure]:
+        """Figure for the image params, new one is created in the current matplotlib style."""
+        key = (str(params.dashboard), str(params.style), bool(int(params.xkcd)))
+        with self.lock:
+            figure = self.figures.pop(key, None)
+        if figure is None:
+            figure = DashboardFigure()
+        try:
+            yield figure
+        finally:
+            self.put(key, figure)
+
+    def put(self, key: tuple[str, str, bool], figure: DashboardFigure) -> None:
+        """Return the figure to the pool."""
+        closed = []
+        with self.lock:
+            if key in self.figures:  # other thread returned the figure for the same key
+                closed.append(figure)
+            else:
+                self.figures[key] = figure
+            while len(self.figures) > self.size:
+                closed.append(self.figures.popitem(last=False)[1])
+        for unused in closed:
+            unused.close()
+
+    def clear(self) -> None:
+        """Close all figures."""
+        with self.lock:
+            figures = list(self.figures.values())
+            self.figures.clear()
+        for figure in figures:
+            figure.close()
+
+
+FIGURES = FigurePool()
+
+
+def configure_axes(axes: Axes, xlim: tuple[float, float], ylim: tuple[float, float]) -> None:
+    """Hide axis and background, set limits."""
+    axes.set_axis_off()
+    axes.patch.set_visible(False)  # type: ignore[union-attr]
+    axes.set_xticklabels([])  # type: ignore[operator]
+    axes.set_yticklabels([])  # type: ignore[operator]
+    axes.set_xlim(*xlim)
+    axes.set_ylim(*ylim)
+
+
+def draw_day_headers(
+    ax: Axes,
+    grid: list[list[dict[str, Any]]],
+    headers: list[Text] | None = None,
+) -> list[Text]:
     """Draws the day headers for a grid.
 
+    :param ax: weeks grid axes
     :param grid: A 2D grid [week][day].
-    :return: None
+    :param headers: headers from the previous call to update
+    :return: headers
     """
-    for day in range(WEEK_DAYS):
-        plt.text(
-            (pie_row_header_width + (day + 0.5) * pie_width) * width_aspect,
-            WEEKS * pie_height + 0.5 * pie_col_header_height,
-            grid[0][day]["date"].strftime("%A"),
-            horizontalalignment="center",
-            verticalalignment="center",
-            fontsize=12,
-        )
+    if headers is None:
+        headers = [
+            ax.text(
+                (pie_row_header_width + (day + 0.5) * pie_width) * width_aspect,
+                WEEKS * pie_height + 0.5 * pie_col_header_height,
+                "",
+                horizontalalignment="center",
+                verticalalignment="center",
+                fontsize=12,
+            )
+            for day in range(WEEK_DAYS)
+        ]
+    for day, header in enumerate(headers):
+        header.set_text(grid[0][day]["date"].strftime("%A"))
+    return headers
 
 
-def draw_week_headers(grid: list[list[dict[str, Any]]]) -> None:
+def draw_week_headers(
+    ax: Axes,
+    grid: list[list[dict[str, Any]]],
+    headers: list[Text] | None = None,
+) -> list[Text]:
     """Draw headers for each week on the grid using the date from the first day of each week.
 
+    :param ax: weeks grid axes
     :param grid: A 2D grid [week][day].
-    :return: None
+    :param headers: headers from the previous call to update
+    :return: headers
     """
-    for week in range(WEEKS):
+    if headers is None:
+        headers = [
+            ax.text(
+                pie_row_header_width * 0.5,
+                (week + 0.5) * pie_height,
+                "",
+                horizontalalignment="center",
+                verticalalignment="center",
+                fontsize=14,
+            )
+            for week in range(WEEKS)
+        ]
+    for week, header in enumerate(headers):
         week_starts_at = grid[week][0]["date"]
         if not isinstance(week_starts_at, datetime):
             raise TypeError(
                 f"Expected datetime.datetime, got {type(week_starts_at)} instead: {week_starts_at}",
             )
-        plt.text(
-            pie_row_header_width * 0.5,
-            (week + 0.5) * pie_height,
-            week_starts_at.strftime("%d\n%b"),
-            horizontalalignment="center",
-            verticalalignment="center",
-            fontsize=14,
-        )
+        header.set_text(week_starts_at.strftime("%d\n%b"))
+    return headers
 
 
-def draw_pie(
+def draw_pie(  # noqa: PLR0913
+    ax: Axes,
     week: int,
     day: int,
     values: list[int | float],
     daily_max: int | float,
+    *,
+    raster: PiesRaster | None = None,
 ) -> None:
     """Draws a pie chart for a specific day of a week based on the given values.
 
+    :param ax: weeks grid axes
     :param week: The index of the week.
     :param day: The index of the day within the week.
     :param values: A list of numerical values for each slice of the pie chart.
     :param daily_max: The maximum value for the day, used to determine the pie's radius.
+    :param raster: if specified the pie is added to it instead of drawing with matplotlib
     :return: None
     """
     radius = sum(values) / daily_max * pie_height * pie_scale / 2
     colours = [f"C{i}" for i in range(len(values))]
-    explode = [0.007 for _ in range(len(values))]
-    plt.pie(
+    center = (
+        (pie_row_header_width + (day + 0.5) * pie_width) * width_aspect,
+        (week + 0.5) * pie_height,
+    )
+    if raster is not None:
+        raster.add_pie(center, radius, values, colours, explode=PIE_EXPLODE)
+        return
+    explode = [PIE_EXPLODE for _ in range(len(values))]
+    ax.pie(
         values,
         # shadow=True,
         explode=explode,
         radius=radius,
         colors=colours,
-        center=(
-            (pie_row_header_width + (day + 0.5) * pie_width) * width_aspect,
-            (week + 0.5) * pie_height,
-        ),
+        center=center,
     )
+    # pie() sets limits around the pie
+    ax.set_xlim(0, width_aspect)
+    ax.set_ylim(0, pies_height)
 
 
 def draw_empty_pie(  # noqa: PLR0913
+    ax: Axes,
     grid: list[list[dict[str, datetime | list[dict[str, Any]]]]],
     image_loader: ImageLoader,
     week: int,
@@ -154,11 +684,15 @@ def draw_empty_pie(  # noqa: PLR0913
     absent_grid_images: dict[str, str],
     empty_image_file_name: str,
     tomorrow: datetime,
+    *,
+    sprites: SpriteAtlas,
+    raster: PiesRaster | None = None,
 ) -> None:
     """Draw an empty pie (or use an absent image) for a given week and day on the grid.
 
     Do not fill cells for a days in the future (after `tomorrow`).
 
+    :param ax: weeks grid axes
     :param grid: The grid representing the schedule with structure [week][day]["date"].
     :param image_loader: Image loader.
     :param week: The week index for which to draw the pie.
@@ -167,6 +701,8 @@ def draw_empty_pie(  # noqa: PLR0913
                                "image_grid" from the "absent" array in the settings.
     :param empty_image_file_name: Name of the file to use for the empty image.
     :param tomorrow: The datetime representing the start of the next day.
+    :param sprites: resized images
+    :param raster: if specified the image is added to it instead of drawing with matplotlib
     :return: None
     """
     week_starts_at = grid[week][day]["date"]
@@ -174,96 +710,107 @@ def draw_empty_pie(  # noqa: PLR0913
         raise TypeError(
             f"Expected datetime.datetime, got {type(week_starts_at)} instead: {week_starts_at}",
         )
-    image_padding = pie_width / 5
     if "absents" in grid[week][day]:
         absents = grid[week][day]["absents"]
         if not isinstance(absents, list):
             raise TypeError(
                 f"Expected list, got {type(absents)} instead: {absents} for week {week} day {day}",
             )
-        image = image_loader.by_file_name(absent_grid_images[absents[0]["summary"]])
+        image_file_name = absent_grid_images[absents[0]["summary"]]
     else:
-        image = image_loader.by_file_name(empty_image_file_name)
+        image_file_name = empty_image_file_name
+    image = image_loader.by_file_name(image_file_name)
     if week_starts_at < tomorrow:
-        plt.imshow(
-            image,
-            extent=(
-                (pie_row_header_width + day * pie_width + image_padding) * width_aspect,
-                (pie_row_header_width + (day + 1) * pie_width - image_padding) * width_aspect,
-                week * pie_height + image_padding,
-                (week + 1) * pie_height - image_padding,
-            ),
-            interpolation="bicubic",
-        )
+        extent = cell_image_extent(week, day)
+        if raster is not None:
+            raster.add_image(image_file_name, image, extent)
+        else:
+            sprites.imshow(ax, image_file_name, image, extent)
+
+
+def cell_image_extent(week: int, day: int) -> Extent:
+    """Extent of the image in the weeks grid cell."""
+    image_padding = pie_width / 5
+    return (
+        (pie_row_header_width + day * pie_width + image_padding) * width_aspect,
+        (pie_row_header_width + (day + 1) * pie_width - image_padding) * width_aspect,
+        week * pie_height + image_padding,
+        (week + 1) * pie_height - image_padding,
+    )
 
 
-def highlight_today(grid: list[list[dict[str, Any]]], today: datetime) -> None:
+def highlight_today(
+    ax: Axes,
+    grid: list[list[dict[str, Any]]],
+    today: datetime,
+    highlight: patches.Rectangle | None = None,
+) -> patches.Rectangle:
     """Draw a rectangle around the current day in the grid to highlight it.
 
+    :param ax: weeks grid axes
     :param grid: The grid representing the schedule with structure [week][day]["date"].
     :param today: A datetime object indicating the current day.
-    :return: None
+    :param highlight: rectangle from the previous call to move
+    :return: the rectangle
     """
     grid_shift = (today - grid[0][0]["date"]).days
     day = grid_shift % WEEK_DAYS
     week = grid_shift // WEEK_DAYS
-    plt.gca().add_patch(
-        patches.Rectangle(
-            ((pie_row_header_width + day * pie_width) * width_aspect, week * pie_height),
+    position = ((pie_row_header_width + day * pie_width) * width_aspect, week * pie_height)
+    if highlight is None:
+        highlight = patches.Rectangle(
+            position,
             pie_width * width_aspect * 0.98,
             pie_height,
             edgecolor="black",
             fill=False,
             linewidth=2,
-        ),
-    )
+        )
+        ax.add_patch(highlight)
+    else:
+        highlight.set_xy(position)
+    return highlight
 
 
-def draw_pies(
+def draw_pies(  # noqa: PLR0913
     grid: list[list[dict[str, Any]]],
+    figure: DashboardFigure,
+    *,
     image_loader: ImageLoader,
     absent_grid_images: dict[str, str],
     empty_image_file_name: str,
     weeks: int = 4,
+    raster: PiesRaster | None = None,
+    cells: Collection[tuple[int, int]] | None = None,
 ) -> None:
     """Draw pie charts or images for each day in the provided grid based on the data provided.
 
     :param grid: The grid representing the schedule [week][day]["date"]/["values"].
+    :param figure: Dashboard figure.
     :param image_loader: Instance responsible for loading images.
     :param weeks: Number of weeks to consider. Default is 4.
     :param absent_grid_images: Dictionary mapping absent summary to image file names,
                                 which comes from the
                                "image_grid" key within the "absent" array in the settings.
     :param empty_image_file_name: File name of the image to use when there's no data.
+    :param raster: if specified pies and images are added to it to draw with numpy
+                   after the figure is drawn
+    :param cells: (week, day) of the cells to draw, all by default
     :return: None
     """
     daily_max = get_daily_max(grid)
-    today = datetime.now(grid[0][0]["date"].tzinfo).replace(
-        hour=0,
-        minute=0,
-        second=0,
-        microsecond=0,
-    )
+    today = grid_today(grid)
     tomorrow = today + timedelta(days=1)
-    ax = plt.gcf().add_axes(
-        (
-            left_gap,
-            0,
-            1,
-            pies_height,
-        ),  # left, bottom, width, height, in fractions of figure width and height
-        frameon=False,
-        autoscale_on=False,
-    )
-    plt.axis("off")
-    highlight_today(grid, today)
-    draw_day_headers(grid)
-    draw_week_headers(grid)
+    ax = figure.pies_axes
+    figure.update_layout(grid, today)
     for week in range(weeks):
         for day in range(len(grid[week])):
+            if cells is not None and (week, day) not in cells:
+                continue
             values = grid[week][day]["values"]
             if sum(values) <= 0:
                 draw_empty_pie(
+                    ax,
                     grid,
                     image_loader,
                     week,
@@ -271,45 +818,44 @@ def draw_pies(
                     absent_grid_images,
                     empty_image_file_name,
                     tomorrow,
+                    sprites=figure.sprites,
+                    raster=raster,
                 )
             else:
-                draw_pie(week, day, values, daily_max)
+                draw_pie(ax, week, day, values, daily_max, raster=raster)
+            figure.add_cell_artists(week, day)
 
-    ax.set_ylim(0, pies_height)
-    ax.set_xlim(0, width_aspect)
-    ax.patch.set_visible(False)  # type: ignore[union-attr]
-    ax.set_xticklabels([])  # type: ignore[operator]
-    ax.set_yticklabels([])  # type: ignore[operator]
+
+def grid_today(grid: list[list[dict[str, Any]]]) -> datetime:
+    """Start of the current day in the time zone of the grid."""
+    return datetime.now(grid[0][0]["date"].tzinfo).replace(
+        hour=0,
+        minute=0,
+        second=0,
+        microsecond=0,
+    )
 
 
 def draw_weather(
     weather: WeatherData | None,
-    rect: tuple[float, float, float, float],
+    figure: DashboardFigure,
     image_loader: ImageLoader,
 ) -> None:
-    """Render the weather data onto a specified rectangle using matplotlib.
+    """Render the weather data onto the weather axes of the figure.
 
     :param weather: Weather data to render.
                     Only data for 1st day is used.
                     If weather is None, only the date is rendered.
 
-    :param rect: A list of four float numbers [left, bottom, width, height]
-                 specifying the rectangle where the
-                 weather data will be rendered.
-    :type rect: list[float]
+    :param figure: Dashboard figure.
+    :type figure: DashboardFigure
 
     :param image_loader: Instance responsible for loading images.
     :type image_loader: ImageLoader
 
     :return: None
     """
-    ax = plt.axes(rect)
-    plt.axis("off")
-    ax.patch.set_visible(False)  # type: ignore[union-attr]
-    ax.set_xticklabels([])  # type: ignore[operator]
-    ax.set_yticklabels([])  # type: ignore[operator]
-    ax.set_ylim(-0.03, 1.03)
-    ax.set_xlim(-0.03, 1.03)
+    ax = figure.weather_axes
     ax.text(
         0.5,
         1,
@@ -326,71 +872,103 @@ def draw_weather(
         horizontalalignment="center",
         verticalalignment="bottom",
     )
-    plt.imshow(
-        image_loader.by_file_name(os.path.join(weather.images_folder, f"{weather.icon[0]}.png")),
-        extent=(0.15, 0.85, 0.15, 0.85),
-        interpolation="bilinear",  # 'bicubic'
+    image_file_name = os.path.join(weather.images_folder, f"{weather.icon[0]}.png")
+    figure.sprites.imshow(
+        ax,
+        image_file_name,
+        image_loader.by_file_name(image_file_name),
+        WEATHER_ICON_EXTENT,
     )
 
 
 def place_text_and_image(
-    ax: Axes,
+    figure: DashboardFigure,
     x_pos: datetime,
     y_pos: int | float,
     label: WeatherLabel,
     image_loader: ImageLoader,
-) -> None:
-    """Place text and image on the axes."""
-    ax.text(x_pos, y_pos, label.summary, horizontalalignment="center", verticalalignment="top")  # type: ignore
+) -> Icon | None:
+    """Place text on the plot, the image is returned to be drawn with the other labels images."""
+    figure.plot_axes.text(
+        x_pos,  # type: ignore[arg-type]
+        y_pos,
+        label.summary,
+        horizontalalignment="center",
+        verticalalignment="top",
+    )
 
     if label.image:
-        add_image_to_axes(ax, x_pos, y_pos, label, image_loader)
+        return (
+            label.image,
+            image_loader.by_file_name(label.image),
+            label_image_extent(figure, x_pos, y_pos),
+        )
+    return None
 
 
-def add_image_to_axes(
-    ax: Axes,
+def label_image_extent(
+    figure: DashboardFigure,
     x_pos: datetime,
     y_pos: int | float,
-    label: WeatherLabel,
-    image_loader: ImageLoader,
-) -> None:
-    """Add image to the axes."""
+) -> Extent:
+    """Extent of the label image in the labels axes, under the label text on the plot."""
     legend_text_height = 0.13
+    ax = figure.plot_axes
     xlim, ylim = ax.get_xlim(), ax.get_ylim()
     xsz, ysz = xlim[1] - xlim[0], ylim[1] - ylim[0]
     x_scale = 1 / plot_height  # Clarify the logic behind this.
     x_val = float((date2num(x_pos) - xlim[0]) / xsz * x_scale)
     y_val = float((y_pos - ylim[0]) / ysz)
 
-    axes = plt.axes((plot_left, plot_bottom, plot_width, plot_height), label="2")
-    configure_axes_for_image(axes)
-    plt.imshow(
-        image_loader.by_file_name(label.image),
-        extent=(
-            x_val - legend_image_sz / 2,
-            x_val + legend_image_sz / 2,
-            y_val - legend_image_sz - legend_text_height,
-            y_val - legend_text_height,
-        ),
-        interpolation="bicubic",
+    return (
+        x_val - legend_image_sz / 2,
+        x_val + legend_image_sz / 2,
+        y_val - legend_image_sz - legend_text_height,
+        y_val - legend_text_height,
     )
 
 
-def configure_axes_for_image(axes: Axes) -> None:
-    """Configure the axes for displaying an image."""
-    plt.axis("off")
-    axes.patch.set_visible(False)  # type: ignore[union-attr]
-    axes.set_xticklabels([])  # type: ignore[operator]
-    axes.set_yticklabels([])  # type: ignore[operator]
-    axes.set_ylim(0, 1)
-    axes.set_xlim(0, 1 / plot_height)  # Used the earlier logic for x_scale directly here.
+def build_sprites(  # noqa: PLR0913
+    figure: DashboardFigure,
+    image_loader: ImageLoader,
+    *,
+    cell_images: list[str],
+    label_images: list[str],
+    weather_images_folder: str | None,
+) -> None:
+    """Resize all icons of the dashboard for the figure.
+
+    Icons not resized here (for example from changed settings) are resized on the first use.
+
+    :param cell_images: empty and absent weeks grid cells images
+    :param label_images: plot labels images
+    :param weather_images_folder: folder of the weather icons, all of them are resized
+    """
+    weather_images = []
+    if weather_images_folder:
+        with contextlib.suppress(OSError):
+            weather_images = [
+                os.path.join(weather_images_folder, file_name)
+                for file_name in sorted(os.listdir(weather_images_folder))
+                if file_name.endswith(".png")
+            ]
+    for ax, extent, file_names in (
+        (figure.pies_axes, cell_image_extent(0, 0), cell_images),
+        (figure.labels_axes, (0, legend_image_sz, 0, legend_image_sz), label_images),
+        (figure.weather_axes, WEATHER_ICON_EXTENT, weather_images),
+    ):
+        figure.sprites.build(
+            ax,
+            extent,
+            ((file_name, image_loader.by_file_name(file_name)) for file_name in file_names),
+        )
 
 
 def draw_plot(  # noqa: PLR0913
     x: list[datetime],
     y: list[list[float]],
     labels: list[WeatherLabel],
-    rect: tuple[float, float, float, float],
+    figure: DashboardFigure,
     image_loader: ImageLoader,
     legend: str = "inside",
 ) -> None:
@@ -401,9 +979,8 @@ def draw_plot(  # noqa: PLR0913
     :param y: 2D list where each inner list represents a dataset for the plot, meant to be stacked.
     :type y: list[list[float]]
     :param labels: List of dictionaries containing labels for each dataset in `y`.
-    :param rect: A list of four floats denoting the [left, bottom, width, height]
-                   of the rectangle where the plot is drawn.
-    :type rect: list[float]
+    :param figure: Dashboard figure, the plot is drawn on its plot axes.
+    :type figure: DashboardFigure
     :param image_loader: Instance responsible for image operations.
     :type image_loader: ImageLoader
     :param legend: Specifies the legend style.
@@ -414,7 +991,7 @@ def draw_plot(  # noqa: PLR0913
 
     :return: None
     """
-    ax = plt.axes(rect)
+    ax = figure.plot_axes
     if len(x) > 0:
         days_on_plot = (x[-1] - x[0]).days
         if days_on_plot < 5 * 30:
@@ -426,22 +1003,36 @@ def draw_plot(  # noqa: PLR0913
         ax.xaxis.set_major_formatter(short_fmt)
     legend_labels = [label.summary for label in labels]
     polies = ax.stackplot(x, y)  # type: ignore
-    ax.xaxis.set_major_locator(MaxNLocator(6))
-    ax.patch.set_visible(False)  # type: ignore[union-attr]
     if legend == "rectangle":
-        plt.legend(
+        ax.legend(
             [patches.Rectangle((0, 0), 1, 1, fc=poly.get_facecolor()[0]) for poly in polies],
             legend_labels,
         )
     elif legend == "inside":
         # y_sum = np.sum(np.array(y), axis=0)
         # y_max = y_sum.max()
+        icons = []
         for region, label in enumerate(labels):
             if not y[region]:
-                return
+                break
             max_idx, _ = max(enumerate(y[region]), key=lambda item: item[1])
             x_pos, y_pos = x[max_idx], y[region][max_idx]
-            place_text_and_image(ax, x_pos, y_pos, label, image_loader)
+            icon = place_text_and_image(figure, x_pos, y_pos, label, image_loader)
+            if icon is not None:
+                icons.append(icon)
+        figure.sprites.overlay(figure.labels_axes, icons)
+
+
+def warm_up() -> None:
+    """Load matplotlib fonts and draw xkcd text so the first dashboard render does not wait for it.
+
+    Initializer of the render processes.
+    """
+    figure = Figure(figsize=(1, 1), dpi=dpi)
+    canvas = FigureCanvasAgg(figure)
+    with STYLE_LOCK, STYLES.context("default", xkcd=True):
+        figure.text(0.5, 0.5, "0")
+        canvas.draw()
 
 
 @cached(
@@ -462,6 +1053,14 @@ def draw_calendar(  # noqa: PLR0913
     """Draw IoT calendar as image, optimized for Amazon Kindle (600 x 800).
 
     To prepare data see functions in calendar_data.py
+    The figure of the dashboard is reused from `FIGURES`, only changed data is redrawn.
+    Images for other devices (`target` in params, see `DEVICES`) are drawn from the same
+    figure artists, in the size and dpi of the device.
+    Can be called from different threads, drawing in the matplotlib style is serialized
+    by `STYLE_LOCK` but image encoding runs in parallel.
+    To profile the drawing stages set `IOT_CALENDAR_PROFILE`, see `render_profiler`.
+    Encoder options are selected by `compression` in params, see `ENCODER_PROFILES`.
+    To encode one drawing in several formats use `draw_calendar_encodings`.
 
     :param grid:
         grid[weeks][days]
@@ -484,63 +1083,189 @@ def draw_calendar(  # noqa: PLR0913
     :return:
         image data in specified (in params) format (png, gif etc)
     """
-    plt.clf()
-    plt.figure(figsize=(picture_width, picture_height), dpi=dpi, facecolor="white")
+    encoding = (params.format, params.compression)
+    return draw_calendar_encodings(
+        grid,
+        x,
+        y,
+        weather,
+        dashboard,
+        events,
+        absent_labels,
+        params,
+        (encoding,),
+    )[encoding]
+
+
+def draw_calendar_encodings(  # noqa: PLR0913, PLR0917
+    grid: list[list[dict[str, datetime | list[int]]]],
+    x: list[datetime],
+    y: list[list[float]],
+    weather: WeatherData | None,
+    dashboard: dict[str, str | list[dict[str, str]]],
+    events: list[dict[str, str]],
+    absent_labels: list[dict[str, str]],
+    params: "ImageParams",
+    encodings: Collection[Encoding],
+) -> dict[Encoding, bytes]:
+    """Draw IoT calendar once and encode the image in each of the encodings.
+
+    Params are the same as in `draw_calendar`, `format` and `compression` of `params`
+    are ignored, all other params define the drawn image.
+
+    :param encodings: (format, compression) like in ImageParams
+    :return: image data by encoding
+    """
+    check_params(params, encodings)
+    device = DEVICES[params.target]
+    raster = PiesRaster() if params.pies == PIES_NUMPY else None
+    empty_image_file_name = dashboard["empty_image"]
+    if not isinstance(empty_image_file_name, str):
+        raise TypeError(
+            f"Expected filename in `empty_image`, got {type(empty_image_file_name)} "
+            f"instead: {empty_image_file_name}",
+        )
     absent_grid_images = {absent["summary"]: absent["image_grid"] for absent in absent_labels}
+    labels = [WeatherLabel(summary=event["summary"], image=event["image"]) for event in events]
+    daily_max = get_daily_max(grid)
+    inputs: dict[Hashable, Any] = {
+        "figure": (
+            params.pies,
+            grid_today(grid),
+            [[day["date"] for day in week] for week in grid],
+            empty_image_file_name,
+            absent_grid_images,
+        ),
+        "weather": weather,
+        "plot": (x, y, labels),
+        **{
+            (week, day): (cell, daily_max)
+            for week, days in enumerate(grid[:WEEKS])
+            for day, cell in enumerate(days)
+        },
+    }
     image_loader = ImageLoader()
-    plt.rcParams.update(matplotlib.rcParamsDefault)
-    with matplotlib.style.context(params.style, after_reset=True):  # type: ignore[union-attr]
-        if int(params.xkcd):
-            plt.xkcd()
-        draw_weather(
-            weather,
-            rect=(0, plot_bottom, plot_left * 0.8, plot_height),
-            image_loader=image_loader,
-        )
-        draw_plot(
-            x,
-            y,
-            [WeatherLabel(summary=event["summary"], image=event["image"]) for event in events],
-            rect=(plot_left, plot_bottom, plot_width, plot_height),
-            image_loader=image_loader,
+    # the figure is used until the image is encoded but the style lock is released after drawing
+    with profile_render(), contextlib.ExitStack() as figure_in_use:
+        with STYLE_LOCK, STYLES.context(str(params.style), xkcd=bool(int(params.xkcd))):
+            figure = figure_in_use.enter_context(FIGURES.use(params))
+            figure.use_device(device)
+            with stage("draw"):
+                changed = figure.changed_parts(inputs)
+                figure.clear_data(changed)
+                if not figure.sprites.sprites:
+                    build_sprites(
+                        figure,
+                        image_loader,
+                        cell_images=[empty_image_file_name, *absent_grid_images.values()],
+                        label_images=[event["image"] for event in events if event.get("image")],
+                        weather_images_folder=weather.images_folder if weather else None,
+                    )
+                if changed is None or "weather" in changed:
+                    with profiled("weather"):
+                        draw_weather(weather, figure, image_loader=image_loader)
+                if changed is None or "plot" in changed:
+                    with profiled("plot"):
+                        draw_plot(x, y, labels, figure, image_loader=image_loader)
+                with profiled("pies"):
+                    draw_pies(
+                        grid,
+                        figure,
+                        image_loader=image_loader,
+                        weeks=WEEKS,
+                        absent_grid_images=absent_grid_images,
+                        empty_image_file_name=empty_image_file_name,
+                        raster=raster,
+                        # the raster draws unchanged pies around the changed ones too
+                        cells=None
+                        if changed is None or raster is not None
+                        else [part for part in changed if isinstance(part, tuple)],
+                    )
+                with profiled("canvas"):
+                    figure.draw()
+
+        with stage("draw"), profiled("raster"):
+            if raster is not None:
+                raster.draw(
+                    figure.pies_axes,
+                    np.asarray(figure.raster.canvas.buffer_rgba()),
+                    figure.sprites,
+                    regions=figure.raster.dirty,
+                )
+            figure.keep_frame()
+
+        with stage("encode"), profiled("encode"):
+            image = create_image(figure.figure, rotation_degrees=int(params.rotate))
+            image = to_eink(image, params.eink)
+            return {
+                (image_format, compression): encode_image(image, image_format, compression)
+                for image_format, compression in encodings
+            }
+
+
+def check_params(params: "ImageParams", encodings: Collection[Encoding]) -> None:
+    """Raise ValueError for unknown pies renderer, target, e-ink mode or compression."""
+    if params.pies not in (PIES_MATPLOTLIB, PIES_NUMPY):
+        raise ValueError(
+            f"Unknown pies renderer {params.pies}, use {PIES_MATPLOTLIB} or {PIES_NUMPY}",
         )
-        empty_image_file_name = dashboard["empty_image"]
-        if not isinstance(empty_image_file_name, str):
-            raise TypeError(
-                f"Expected filename in `empty_image`, got {type(empty_image_file_name)} "
-                f"instead: {empty_image_file_name}",
+    if params.target not in DEVICES:
+        raise ValueError(f"Unknown target {params.target}, use one of {', '.join(DEVICES)}")
+    if params.eink not in EINK_MODES:
+        raise ValueError(f"Unknown e-ink mode {params.eink}, use one of {', '.join(EINK_MODES)}")
+    for _, compression in encodings:
+        if compression not in ENCODER_PROFILES:
+            raise ValueError(
+                f"Unknown compression {compression}, use one of {', '.join(ENCODER_PROFILES)}",
             )
-        draw_pies(
-            grid,
-            image_loader=image_loader,
-            weeks=WEEKS,
-            absent_grid_images=absent_grid_images,
-            empty_image_file_name=empty_image_file_name,
-        )
-        plt.gcf().canvas.draw()
 
-        image = create_image(rotation_degrees=int(params.rotate), format=params.format)
-        bytes_file = BytesIO()
-        image.save(bytes_file, format=params.format)
-        return bytes_file.getvalue()
 
+def create_image(figure: Figure, rotation_degrees: int) -> PIL.Image.Image:
+    """Create image from the pixels of the drawn matplotlib figure.
 
-def create_image(rotation_degrees: int, format: str) -> PIL.Image.Image:  # pragma: no cover
-    """Create image from matplotlib canvas."""
+    Without rotation the image shares memory with the figure canvas.
+    """
     if rotation_degrees % 90 != 0:
         raise ValueError("Degrees should be a multiple of 90")
 
     num_90_rotations = (rotation_degrees // 90) % 4
-    buf = io.BytesIO()
-    plt.savefig(buf, format=format)
-    buf.seek(0)
-    image = PIL.Image.open(buf)
+    canvas = figure.canvas
+    if not isinstance(canvas, FigureCanvasAgg):
+        raise TypeError(f"Expected Agg canvas, got {type(canvas)} instead")
+    image = PIL.Image.frombuffer(
+        "RGBA",
+        canvas.get_width_height(),
+        canvas.buffer_rgba(),
+        "raw",
+        "RGBA",
+        0,
+        1,
+    )
+    if num_90_rotations:
+        image = image.transpose(ROTATIONS[num_90_rotations])
+    return image
+
 
-    # Rotate the image
-    img_np = np.array(image)
-    img_np = np.rot90(img_np, k=num_90_rotations)
+def encode_image(
+    image: PIL.Image.Image,
+    format: str,
+    compression: str = ENCODE_DEFAULT,
+) -> bytes:
+    """Encode image to the format, `format` is file extension like png, gif or jpg.
 
-    return PIL.Image.fromarray(img_np)
+    `compression` is the name of the save options in `ENCODER_PROFILES`.
+    PNG of palette image has as few bits per pixel as the palette needs.
+    """
+    pil_format = PIL.Image.registered_extensions().get(f".{format.lower()}", format.upper())
+    options = dict(ENCODER_PROFILES[compression].get(pil_format, {}))
+    if pil_format == "JPEG":  # no alpha channel
+        image = image.convert("RGB")
+    elif pil_format == "PNG" and image.mode == "P":  # bits per pixel for the palette size
+        colors = len(image.getpalette() or []) // 3
+        options["bits"] = next((bits for bits in (1, 2, 4) if colors <= 2**bits), 8)
+    bytes_file = BytesIO()
+    image.save(bytes_file, format=pil_format, **options)
+    return bytes_file.getvalue()
 
 
 def check(show: bool = True) -> None:  # pragma: no cover
@@ -0,0 +1,553 @@
+"""Render dashboard images and keep them ready for the web-server.
+
+Usage
+    renderer = DashboardRenderer(settings, executor, images=FileImageStore(folder))
+    PrerenderScheduler(renderer, interval_seconds=60).start()
+    image = await renderer.get(params)
+
+The scheduler re-renders every dashboard from settings in the commonly used
+`ImageParams` combinations when their inputs change (new Google calendar data,
+weather refresh, day rollover), so requests just return the stored bytes.
+"""
+
+import asyncio
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+from collections.abc import Callable, Iterable, Iterator, MutableMapping
+from pathlib import Path
+from typing import Any, NamedTuple, TypeVar
+
+import tornado.ioloop
+
+from calendar_data import (
+    calendar_events_list,
+    dashboard_absent_events_list,
+    events_to_array,
+    events_to_weeks_grid,
+)
+from calendar_image import ENCODE_DEFAULT, Encoding, ImageParams, draw_calendar_encodings
+from google_calendar import MIN_GOOGLE_API_CALL_DELAY_SECONDS, collect_events
+from metrics import RENDERS, SHED_REQUESTS, STAGE_SECONDS, StageTimer, run_timed
+from models import RenderedImage, WeatherData
+from openweathermap_org import Weather
+
+T = TypeVar("T")
+
+MAX_STALE_SECONDS = 60 * 10
+MAX_RENDERS = 4
+MAX_QUEUED_RENDERS = 16
+RETRY_AFTER_SECONDS = 5
+
+# (format, style, xkcd, rotate) for the Kindle page and for the links from index.html
+PRERENDER_PARAMS = [
+    ("png", "grayscale", "1", "90"),
+    ("png", "seaborn-v0_8-talk", "1", "0"),
+    ("png", "seaborn-v0_8-talk", "0", "0"),
+]
+
+
+class RenderQueueFullError(Exception):
+    """Too many images are rendering or waiting for render."""
+
+
+class DashboardData(NamedTuple):
+    """Data to draw dashboard, `draw_calendar` parameters except `params`."""
+
+    grid: list[list[dict[str, Any]]]
+    x: list[datetime.datetime]
+    y: list[list[int]]
+    weather: WeatherData | None
+    dashboard: dict[str, Any]
+    events: list[dict[str, Any]]
+    absent_labels: list[dict[str, Any]]
+
+
+def render_key(params: ImageParams) -> ImageParams:
+    """Canonical form of image params.
+
+    Params from the request are strings but defaults could be numbers,
+    so `xkcd=1` and `xkcd="1"` should be the same image.
+    """
+    return ImageParams(*(str(value) for value in params))._replace(format=params.format.lower())
+
+
+def raster_key(params: ImageParams) -> ImageParams:
+    """Key of the drawn image, the same for all its encodings (format and compression)."""
+    return render_key(params)._replace(format="", compression=ENCODE_DEFAULT)
+
+
+def prerender_keys(settings: dict[str, Any]) -> list[ImageParams]:
+    """Keys of images of all dashboards from settings in `PRERENDER_PARAMS` combinations."""
+    return [
+        render_key(ImageParams(dashboard_name, image_format, style, xkcd, rotate))
+        for dashboard_name in settings["dashboards"]
+        for image_format, style, xkcd, rotate in PRERENDER_PARAMS
+    ]
+
+
+def dashboard_keys(keys: Iterable[ImageParams]) -> dict[str, list[ImageParams]]:
+    """Keys grouped by dashboard name, in the order of the keys."""
+    result: dict[str, list[ImageParams]] = {}
+    for key in keys:
+        result.setdefault(key.dashboard, []).append(key)
+    return result
+
+
+def inputs_hash(data: DashboardData, params: ImageParams) -> str:
+    """Hash of everything the image depends on.
+
+    The image shows the current date, so it changes at day rollover even with the same data.
+    """
+    hash_list = [str(datetime.date.today()), str(data), str(params)]
+    return hashlib.sha256("\n".join(hash_list).encode("utf-8")).hexdigest()
+
+
+def image_age(image: RenderedImage) -> float:
+    """Seconds since the image inputs were checked."""
+    return (datetime.datetime.now(datetime.UTC) - image.checked_at).total_seconds()
+
+
+class FileImageStore(MutableMapping[ImageParams, RenderedImage]):
+    """Rendered images in files, to share them between web-server processes.
+
+    Each image is one file: json with image attributes in the first line and image data after it.
+    Files are replaced atomically, so other processes never read partially written image.
+    """
+
+    suffix = ".image"
+    ready_file = "ready"  # created when the warm-up is finished, by any process
+
+    def __init__(self, folder: str) -> None:
+        """Init.
+
+        :param folder: folder for the images files, created if not exists
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: ImageParams) -> Path:
+        """Path to the image file."""
+        file_name = hashlib.sha256(str(tuple(key)).encode("utf-8")).hexdigest()
+        return self.folder / f"{file_name}{self.suffix}"
+
+    @staticmethod
+    def read(path: Path) -> tuple[ImageParams, RenderedImage]:
+        """Read image file."""
+        with path.open("rb") as image_file:
+            header = json.loads(image_file.readline())
+            data = image_file.read()
+        image = RenderedImage(data=data, **header["image"])
+        return ImageParams(*header["key"]), image
+
+    def __getitem__(self, key: ImageParams) -> RenderedImage:
+        """Read image from file."""
+        try:
+            return self.read(self.path(key))[1]
+        except FileNotFoundError as e:
+            raise KeyError(key) from e
+
+    def __setitem__(self, key: ImageParams, image: RenderedImage) -> None:
+        """Write image to file."""
+        header = {"key": list(key), "image": image.model_dump(mode="json", exclude={"data"})}
+        with tempfile.NamedTemporaryFile(dir=self.folder, suffix=".tmp", delete=False) as tmp:
+            tmp.write(json.dumps(header).encode("utf-8") + b"\n")
+            tmp.write(image.data)
+        os.replace(tmp.name, self.path(key))
+
+    def __delitem__(self, key: ImageParams) -> None:
+        """Delete image file."""
+        try:
+            self.path(key).unlink()
+        except FileNotFoundError as e:
+            raise KeyError(key) from e
+
+    def __iter__(self) -> Iterator[ImageParams]:
+        """Keys of all stored images."""
+        for path in self.folder.glob(f"*{self.suffix}"):
+            try:
+                yield self.read(path)[0]
+            except FileNotFoundError:  # deleted by other process
+                continue
+
+    def __len__(self) -> int:
+        """Number of stored images."""
+        return sum(1 for _ in self.folder.glob(f"*{self.suffix}"))
+
+    def clear(self) -> None:
+        """Delete all images files, including left by interrupted writes, and the ready mark."""
+        for pattern in (f"*{self.suffix}", "*.tmp", self.ready_file):
+            for path in self.folder.glob(pattern):
+                path.unlink(missing_ok=True)
+
+    def mark_ready(self) -> None:
+        """Mark the images warmed up for all processes sharing the folder."""
+        (self.folder / self.ready_file).touch()
+
+    def is_ready(self) -> bool:
+        """If the images were warmed up by any process sharing the folder."""
+        return (self.folder / self.ready_file).exists()
+
+
+class DashboardRenderer:
+    """Load dashboard data and render images.
+
+    Rendered images are stored by `render_key` and re-rendered only if
+    `inputs_hash` changed.
+    The image is drawn once for all encodings requested so far with the same `raster_key`,
+    and all encoded variants are stored side by side.
+    Concurrent renders of the same image wait for one in-flight render.
+    To share images between web-server processes use `FileImageStore` as `images`.
+    In stale-while-revalidate mode the last image is returned at once and refreshed
+    in background.
+    The image is rendered in the `executor` (process pool, see `iot_calendar.main()`),
+    or in the IOLoop thread if there is no executor.
+    At most `max_renders` images render at once and `max_queued_renders` wait for their turn,
+    if the queue is full the last image is returned, without it `RenderQueueFullError` is raised.
+    """
+
+    def __init__(  # noqa: PLR0913, PLR0917
+        self,
+        settings: dict[str, Any],
+        executor: concurrent.futures.Executor | None = None,
+        images: MutableMapping[ImageParams, RenderedImage] | None = None,
+        stale_while_revalidate: bool = False,
+        max_stale_seconds: float = MAX_STALE_SECONDS,
+        max_renders: int = MAX_RENDERS,
+        max_queued_renders: int = MAX_QUEUED_RENDERS,
+    ) -> None:
+        """Init.
+
+        :param settings: settings loaded by `iot_calendar.load_settings`
+        :param executor: to render images, None to render in the IOLoop thread
+        :param images: rendered images store, in memory by default
+        :param stale_while_revalidate: return the last image and refresh it in background
+        :param max_stale_seconds: older images are never returned without refresh
+        :param max_renders: images rendering at the same time
+        :param max_queued_renders: images waiting for render, more renders are refused
+        """
+        self.settings = settings
+        self.weather = Weather(settings)  # one instance so its cache keeps API calls rare
+        self.executor = executor
+        self.images = {} if images is None else images
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_stale_seconds = max_stale_seconds
+        self.max_renders = max_renders
+        self.render_slots = asyncio.Semaphore(max_renders)
+        self.max_in_flight = max_renders + max_queued_renders
+        self.scheduled: set[ImageParams] = set()  # kept up to date by PrerenderScheduler
+        self.in_flight: dict[ImageParams, asyncio.Future[tuple[RenderedImage, StageTimer]]] = {}
+        # encodings requested for each `raster_key`, all of them are encoded on render
+        self.encodings: dict[ImageParams, set[Encoding]] = {}
+        self.warmed_up = False  # set by warm_up
+
+    async def warm_up(self) -> None:
+        """Render images of all dashboards so the first requests do not pay for the start-up.
+
+        That builds Google API client, loads weather, icons and matplotlib fonts.
+        `max_renders` images are rendered concurrently to start all render processes,
+        so warm-up never fills the render queue and leaves it to the requests.
+        Errors are reported but do not prevent readiness, failed images are rendered on request.
+        """
+        dashboards = dashboard_keys(prerender_keys(self.settings))
+        slots = asyncio.Semaphore(self.max_renders)
+        await asyncio.gather(*(self.render_dashboard(keys, slots) for keys in dashboards.values()))
+        self.warmed_up = True
+        if isinstance(self.images, FileImageStore):
+            self.images.mark_ready()
+
+    @property
+    def ready(self) -> bool:
+        """If the warm-up is finished.
+
+        With images shared in files, by any web-server process, so only one of them warms up.
+        """
+        if isinstance(self.images, FileImageStore):
+            return self.images.is_ready()
+        return self.warmed_up
+
+    async def render_dashboard(
+        self,
+        keys: list[ImageParams],
+        slots: asyncio.Semaphore | None = None,
+    ) -> None:
+        """Render images of one dashboard, its data is loaded once for all the images.
+
+        Images are rendered concurrently, errors are reported and do not stop other images.
+
+        :param slots: limits the images that are rendering at once, could be shared by dashboards
+        """
+        try:
+            data = await self.load_data(keys[0].dashboard)
+        except Exception as e:  # noqa: BLE001
+            print("#" * 5, f" Error loading {keys[0].dashboard}:\n{e}")
+            return
+
+        async def render(key: ImageParams) -> None:
+            async with slots or contextlib.nullcontext():
+                try:
+                    await self.render(key, data=data)
+                except Exception as e:  # noqa: BLE001
+                    print("#" * 5, f" Error rendering {key}:\n{e}")
+
+        await asyncio.gather(*(render(key) for key in keys))
+
+    async def load_data(
+        self,
+        dashboard_name: str,
+        timer: StageTimer | None = None,
+    ) -> DashboardData:
+        """Load dashboard data.
+
+        Google calendar and weather are loaded concurrently in the IOLoop thread pool.
+
+        :param timer: to collect the stages durations
+        """
+        if timer is None:
+            timer = StageTimer()
+        settings = self.settings
+        with timer.stage("settings"):
+            calendar_events = calendar_events_list(settings, dashboard_name)
+            absent_events = dashboard_absent_events_list(settings, dashboard_name)
+        with timer.stage("fetch"):
+            (events, absents), weather = await asyncio.gather(
+                self.run_in_thread(
+                    timer.stage("collect_events"),
+                    collect_events,
+                    calendar_events,
+                    absent_events,
+                    settings,
+                ),
+                self.run_in_thread(
+                    timer.stage("get_weather"),
+                    self.weather.get_weather,
+                    settings["latitude"],
+                    settings["longitude"],
+                ),
+            )
+        with timer.stage("events_to_grid"):
+            grid = events_to_weeks_grid(events, absents)
+            x, y = events_to_array(events, absents)
+        with timer.stage("settings"):
+            if weather:
+                weather.images_folder = settings["images_folder"]
+            dashboard = settings["dashboards"][dashboard_name]
+            if "images_folder" not in dashboard:
+                dashboard["images_folder"] = settings["images_folder"]
+        return DashboardData(grid, x, y, weather, dashboard, calendar_events, absent_events)
+
+    @staticmethod
+    async def run_in_thread(
+        timing: contextlib.AbstractContextManager[None],
+        func: Callable[..., T],
+        *args: Any,
+    ) -> T:
+        """Run blocking I/O function in the IOLoop thread pool.
+
+        :param timing: context manager to measure the call duration
+        """
+        with timing:
+            return await tornado.ioloop.IOLoop.current().run_in_executor(None, func, *args)
+
+    async def render(
+        self,
+        params: ImageParams,
+        timer: StageTimer | None = None,
+        data: DashboardData | None = None,
+    ) -> RenderedImage:
+        """Render the image if its inputs changed since the last render.
+
+        If the same image is already rendering, wait for that render instead of starting new one.
+
+        :param timer: receives the render stages durations and cache status
+        :param data: dashboard data if already loaded
+        """
+        key = render_key(params)
+        coalesced = key in self.in_flight
+        # shield so the client that disconnected does not cancel the render for others
+        image, render_timer = await asyncio.shield(self.start_render(key, data))
+        if timer is not None:
+            timer.durations.update(render_timer.durations)
+            timer.cache = "coalesced" if coalesced else render_timer.cache
+        return image
+
+    def start_render(
+        self,
+        params: ImageParams,
+        data: DashboardData | None = None,
+    ) -> asyncio.Future[tuple[RenderedImage, StageTimer]]:
+        """Start render, or return the in-flight render of the same image.
+
+        :param data: dashboard data if already loaded
+        :raise RenderQueueFullError: if the render queue is full
+        """
+        key = render_key(params)
+        future = self.in_flight.get(key)
+        if future is None:
+            if len(self.in_flight) >= self.max_in_flight:
+                raise RenderQueueFullError(f"{len(self.in_flight)} images are rendering")
+            future = asyncio.ensure_future(self._render(key, data))
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return future
+
+    async def _render(
+        self,
+        key: ImageParams,
+        data: DashboardData | None,
+    ) -> tuple[RenderedImage, StageTimer]:
+        """Load data if not loaded yet and render the image if its inputs changed.
+
+        Other encodings of the same drawing are rendered and stored too.
+        Stages durations go to the `metrics.STAGE_SECONDS` histogram.
+        """
+        encodings = self.encodings.setdefault(raster_key(key), set())
+        timer = StageTimer()
+        with timer.stage("queue"):
+            await self.render_slots.acquire()
+        try:
+            if data is None:
+                data = await self.load_data(key.dashboard, timer)
+            data_hash = inputs_hash(data, key)
+            image = self.images.get(key)
+            if image is None or image.inputs_hash != data_hash:
+                with timer.stage("render"):
+                    encoded, render_durations = await self.run_render(
+                        run_timed,
+                        draw_calendar_encodings,
+                        *data,
+                        key,
+                        tuple(sorted(encodings | {(key.format, key.compression)})),
+                    )
+                timer.durations.update(render_durations)
+                now = datetime.datetime.now(datetime.UTC)
+                variants = {}
+                for (image_format, compression), image_data in encoded.items():
+                    variant = key._replace(format=image_format, compression=compression)
+                    variants[variant] = RenderedImage(
+                        data=image_data,
+                        etag=hashlib.sha256(image_data).hexdigest(),
+                        inputs_hash=inputs_hash(data, variant),
+                        rendered_at=now,
+                        checked_at=now,
+                    )
+                image = variants.pop(key)
+                self.images.update(variants)  # other encodings, stored side by side
+                RENDERS.inc(result="rendered")
+                timer.cache = "miss"
+            else:
+                image = image.model_copy(
+                    update={"checked_at": datetime.datetime.now(datetime.UTC)},
+                )
+                RENDERS.inc(result="unchanged")
+                timer.cache = "unchanged"
+            self.images[key] = image
+            encodings.add((key.format, key.compression))  # not added if the encoding failed
+        except Exception:
+            RENDERS.inc(result="error")
+            raise
+        finally:
+            self.render_slots.release()
+            STAGE_SECONDS.observe_all(timer.durations)
+        return image, timer
+
+    async def get(self, params: ImageParams, timer: StageTimer | None = None) -> RenderedImage:
+        """Get the image.
+
+        Images maintained by the scheduler are returned as is, others are rendered on demand.
+        In stale-while-revalidate mode the last image is returned at once, and if it was not
+        checked for a while it is refreshed in background.
+        Images older than `max_stale_seconds` are always rendered before return.
+        If the render queue is full the last image is returned regardless of its age.
+
+        :param timer: receives the stages durations and cache status
+        :raise RenderQueueFullError: if the render queue is full and there is no image yet
+        """
+        key = render_key(params)
+        image = self.images.get(key)
+        if image is not None and image_age(image) <= self.max_stale_seconds:
+            status = None
+            if key in self.scheduled:
+                status = "hit"
+            elif self.stale_while_revalidate:
+                status = "hit"
+                if image_age(image) > MIN_GOOGLE_API_CALL_DELAY_SECONDS:
+                    self.revalidate(key)
+                    status = "stale"
+            if status is not None:
+                if timer is not None:
+                    timer.cache = status
+                return image
+        try:
+            return await self.render(key, timer)
+        except RenderQueueFullError:
+            if image is None:
+                SHED_REQUESTS.inc(result="unavailable")
+                raise
+            SHED_REQUESTS.inc(result="stale")
+            if timer is not None:
+                timer.cache = "shed"
+            return image
+
+    def revalidate(self, params: ImageParams) -> None:
+        """Refresh the image in background."""
+
+        def report_error(future: asyncio.Future[tuple[RenderedImage, StageTimer]]) -> None:
+            if not future.cancelled() and (error := future.exception()) is not None:
+                print("#" * 5, f" Error refreshing {params}:\n{error}")
+
+        # with full queue the stale image is refreshed on a later request
+        with contextlib.suppress(RenderQueueFullError):
+            self.start_render(params).add_done_callback(report_error)
+
+    async def run_render(self, func: Callable[..., T], *args: Any) -> T:
+        """Run render function in the render executor.
+
+        Matplotlib is not thread-safe, so without process pool executor we render right in
+        the IOLoop thread.
+        """
+        if self.executor is None:
+            return func(*args)
+        return await tornado.ioloop.IOLoop.current().run_in_executor(self.executor, func, *args)
+
+
+class PrerenderScheduler:
+    """Re-render images of all dashboards from settings in background."""
+
+    def __init__(self, renderer: DashboardRenderer, interval_seconds: float) -> None:
+        """Init.
+
+        :param renderer: renderer to keep up to date
+        :param interval_seconds: how often to check if the images inputs changed
+        """
+        self.renderer = renderer
+        self.interval_seconds = interval_seconds
+        self.periodic_callback: tornado.ioloop.PeriodicCallback | None = None
+        renderer.scheduled.update(prerender_keys(renderer.settings))
+
+    async def refresh(self) -> None:
+        """Re-render images with changed inputs, one image at a time.
+
+        The data of each dashboard is loaded once for all its images.
+        """
+        for keys in dashboard_keys(sorted(self.renderer.scheduled)).values():
+            await self.renderer.render_dashboard(keys, slots=asyncio.Semaphore(1))
+
+    def start(self) -> None:
+        """Render all images and schedule periodic refresh in the current IOLoop."""
+        self.periodic_callback = tornado.ioloop.PeriodicCallback(
+            self.refresh,
+            self.interval_seconds * 1000,
+        )
+        self.periodic_callback.start()
+        tornado.ioloop.IOLoop.current().add_callback(self.refresh)
+
+    def stop(self) -> None:
+        """Stop periodic refresh."""
+        if self.periodic_callback is not None:
+            self.periodic_callback.stop()
+            self.periodic_callback = None
@@ -14,9 +14,11 @@ from google.oauth2 import service_account
 from googleapiclient import discovery
 
 from cached_decorator import cached
+from metrics import upstream_request
 
 GOOGLE_CREDENTIALS_PARAM = "credentials_file_name"
 MIN_GOOGLE_API_CALL_DELAY_SECONDS = 15
+GOOGLE_API_ENDPOINT: str | None = None  # None for Google servers, load_test.py uses fake server
 
 
 class Calendar:
@@ -64,6 +66,7 @@ You can get new one from https://console.developers.google.com/start/api?id=cale
             "calendar",
             "v3",
             credentials=self.credentials,
+            client_options={"api_endpoint": GOOGLE_API_ENDPOINT} if GOOGLE_API_ENDPOINT else None,
         )
 
     def parse_time(self, s: str) -> datetime.datetime:
@@ -118,22 +121,23 @@ You can get new one from https://console.developers.google.com/start/api?id=cale
         tzinfo = dateutil.tz.tzoffset(None, -time.timezone)
         page_token = None
         while True:
-            events = (
-                self.service.events()  # type: ignore[union-attr]
-                .list(
-                    calendarId=self.calendarId,
-                    timeMin=self.google_time_format(
-                        datetime.datetime.now() - datetime.timedelta(days=days),
-                    ),
-                    q=summary,
-                    # timeZone='UTC',
-                    orderBy="startTime",
-                    singleEvents=True,
-                    showDeleted=False,
-                    pageToken=page_token,
+            with upstream_request("google_calendar"):
+                events = (
+                    self.service.events()  # type: ignore[union-attr]
+                    .list(
+                        calendarId=self.calendarId,
+                        timeMin=self.google_time_format(
+                            datetime.datetime.now() - datetime.timedelta(days=days),
+                        ),
+                        q=summary,
+                        # timeZone='UTC',
+                        orderBy="startTime",
+                        singleEvents=True,
+                        showDeleted=False,
+                        pageToken=page_token,
+                    )
+                    .execute()
                 )
-                .execute()
-            )
             if len(events["items"]) > 0:
                 for event in events["items"]:
                     start, end = get_event_interval(event)
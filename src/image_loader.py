@@ -1,5 +1,6 @@
 """Load mathplot images from files."""
 
+import os
 from typing import Any
 
 import matplotlib.image as mpimg
@@ -14,6 +15,7 @@ class ImageLoader(metaclass=Singleton):
 
     Cache images that have already been read.
     Return default image if file does not exist or if file name is empty.
+    In the child process after fork the cache starts from scratch.
     """
 
     def __init__(self) -> None:
@@ -32,3 +34,6 @@ class ImageLoader(metaclass=Singleton):
                 print("#" * 5, f" Error reading image from {image_file_name}:\n{e}")
                 return self._non_existed
         return self._cache[image_file_name]
+
+
+os.register_at_fork(after_in_child=ImageLoader.new_instance)
@@ -1,11 +1,14 @@
 """Web-server for calendar."""
 
+import concurrent.futures
 import datetime
 import json
+import multiprocessing
 import os
 import os.path
 import pprint
 import sys
+import tempfile
 from collections.abc import Awaitable, Sequence
 from pathlib import Path
 from typing import Any, cast
@@ -14,20 +17,30 @@ import tornado.auth
 import tornado.escape
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 from tornado.options import define, options
 from tornado.routing import _RuleList
 
-from calendar_data import (
-    calendar_events_list,
-    dashboard_absent_events_list,
-    events_to_array,
-    events_to_weeks_grid,
+import metrics
+from calendar_image import ImageParams, warm_up
+from dashboard_renderer import (
+    MAX_QUEUED_RENDERS,
+    MAX_RENDERS,
+    MAX_STALE_SECONDS,
+    RETRY_AFTER_SECONDS,
+    DashboardRenderer,
+    FileImageStore,
+    PrerenderScheduler,
+    RenderQueueFullError,
+    image_age,
 )
-from calendar_image import ImageParams, draw_calendar
-from google_calendar import GOOGLE_CREDENTIALS_PARAM, collect_events
-from openweathermap_org import WEATHER_KEY_PARAM, Weather
+from google_calendar import GOOGLE_CREDENTIALS_PARAM
+from models import RenderedImage
+from openweathermap_org import WEATHER_KEY_PARAM
+from render_profiler import PROFILE_DIR_ENV
 
 SETTINGS_FOLDER = "../amazon-dash-private"
 SETTINGS_FILE_NAME = "settings.json"
@@ -116,42 +129,48 @@ class HandlerWithParams(tornado.web.RequestHandler):
 
 
 class DashboardImageHandler(HandlerWithParams):
-    """Dashboard image handler."""
+    """Dashboard image handler.
 
-    # todo async decorators and async version of draw_calendar
-    def get(self, *args: str, **_kwargs: str) -> None:
+    Answers `304 Not Modified` if the client already has the image (`If-None-Match`).
+    `Server-Timing` header shows where the request time was spent and if the image was cached.
+    Answers `503 Service Unavailable` with `Retry-After` if the render queue is full
+    and there is no image rendered before.
+    """
+
+    async def get(self, *args: str, **_kwargs: str) -> None:
         """Get image."""
         image_format = args[0]
-        self.disable_cache()
         params = self.load_params(
             format=image_format,
             dashboard=list(settings["dashboards"].keys())[0],
         )
-        calendar_events = calendar_events_list(settings, params.dashboard)
-        absent_events = dashboard_absent_events_list(settings, "anna_work_out")
-        events, absents = collect_events(calendar_events, absent_events, settings)
-        grid = events_to_weeks_grid(events, absents)
-        x, y = events_to_array(events, absents)
-        wth = Weather(settings)
-        weather = wth.get_weather(settings["latitude"], settings["longitude"])
-        if weather:
-            weather.images_folder = settings["images_folder"]
-        dashboard = settings["dashboards"][params.dashboard]
-        if "images_folder" not in dashboard:
-            dashboard["images_folder"] = settings["images_folder"]
-        image = draw_calendar(
-            grid,
-            x,
-            y,
-            weather,
-            dashboard,
-            calendar_events,
-            absent_events,
-            params,
-        )
-        self.write(image)
+        renderer: DashboardRenderer = self.settings["renderer"]
+        timer = metrics.StageTimer()
+        try:
+            image = await renderer.get(params, timer)
+        except RenderQueueFullError:
+            self.set_status(503)
+            self.set_header("Retry-After", RETRY_AFTER_SECONDS)
+            self.write("Too many images are rendering, retry later")
+            return
+        if server_timing := metrics.server_timing(timer):
+            self.set_header("Server-Timing", server_timing)
+        self.set_cache_validators(image)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
         self.set_header("Content-type", f"image/{image_format}")
-        self.flush()
+        self.write(image.data)
+
+    def set_cache_validators(self, image: RenderedImage) -> None:
+        """Let the client cache the image but check if it is changed on each request.
+
+        `Age` is seconds since the image was found up to date.
+        """
+        self.set_header("Cache-Control", "no-cache")
+        self.set_header("Etag", f'"{image.etag}"')
+        self.set_header("Last-Modified", image.rendered_at)
+        self.set_header("Age", max(0, int(image_age(image))))
 
     def data_received(self, chunk: bytes) -> Awaitable[None] | None:
         """Receive data."""
@@ -172,6 +191,10 @@ class DashboardListHandler(HandlerWithParams):
                 xkcd=params.xkcd,
                 format=params.format,
                 rotate=params.rotate,
+                pies=params.pies,
+                target=params.target,
+                eink=params.eink,
+                compression=params.compression,
                 page_title="Dashboard",
             )
         else:
@@ -186,9 +209,48 @@ class DashboardListHandler(HandlerWithParams):
         """Receive data."""
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """Metrics in Prometheus text format."""
+
+    def get(self, *_args: str, **_kwargs: str) -> None:
+        """Get metrics."""
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.exposition())
+
+    def data_received(self, chunk: bytes) -> Awaitable[None] | None:
+        """Receive data."""
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """Liveness probe, the web-server answers requests."""
+
+    def get(self, *_args: str, **_kwargs: str) -> None:
+        """Get health status."""
+        self.write("ok")
+
+    def data_received(self, chunk: bytes) -> Awaitable[None] | None:
+        """Receive data."""
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """Readiness probe, `503 Service Unavailable` until the start-up warm-up is finished."""
+
+    def get(self, *_args: str, **_kwargs: str) -> None:
+        """Get readiness status."""
+        renderer: DashboardRenderer = self.settings["renderer"]
+        if not renderer.ready:
+            self.set_status(503)
+            self.write("warming up")
+            return
+        self.write("ready")
+
+    def data_received(self, chunk: bytes) -> Awaitable[None] | None:
+        """Receive data."""
+
+
 HandlersType = (
     Sequence[
-        tuple[str, type[HandlerWithParams]]
+        tuple[str, type[tornado.web.RequestHandler]]
         | tuple[str, type[tornado.web.StaticFileHandler], dict[str, Any]]
     ]
     | None
@@ -202,19 +264,29 @@ class Application(tornado.web.Application):
         self,
         server_settings: dict[str, Any] | None = None,
         handlers: HandlersType = None,
+        renderer: DashboardRenderer | None = None,
     ):
-        """Init."""
+        """Init.
+
+        :param renderer: renders dashboard images, by default renders in the IOLoop thread
+        """
         if server_settings is None:
             server_settings = {
                 "template_path": os.path.join(os.path.dirname(__file__), "../templates"),
                 "debug": True,
             }
+        if renderer is None:
+            renderer = DashboardRenderer(settings)
+        server_settings = {**server_settings, "renderer": renderer}
         if handlers is None:
             handlers = [
                 (r"/", DashboardListHandler),
                 (r"/index.html", DashboardListHandler),
                 (r"/dashboard\.(\w*)", DashboardImageHandler),
                 (r"/d\.(\w*)", DashboardImageHandler),
+                (r"/metrics", MetricsHandler),
+                (r"/healthz", HealthHandler),
+                (r"/readyz", ReadyHandler),
                 (
                     r"/img/(.*)",
                     tornado.web.StaticFileHandler,
@@ -234,20 +306,142 @@ class Application(tornado.web.Application):
         tornado.web.Application.__init__(self, cast(_RuleList, handlers), **server_settings)
 
 
+def create_render_executor(processes: int) -> concurrent.futures.Executor | None:
+    """Create process pool to render images outside of the IOLoop process.
+
+    :param processes: number of render processes, 0 to render in the IOLoop thread
+    """
+    if processes <= 0:
+        return None
+    # spawn so the render processes do not inherit IOLoop and thread pool state
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=warm_up,
+    )
+
+
+def create_image_store(folder: str | None, workers: int) -> FileImageStore | None:
+    """Create store for rendered images.
+
+    One web-server process keeps images in memory unless `folder` is specified,
+    several processes share images in files.
+
+    :param folder: folder for the images files, by default new temp folder of this server,
+        so other servers on the host do not share it.
+        Create the store before forking the workers so they share the folder.
+    :param workers: number of web-server processes
+    :return: None for in memory store
+    """
+    if folder is None:
+        if workers == 1:
+            return None
+        return FileImageStore(tempfile.mkdtemp(prefix="iot-calendar-"))
+    store = FileImageStore(folder)
+    store.clear()  # do not serve images left by the previous run
+    return store
+
+
 def main() -> None:  # pragma: no cover
     """Check."""
     global settings  # noqa: PLW0603
 
     define("port", default=4444, help="run on the given port", type=int)
     define("folder", default=None, help="path to settings and files with secrets", type=str)
+    define(
+        "render_processes",
+        default=1,
+        help="number of processes to render images, 0 to render in the web-server process",
+        type=int,
+    )
+    define(
+        "prerender_interval",
+        default=60,
+        help="seconds between checks if pre-rendered images are outdated, 0 to render on request",
+        type=float,
+    )
+    define(
+        "stale_while_revalidate",
+        default=False,
+        help="return the last rendered image at once and refresh it in background",
+        type=bool,
+    )
+    define(
+        "max_stale",
+        default=MAX_STALE_SECONDS,
+        help="seconds, older images are rendered before return, should exceed prerender_interval",
+        type=float,
+    )
+    define(
+        "max_renders",
+        default=MAX_RENDERS,
+        help="number of images rendering at the same time",
+        type=int,
+    )
+    define(
+        "render_queue",
+        default=MAX_QUEUED_RENDERS,
+        help="number of images waiting for render, if more requests get the last image or 503",
+        type=int,
+    )
+    define(
+        "workers",
+        default=1,
+        help="number of web-server processes, 0 for one process per CPU",
+        type=int,
+    )
+    define(
+        "render_store",
+        default=None,
+        help="folder to share rendered images between workers, new temp folder by default",
+        type=str,
+    )
+    define(
+        "profile_dir",
+        default=None,
+        help="folder to write cProfile and collapsed stacks of each render stage",
+        type=str,
+    )
     tornado.options.parse_command_line()
 
-    settings = load_settings(folder=options.folder)
-    http_server = tornado.httpserver.HTTPServer(Application())
-    print(f"Running on port {options.port}")
+    if options.profile_dir:  # before the render processes start, they inherit environment
+        os.environ[PROFILE_DIR_ENV] = options.profile_dir
 
-    http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    settings = load_settings(folder=options.folder)
+    images = create_image_store(options.render_store, options.workers)
+    sockets = tornado.netutil.bind_sockets(options.port)
+    task_id = 0
+    if options.workers != 1:
+        # fork before any IOLoop, thread or process pool is created
+        task_id = tornado.process.fork_processes(options.workers)
+    renderer = DashboardRenderer(
+        settings,
+        executor=create_render_executor(options.render_processes),
+        images=images,
+        stale_while_revalidate=options.stale_while_revalidate,
+        max_stale_seconds=options.max_stale,
+        max_renders=options.max_renders,
+        max_queued_renders=options.render_queue,
+    )
+    # in all workers, so they return the scheduled images without render
+    scheduler = (
+        PrerenderScheduler(renderer, options.prerender_interval)
+        if options.prerender_interval > 0
+        else None
+    )
+    http_server = tornado.httpserver.HTTPServer(Application(renderer=renderer))
+    http_server.add_sockets(sockets)
+    print(f"Running on port {options.port} (worker {task_id}), warming up")
+
+    async def warm_up_renderer() -> None:
+        await renderer.warm_up()
+        print(f"Ready on port {options.port} (worker {task_id})")
+        if scheduler is not None:  # after warm-up, so they do not load the same data at once
+            scheduler.start()
+
+    if task_id == 0:  # images are shared so one worker warms them up and renders for all
+        tornado.ioloop.IOLoop.current().add_callback(warm_up_renderer)
+    tornado.ioloop.IOLoop.current().start()
 
 
 if __name__ == "__main__":  # pragma: no cover
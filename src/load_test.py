@@ -0,0 +1,395 @@
+"""Load test of the web-server without real Google Calendar and weather APIs.
+
+Usage
+    python load_test.py --clients=50 --duration=60 --latency=0.2 --error_rate=0.01
+
+Starts local stand-ins for Google Calendar API (with OAuth token endpoint),
+OpenWeatherMap.org and weather.gov, and the web-server `Application` with
+settings from `--folder` but with fake secrets pointing to these stand-ins.
+Images are rendered in separate processes as in production.
+Then simulates Kindle clients polling `/dashboard.png` and prints latency
+percentiles, throughput and memory usage.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import random
+import resource
+import socket
+import statistics
+import tempfile
+import time
+from collections import Counter as CounterDict
+from pathlib import Path
+from typing import Any
+
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.options
+import tornado.web
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from tornado.options import define, options
+
+import google_calendar
+import iot_calendar
+import openweathermap_org
+import weather_gov
+from dashboard_renderer import (
+    MAX_QUEUED_RENDERS,
+    MAX_RENDERS,
+    MAX_STALE_SECONDS,
+    DashboardRenderer,
+    PrerenderScheduler,
+)
+from google_calendar import GOOGLE_CREDENTIALS_PARAM
+from openweathermap_org import WEATHER_KEY_PARAM
+
+EVENTS_PAGE_SIZE = 10  # small to make the client follow `nextPageToken`
+KINDLE_PATH = "/dashboard.png?style=grayscale&xkcd=1&rotate=90"
+
+
+class FakeUpstreamHandler(tornado.web.RequestHandler):
+    """Answer after `latency` seconds (+-50%), fail with `error_rate` probability."""
+
+    def initialize(self, latency: float, error_rate: float) -> None:
+        """Init."""
+        self.latency = latency
+        self.error_rate = error_rate
+
+    async def prepare(self) -> None:
+        """Simulate network latency and errors."""
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))  # noqa: S311
+        if random.random() < self.error_rate:  # noqa: S311
+            self.set_status(500)
+            self.write_error_response()
+            self.finish()
+
+    def write_error_response(self) -> None:
+        """Write error in the API format."""
+        self.write({"error": {"code": 500, "message": "Fake upstream error"}})
+
+    def data_received(self, chunk: bytes) -> None:
+        """Receive data."""
+
+
+class FakeGoogleTokenHandler(FakeUpstreamHandler):
+    """OAuth token for the fake service account."""
+
+    def post(self) -> None:
+        """Issue token."""
+        self.write({"access_token": "fake-token", "token_type": "Bearer", "expires_in": 3600})
+
+
+class FakeGoogleEventsHandler(FakeUpstreamHandler):
+    """Google Calendar API `events().list`: an event a day with the searched summary."""
+
+    def get(self, calendar_id: str) -> None:
+        """List events."""
+        summary = self.get_argument("q", "")
+        time_min = datetime.datetime.strptime(
+            self.get_argument("timeMin"),
+            "%Y-%m-%dT%H:%M:%SZ",
+        )
+        events = []
+        day = time_min.replace(hour=0, minute=0, second=0, microsecond=0)
+        while day <= datetime.datetime.now():
+            # the same events for the same day so the image is not re-rendered on each request
+            day_random = random.Random(f"{calendar_id}{summary}{day}")  # noqa: S311
+            start = day + datetime.timedelta(hours=8, minutes=day_random.randrange(0, 600, 5))
+            end = start + datetime.timedelta(minutes=day_random.randrange(10, 90, 5))
+            events.append(
+                {
+                    "summary": summary,
+                    "start": {"dateTime": start.isoformat() + "Z"},
+                    "end": {"dateTime": end.isoformat() + "Z"},
+                },
+            )
+            day += datetime.timedelta(days=1)
+        first = int(self.get_argument("pageToken", "0"))
+        page: dict[str, Any] = {"items": events[first : first + EVENTS_PAGE_SIZE]}
+        if first + EVENTS_PAGE_SIZE < len(events):
+            page["nextPageToken"] = str(first + EVENTS_PAGE_SIZE)
+        self.write(page)
+
+
+class FakeOpenWeatherMapHandler(FakeUpstreamHandler):
+    """OpenWeatherMap.org `/data/2.5/forecast`: 5 days forecast in 3 hours steps."""
+
+    def write_error_response(self) -> None:
+        """Write error in the API format."""
+        self.write({"cod": "500", "message": "Fake upstream error"})
+
+    def get(self) -> None:
+        """Get forecast."""
+        today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        forecast = []
+        for step in range(5 * 8):
+            time_point = today + datetime.timedelta(hours=3 * step)
+            forecast.append(
+                {
+                    "dt_txt": time_point.strftime("%Y-%m-%d %H:%M:%S"),
+                    "main": {"temp_min": 10 + step % 8, "temp_max": 12 + step % 8},
+                    "weather": [{"id": 802, "icon": "03d"}],
+                },
+            )
+        self.write({"cod": "200", "cnt": len(forecast), "list": forecast})
+
+
+class FakeWeatherGovHandler(FakeUpstreamHandler):
+    """Weather.gov NDFD `ndfdSOAPclientByDay.php` in DWML (XML) format."""
+
+    def write_error_response(self) -> None:
+        """Write error in the API format."""
+        self.write("<error><pre>Fake upstream error</pre></error>")
+
+    def get(self) -> None:
+        """Get forecast."""
+        days = int(self.get_argument("numDays", "1"))
+        today = datetime.date.today().isoformat()
+        self.set_header("Content-Type", "application/xml")
+        self.write(
+            f"""<?xml version="1.0"?>
+<dwml><data>
+<time-layout><start-valid-time>{today}T06:00:00-04:00</start-valid-time></time-layout>
+<parameters>
+<temperature type="maximum">{"<value>30</value>" * days}</temperature>
+<temperature type="minimum">{"<value>20</value>" * days}</temperature>
+<conditions-icon>{"<icon-link>http://forecast.weather.gov/images/sct.jpg</icon-link>" * days}
+</conditions-icon>
+</parameters>
+</data></dwml>""",
+        )
+
+
+def bind_local_socket() -> tuple[list[socket.socket], str]:
+    """Bind socket on a free local port, return sockets and base URL."""
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    return sockets, f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+
+
+def start_fake_upstream(latency: float, error_rate: float) -> str:
+    """Start fake APIs in the current IOLoop and point the API clients to them.
+
+    :return: base URL of the fake APIs
+    """
+    handler_args = {"latency": latency, "error_rate": error_rate}
+    application = tornado.web.Application(
+        [
+            (r"/token", FakeGoogleTokenHandler, handler_args),
+            (r"/calendar/v3/calendars/([^/]+)/events", FakeGoogleEventsHandler, handler_args),
+            (r"/data/2\.5/forecast", FakeOpenWeatherMapHandler, handler_args),
+            (
+                r"/xml/SOAP_server/ndfdSOAPclientByDay\.php",
+                FakeWeatherGovHandler,
+                handler_args,
+            ),
+        ],
+    )
+    sockets, url = bind_local_socket()
+    tornado.httpserver.HTTPServer(application).add_sockets(sockets)
+    google_calendar.GOOGLE_API_ENDPOINT = f"{url}/calendar/v3/"
+    openweathermap_org.OPENWEATHERMAP_FORECAST_URL = f"{url}/data/2.5/forecast"
+    weather_gov.WEATHER_GOV_URL = f"{url}/xml/SOAP_server/ndfdSOAPclientByDay.php"
+    return url
+
+
+def write_fake_secrets(folder: str, upstream_url: str) -> dict[str, str]:
+    """Write Google service account with new key and OpenWeatherMap key.
+
+    :return: settings params with the secrets file names
+    """
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    credentials_file_name = os.path.join(folder, "fake-google-credentials.json")
+    Path(credentials_file_name).write_text(
+        json.dumps(
+            {
+                "type": "service_account",
+                "project_id": "load-test",
+                "client_email": "load-test@load-test.iam.gserviceaccount.com",
+                "token_uri": f"{upstream_url}/token",
+                "private_key": private_key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.PKCS8,
+                    serialization.NoEncryption(),
+                ).decode("ascii"),
+            },
+        ),
+        encoding="utf-8",
+    )
+    weather_key_file_name = os.path.join(folder, "fake-openweathermap-key.json")
+    Path(weather_key_file_name).write_text(json.dumps({"key": "fake-key"}), encoding="utf-8")
+    return {
+        GOOGLE_CREDENTIALS_PARAM: credentials_file_name,
+        WEATHER_KEY_PARAM: weather_key_file_name,
+    }
+
+
+def percentiles(values: list[float], points: tuple[int, ...] = (50, 95, 99)) -> dict[int, float]:
+    """Percentiles of the values."""
+    if len(values) < 2:  # noqa: PLR2004
+        return dict.fromkeys(points, values[0] if values else 0.0)
+    quantiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {point: quantiles[point - 1] for point in points}
+
+
+def rss_mb(pid: int | str = "self") -> float:
+    """Resident memory of the process from /proc (Linux), 0 if not available."""
+    try:
+        status = Path(f"/proc/{pid}/status").read_text(encoding="utf-8")
+    except OSError:
+        return 0.0
+    for line in status.splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def children_rss_mb() -> float:
+    """Resident memory of the render processes and other children (Linux)."""
+    total = 0.0
+    for stat_path in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # fields after the command name in parentheses: state, ppid, ...
+            ppid = int(stat_path.read_text(encoding="utf-8").rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == os.getpid():
+            total += rss_mb(stat_path.parent.name)
+    return total
+
+
+class LoadTestResults:
+    """Requests latencies and statuses."""
+
+    def __init__(self) -> None:
+        """Init."""
+        self.latencies: list[float] = []
+        self.statuses: CounterDict[int] = CounterDict()
+        self.cache: CounterDict[str] = CounterDict()
+        self.peak_rss_mb = 0.0
+        self.peak_children_rss_mb = 0.0
+
+    def add(self, latency: float, response: tornado.httpclient.HTTPResponse) -> None:
+        """Add the request result."""
+        self.latencies.append(latency)
+        self.statuses[response.code] += 1
+        for metric in response.headers.get("Server-Timing", "").split(","):
+            name, *params = metric.strip().split(";")
+            if name == "cache":
+                self.cache[params[0].removeprefix("desc=").strip('"')] += 1
+
+    def sample_memory(self) -> None:
+        """Update peak memory usage."""
+        self.peak_rss_mb = max(self.peak_rss_mb, rss_mb())
+        self.peak_children_rss_mb = max(self.peak_children_rss_mb, children_rss_mb())
+
+    def report(self, duration: float) -> str:
+        """Text report."""
+        latency_ms = {point: value * 1000 for point, value in percentiles(self.latencies).items()}
+        max_latency_ms = max(self.latencies, default=0) * 1000
+        web_server_rss_mb = max(
+            self.peak_rss_mb,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        )
+        statuses = ", ".join(f"{code}: {count}" for code, count in sorted(self.statuses.items()))
+        cache = ", ".join(f"{status}: {count}" for status, count in sorted(self.cache.items()))
+        throughput = len(self.latencies) / duration
+        return f"""Requests: {len(self.latencies)} in {duration:.1f} s, {throughput:.1f} requests/s
+Statuses: {statuses}
+Cache: {cache}
+Latency ms: p50 {latency_ms[50]:.1f}, p95 {latency_ms[95]:.1f}, p99 {latency_ms[99]:.1f}, \
+max {max_latency_ms:.1f}
+Peak RSS MB: web-server {web_server_rss_mb:.1f}, render processes {self.peak_children_rss_mb:.1f}"""
+
+
+async def kindle_client(
+    url: str,
+    interval: float,
+    deadline: float,
+    results: LoadTestResults,
+) -> None:
+    """Poll the dashboard image until the deadline."""
+    client = tornado.httpclient.AsyncHTTPClient()
+    await asyncio.sleep(random.uniform(0, interval))  # noqa: S311
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        response = await client.fetch(url, raise_error=False, request_timeout=120)
+        results.add(time.monotonic() - start, response)
+        await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+
+async def run_load_test() -> None:
+    """Start the fake APIs and the web-server, run the clients and print report."""
+    upstream_url = start_fake_upstream(options.latency, options.error_rate)
+    secrets_folder = tempfile.mkdtemp(prefix="iot-calendar-load-test-")
+    iot_calendar.settings = {
+        **iot_calendar.load_settings(folder=options.folder, load_secrets=False),
+        **write_fake_secrets(secrets_folder, upstream_url),
+    }
+    renderer = DashboardRenderer(
+        iot_calendar.settings,
+        executor=iot_calendar.create_render_executor(options.render_processes),
+        stale_while_revalidate=options.stale_while_revalidate,
+        max_stale_seconds=options.max_stale,
+        max_renders=options.max_renders,
+        max_queued_renders=options.render_queue,
+    )
+    sockets, server_url = bind_local_socket()
+    tornado.httpserver.HTTPServer(iot_calendar.Application(renderer=renderer)).add_sockets(sockets)
+
+    start = time.monotonic()
+    await renderer.warm_up()
+    print(f"Warm-up: {time.monotonic() - start:.1f} s")
+    if options.prerender_interval > 0:
+        PrerenderScheduler(renderer, options.prerender_interval).start()
+
+    results = LoadTestResults()
+    memory_sampler = tornado.ioloop.PeriodicCallback(results.sample_memory, 1000)
+    memory_sampler.start()
+    # the client queues requests above max_clients, that would add to the latency
+    tornado.httpclient.AsyncHTTPClient.configure(None, max_clients=options.clients)
+    start = time.monotonic()
+    await asyncio.gather(
+        *(
+            kindle_client(
+                f"{server_url}{options.path}",
+                options.interval,
+                start + options.duration,
+                results,
+            )
+            for _ in range(options.clients)
+        ),
+    )
+    memory_sampler.stop()
+    results.sample_memory()
+    print(results.report(time.monotonic() - start))
+
+
+def main() -> None:  # pragma: no cover
+    """Run load test."""
+    define("folder", default=None, help="path to settings, secrets are replaced by fakes", type=str)
+    define("clients", default=10, help="number of Kindle clients", type=int)
+    define("interval", default=5, help="seconds between requests of each client", type=float)
+    define("duration", default=30, help="seconds to run clients", type=float)
+    define("path", default=KINDLE_PATH, help="image to request", type=str)
+    define("latency", default=0.1, help="seconds, average latency of fake APIs", type=float)
+    define("error_rate", default=0.0, help="fraction of failed fake APIs requests", type=float)
+    define("render_processes", default=1, help="0 to render in the web-server process", type=int)
+    define("prerender_interval", default=60, help="0 to render on request", type=float)
+    define("stale_while_revalidate", default=False, help="see iot_calendar.py", type=bool)
+    define("max_stale", default=MAX_STALE_SECONDS, help="see iot_calendar.py", type=float)
+    define("max_renders", default=MAX_RENDERS, help="see iot_calendar.py", type=int)
+    define("render_queue", default=MAX_QUEUED_RENDERS, help="see iot_calendar.py", type=int)
+    options.logging = "warning"  # do not log each request
+    tornado.options.parse_command_line()
+
+    asyncio.run(run_load_test())
+
+
+if __name__ == "__main__":  # pragma: no cover
+    main()
@@ -0,0 +1,248 @@
+"""Web-server metrics in Prometheus text format.
+
+Usage
+    timer = StageTimer()
+    with timer.stage("collect_events"):
+        ...
+    STAGE_SECONDS.observe_all(timer.durations)
+
+    exposition()  # text for the /metrics page
+
+Metrics are per process, so with several web-server workers each of them
+reports its own numbers.
+Durations of the stages inside render processes are collected by `run_timed`
+and returned with the result.
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+from collections.abc import Callable, Iterator
+from typing import Any, TypeVar
+
+from cached_decorator import cached
+
+T = TypeVar("T")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelsType = tuple[tuple[str, str], ...]
+
+
+def format_labels(labels: LabelsType) -> str:
+    """Prometheus labels, like `{stage="draw"}`."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels."""
+
+    def __init__(self, name: str, description: str) -> None:
+        """Init."""
+        self.name = name
+        self.description = description
+        self.values: dict[LabelsType, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the counter."""
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def exposition(self) -> list[str]:
+        """Lines in Prometheus text format, of the values snapshot taken under the lock."""
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(labels)} {value}" for labels, value in values)
+        return lines
+
+
+class Histogram:
+    """Histogram with labels and fixed buckets."""
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Init."""
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        # counts per bucket (not cumulative) plus +Inf, and sum of observed values
+        self.counts: dict[LabelsType, list[int]] = {}
+        self.sums: dict[LabelsType, float] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Add the value."""
+        key = tuple(sorted(labels.items()))
+        bucket = next(
+            (idx for idx, bound in enumerate(self.buckets) if value <= bound),
+            len(self.buckets),
+        )
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bucket] += 1
+            self.sums[key] = self.sums.get(key, 0) + value
+
+    def observe_all(self, durations: dict[str, float], label: str = "stage") -> None:
+        """Add values labeled by the dict keys."""
+        for name, value in durations.items():
+            self.observe(value, **{label: name})
+
+    def exposition(self) -> list[str]:
+        """Lines in Prometheus text format, of the values snapshot taken under the lock."""
+        with self.lock:
+            histograms = sorted((labels, list(counts)) for labels, counts in self.counts.items())
+            sums = dict(self.sums)
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, counts in histograms:
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts, strict=True):
+                total += count
+                bucket_labels = format_labels((*labels, ("le", str(bound))))
+                lines.append(f"{self.name}_bucket{bucket_labels} {total}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {sums[labels]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {total}")
+        return lines
+
+
+class StageTimer:
+    """Durations of the pipeline stages for one image."""
+
+    def __init__(self) -> None:
+        """Init."""
+        self.durations: dict[str, float] = {}
+        # how the image was obtained: hit, stale, miss, unchanged, coalesced or shed
+        self.cache = ""
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Add the block duration to the stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+
+
+current_timer: contextvars.ContextVar[StageTimer | None] = contextvars.ContextVar(
+    "current_timer",
+    default=None,
+)
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Add the block duration to the stage of the `run_timed` call, if any."""
+    timer = current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def run_timed(func: Callable[..., T], *args: Any) -> tuple[T, dict[str, float]]:
+    """Call the function and return its result with durations of its stages.
+
+    Can run in other process, `stage` blocks inside the function report to the returned durations.
+    """
+    timer = StageTimer()
+    token = current_timer.set(timer)
+    try:
+        return func(*args), timer.durations
+    finally:
+        current_timer.reset(token)
+
+
+STAGE_SECONDS = Histogram(
+    "iot_calendar_stage_seconds",
+    "Duration of the dashboard image pipeline stages",
+)
+RENDERS = Counter(
+    "iot_calendar_renders_total",
+    "Dashboard images renders by result: rendered, unchanged inputs or error",
+)
+SHED_REQUESTS = Counter(
+    "iot_calendar_shed_requests_total",
+    "Image requests with full render queue by result: stale image or unavailable",
+)
+UPSTREAM_REQUESTS = Counter(
+    "iot_calendar_upstream_requests_total",
+    "Requests to Google calendar and weather APIs",
+)
+UPSTREAM_ERRORS = Counter(
+    "iot_calendar_upstream_errors_total",
+    "Failed requests to Google calendar and weather APIs",
+)
+
+
+@contextlib.contextmanager
+def upstream_request(service: str) -> Iterator[None]:
+    """Count the request to the API, and count it as error if the block raises exception."""
+    UPSTREAM_REQUESTS.inc(service=service)
+    try:
+        yield
+    except Exception:
+        UPSTREAM_ERRORS.inc(service=service)
+        raise
+
+
+SERVER_TIMING_METRICS = {  # Server-Timing metric: (stages summed up, description)
+    "queue": (("queue",), "Waiting in render queue"),
+    "fetch": (("fetch",), "Google calendar and weather"),
+    "prepare": (("settings", "events_to_grid"), "Data preparation"),
+    "draw": (("draw",), "Matplotlib drawing"),
+    "encode": (("encode",), "Image encoding"),
+}
+
+
+def server_timing(timer: StageTimer) -> str:
+    """Value for the Server-Timing header, durations in milliseconds.
+
+    Stages that did not run for the request (e.g. image from cache) are omitted.
+    """
+    metrics = []
+    for metric, (stages, description) in SERVER_TIMING_METRICS.items():
+        durations = [timer.durations[name] for name in stages if name in timer.durations]
+        if durations:
+            metrics.append(f'{metric};dur={sum(durations) * 1000:.1f};desc="{description}"')
+    if timer.cache:
+        metrics.append(f'cache;desc="{timer.cache}"')
+    return ", ".join(metrics)
+
+
+def cache_exposition() -> list[str]:
+    """Hits and misses of the functions with `cached` decorator."""
+    name = "iot_calendar_cache_requests_total"
+    lines = [
+        f"# HELP {name} Calls of functions with cached decorator by result: hit or miss",
+        f"# TYPE {name} counter",
+    ]
+    totals: dict[tuple[str, str], int] = {}
+    for instance in list(cached.instances):
+        if instance.name:
+            for result, value in (("hit", instance.hits), ("miss", instance.misses)):
+                key = (instance.name, result)
+                totals[key] = totals.get(key, 0) + value
+    for (function, result), value in sorted(totals.items()):
+        labels = format_labels((("function", function), ("result", result)))
+        lines.append(f"{name}{labels} {value}")
+    return lines
+
+
+def exposition() -> str:
+    """All metrics in Prometheus text format."""
+    lines = []
+    for metric in (STAGE_SECONDS, RENDERS, SHED_REQUESTS, UPSTREAM_REQUESTS, UPSTREAM_ERRORS):
+        lines.extend(metric.exposition())
+    lines.extend(cache_exposition())
+    return "\n".join(lines) + "\n"
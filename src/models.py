@@ -18,3 +18,13 @@ class WeatherLabel(BaseModel):
 
     summary: str = Field(..., description="The summary of the weather")
     image: str = Field(..., description="The full path to the image to display on the plot")
+
+
+class RenderedImage(BaseModel):
+    """Dashboard image rendered by `calendar_image.draw_calendar`."""
+
+    data: bytes = Field(..., description="Image in the requested format (png, gif etc)")
+    etag: str = Field(..., description="Strong HTTP entity tag, hash of the `data`")
+    inputs_hash: str = Field(..., description="Hash of the data the image was rendered from")
+    rendered_at: datetime
+    checked_at: datetime = Field(..., description="Last time the inputs were found unchanged")
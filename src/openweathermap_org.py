@@ -13,10 +13,12 @@ from typing import Any
 import requests
 
 from cached_decorator import cached
+from metrics import UPSTREAM_ERRORS, upstream_request
 from models import WeatherData
 
 WEATHER_KEY_PARAM = "openweathermap_key_file_name"
 MIN_API_CALL_DELAY_SECONDS = 60 * 10
+OPENWEATHERMAP_FORECAST_URL = "http://api.openweathermap.org/data/2.5/forecast"
 
 
 class Weather:
@@ -119,16 +121,18 @@ class Weather:
             "lon": longitude,
             "appid": self.key,
         }
-        weather_response = requests.get(
-            "http://api.openweathermap.org/data/2.5/forecast",
-            params=params,
-            timeout=10,
-        )
+        with upstream_request("openweathermap"):
+            weather_response = requests.get(
+                OPENWEATHERMAP_FORECAST_URL,
+                params=params,
+                timeout=10,
+            )
 
         print("Got weather from openweathermap.org:", weather_response.text[:100])
         weather_data = weather_response.json()
 
         if str(weather_data["cod"]) != "200":
+            UPSTREAM_ERRORS.inc(service="openweathermap")
             if str(weather_data["cod"]) == "401" and weather_data["message"].startswith(
                 "Invalid API key",
             ):
@@ -0,0 +1,229 @@
+"""Draw the weeks grid pies and cell images with numpy into the rendered figure pixels.
+
+Faster alternative to matplotlib `pie()` and `imshow()` for the weeks grid:
+instead of wedge patches, all wedges of a pie are masks from the polar angle and
+distance of the pixels, and the cell images are sprites of `SpriteAtlas`
+blended into the pixels without interpolation.
+
+Usage
+    raster = PiesRaster()
+    raster.add_pie(...)  # in the matplotlib style, it defines the pie colors
+    raster.add_image(...)
+    canvas.draw()
+    raster.draw(axes, np.asarray(canvas.buffer_rgba()), sprites)
+"""
+
+import math
+from typing import Any, NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+from matplotlib.axes import Axes
+from matplotlib.colors import to_rgba_array
+from matplotlib.transforms import Bbox
+
+from sprite_atlas import Extent, PixelBox, SpriteAtlas, pixel_box
+
+
+class Pie(NamedTuple):
+    """Pie in the axes data coordinates."""
+
+    center: tuple[float, float]
+    radius: float
+    values: list[float]
+    colors: npt.NDArray[np.float64]  # RGBA 0..1 for each value
+    explode: float  # shift of the wedges from the center
+
+
+class CellImage(NamedTuple):
+    """Image in the axes data coordinates."""
+
+    file_name: str
+    image: npt.NDArray[Any]
+    extent: Extent
+
+
+class PiesRaster:
+    """Pies and images to draw over the pixels of the rendered figure.
+
+    Same geometry as matplotlib `pie()` with `startangle=0` and `counterclock=True`.
+    """
+
+    def __init__(self) -> None:
+        """Init."""
+        self.pies: list[Pie] = []
+        self.images: list[CellImage] = []
+
+    def add_pie(  # noqa: PLR0913
+        self,
+        center: tuple[float, float],
+        radius: float,
+        values: list[float],
+        colors: list[str],
+        explode: float,
+    ) -> None:
+        """Add pie, matplotlib colors like "C0" are converted in the current style."""
+        self.pies.append(Pie(center, radius, values, to_rgba_array(colors), explode))
+
+    def add_image(self, file_name: str, image: npt.NDArray[Any], extent: Extent) -> None:
+        """Add image loaded from the file."""
+        self.images.append(CellImage(file_name, image, extent))
+
+    def draw(
+        self,
+        axes: Axes,
+        pixels: npt.NDArray[np.uint8],
+        sprites: SpriteAtlas,
+        *,
+        regions: list[Bbox] | None = None,
+    ) -> None:
+        """Draw over the pixels of the figure after the canvas was drawn.
+
+        :param axes: axes of the data coordinates, after drawing it has the final position
+        :param pixels: RGBA figure pixels [row][column], rows from the top
+        :param sprites: resized images
+        :param regions: in display coordinates, draw only pies and images overlapping them
+        """
+        for image in self.images:
+            box = pixel_box(axes, image.extent)
+            if box[2] > 0 and box[3] > 0 and overlaps(Bbox.from_bounds(*box), regions):
+                sprite = sprites.sprite(image.file_name, image.image, (box[2], box[3]))
+                draw_image(pixels, sprite, box)
+        for pie in self.pies:
+            center = to_display(axes, *pie.center)
+            scale = to_display(axes, pie.center[0] + 1, pie.center[1])[0] - center[0]
+            reach = (pie.radius + pie.explode) * scale + 1
+            if not overlaps(
+                Bbox.from_extents(
+                    center[0] - reach,
+                    center[1] - reach,
+                    center[0] + reach,
+                    center[1] + reach,
+                ),
+                regions,
+            ):
+                continue
+            draw_pie(
+                pixels,
+                center,
+                pie.radius * scale,
+                np.array(pie.values, dtype=np.float64),
+                pie.colors,
+                explode=pie.explode * scale,
+            )
+
+
+def overlaps(bbox: Bbox, regions: list[Bbox] | None) -> bool:
+    """If the bbox overlaps any of the regions, all regions by default."""
+    return regions is None or any(
+        bbox.x0 < region.x1 and region.x0 < bbox.x1 and bbox.y0 < region.y1 and region.y0 < bbox.y1
+        for region in regions
+    )
+
+
+def to_display(axes: Axes, x: float, y: float) -> tuple[float, float]:
+    """Data coordinates to figure pixels, from the bottom left corner."""
+    display_x, display_y = axes.transData.transform((x, y))
+    return float(display_x), float(display_y)
+
+
+def pixel_centers(
+    height: int,
+    rows: tuple[int, int],
+    columns: tuple[int, int],
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.float64]]:
+    """Display coordinates (x[1][columns], y[rows][1]) of the pixels centers."""
+    x = np.arange(*columns, dtype=np.float64)[np.newaxis, :] + 0.5
+    y = height - (np.arange(*rows, dtype=np.float64)[:, np.newaxis] + 0.5)
+    return x, y
+
+
+def draw_pie(  # noqa: PLR0913
+    pixels: npt.NDArray[np.uint8],
+    center: tuple[float, float],
+    radius: float,
+    values: npt.NDArray[np.float64],
+    colors: npt.NDArray[np.float64],
+    *,
+    explode: float,
+) -> None:
+    """Draw antialiased pie wedges, all wedges of the pie are computed at once.
+
+    The coverage of a pixel by a wedge is its distance to the nearest wedge edge
+    (arc or radius), so the edge pixels are blended with the background.
+
+    :param pixels: RGBA figure pixels [row][column], rows from the top
+    :param center: pie center in display coordinates
+    :param radius: radius in pixels
+    :param values: wedges sizes
+    :param colors: RGBA 0..1 of the wedges
+    :param explode: shift of each wedge from the center along its middle angle, in pixels
+    """
+    height, width = pixels.shape[:2]
+    reach = radius + explode + 1
+    columns = (max(int(center[0] - reach), 0), min(int(center[0] + reach) + 1, width))
+    top = height - center[1]  # center row
+    rows = (max(int(top - reach), 0), min(int(top + reach) + 1, height))
+    if columns[0] >= columns[1] or rows[0] >= rows[1]:
+        return
+    x, y = pixel_centers(height, rows, columns)
+
+    drawn = values > 0  # zero wedges are not visible
+    values, colors = values[drawn], colors[drawn]
+    fractions = values / values.sum()
+    ends = np.cumsum(fractions) * 2 * math.pi
+    starts = ends - fractions * 2 * math.pi
+    spans = ends - starts
+    middles = (starts + ends) / 2
+    # [wedge][row][column]
+    dx = x - (center[0] + explode * np.cos(middles))[:, np.newaxis, np.newaxis]
+    dy = y - (center[1] + explode * np.sin(middles))[:, np.newaxis, np.newaxis]
+    distance = np.hypot(dx, dy)
+    angle = np.arctan2(dy, dx) % (2 * math.pi)
+    from_start = (angle - starts[:, np.newaxis, np.newaxis]) % (2 * math.pi)
+    spans = spans[:, np.newaxis, np.newaxis]
+    angle_inside = np.where(
+        from_start <= spans,
+        np.minimum(from_start, spans - from_start),
+        -np.minimum(from_start - spans, 2 * math.pi - from_start),
+    )
+    to_radius_edge = np.where(
+        spans >= 2 * math.pi - 1e-9,  # full circle has no radius edges
+        np.inf,
+        distance * np.sin(np.clip(angle_inside, -math.pi / 2, math.pi / 2)),
+    )
+    coverage = np.clip(np.minimum(radius - distance, to_radius_edge) + 0.5, 0, 1)
+
+    region = pixels[rows[0] : rows[1], columns[0] : columns[1]].astype(np.float64) / 255
+    for wedge_coverage, color in zip(coverage, colors, strict=True):
+        alpha = (wedge_coverage * color[3])[..., np.newaxis]
+        region[..., :3] = region[..., :3] * (1 - alpha) + color[:3] * alpha
+        region[..., 3:] = region[..., 3:] * (1 - alpha) + alpha
+    pixels[rows[0] : rows[1], columns[0] : columns[1]] = np.rint(region * 255).astype(np.uint8)
+
+
+def draw_image(
+    pixels: npt.NDArray[np.uint8],
+    sprite: npt.NDArray[np.uint8],
+    box: PixelBox,
+) -> None:
+    """Blend the RGBA sprite of the box size into the pixels."""
+    height, width = pixels.shape[:2]
+    left, bottom, sprite_width, sprite_height = box
+    top = height - bottom - sprite_height  # row of the sprite top
+    # the sprite part inside the figure
+    rows = (max(top, 0), min(top + sprite_height, height))
+    columns = (max(left, 0), min(left + sprite_width, width))
+    if rows[0] >= rows[1] or columns[0] >= columns[1]:
+        return
+    visible = (
+        sprite[rows[0] - top : rows[1] - top, columns[0] - left : columns[1] - left].astype(
+            np.float32,
+        )
+        / 255
+    )
+    region = pixels[rows[0] : rows[1], columns[0] : columns[1]].astype(np.float32) / 255
+    alpha = visible[..., 3:]
+    region[..., :3] = region[..., :3] * (1 - alpha) + visible[..., :3] * alpha
+    region[..., 3:] = region[..., 3:] * (1 - alpha) + alpha
+    pixels[rows[0] : rows[1], columns[0] : columns[1]] = np.rint(region * 255).astype(np.uint8)
@@ -0,0 +1,138 @@
+"""Opt-in profiling of the dashboard render stages.
+
+Set the environment variable `IOT_CALENDAR_PROFILE` to a folder (the server option
+`--profile_dir` does that), and each render writes to the folder
+- `<render>-<stage>.prof` for each stage: cProfile stats, for `python -m pstats` or snakeviz
+- `<render>.collapsed`: collapsed stacks of all stages for flamegraph.pl or speedscope
+
+`<render>` is the render time and the process id, so renders in several processes
+do not overwrite the files of each other.
+Without the variable the stages run as is.
+
+Usage
+    with profile_render():
+        with profiled("plot"):
+            ...
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import os
+import pstats
+from collections.abc import Iterator
+from datetime import datetime
+from pathlib import Path
+
+PROFILE_DIR_ENV = "IOT_CALENDAR_PROFILE"
+MIN_STACK_SECONDS = 1e-5  # less time is not split further among the callees
+
+# (file name, line, function name) like in `pstats.Stats.stats`
+Func = tuple[str, int, str]
+
+
+class RenderProfile:
+    """cProfile of each stage of one render."""
+
+    def __init__(self, folder: Path, name: str) -> None:
+        """Init.
+
+        :param folder: for the profile files
+        :param name: prefix of the files names
+        """
+        self.folder = folder
+        self.name = name
+        self.stages: dict[str, list[cProfile.Profile]] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Profile the block, profiles of the same stage are summed up."""
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.stages.setdefault(name, []).append(profile)
+
+    def save(self) -> None:
+        """Write the profiles files."""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        lines = []
+        for name, profiles in self.stages.items():
+            stats = pstats.Stats(*profiles)  # type: ignore[arg-type]
+            stats.dump_stats(self.folder / f"{self.name}-{name}.prof")
+            for stack, seconds in collapsed_stacks(stats).items():
+                microseconds = round(seconds * 1e6)
+                if microseconds > 0:
+                    lines.append(f"{name};{stack} {microseconds}\n")
+        (self.folder / f"{self.name}.collapsed").write_text("".join(lines), encoding="utf-8")
+
+
+current_profile: contextvars.ContextVar[RenderProfile | None] = contextvars.ContextVar(
+    "current_profile",
+    default=None,
+)
+
+
+@contextlib.contextmanager
+def profile_render() -> Iterator[None]:
+    """Profile the `profiled` stages of the block if `IOT_CALENDAR_PROFILE` is set."""
+    folder = os.environ.get(PROFILE_DIR_ENV)
+    if not folder or current_profile.get() is not None:
+        yield
+        return
+    profile = RenderProfile(Path(folder), f"{datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}")
+    token = current_profile.set(profile)
+    try:
+        yield
+    finally:
+        current_profile.reset(token)
+        profile.save()
+
+
+@contextlib.contextmanager
+def profiled(name: str) -> Iterator[None]:
+    """Profile the block as the stage of the `profile_render` call, if any."""
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.stage(name):
+        yield
+
+
+def func_label(func: Func) -> str:
+    """Frame name in the collapsed stacks, like `draw (figure.py:3154)`."""
+    file_name, line, name = func
+    label = name if file_name == "~" else f"{name} ({Path(file_name).name}:{line})"
+    return label.replace(";", ",")  # frames separator
+
+
+def collapsed_stacks(stats: pstats.Stats) -> dict[str, float]:
+    """Self seconds of the call stacks, estimated from the cProfile call graph.
+
+    cProfile keeps callers of each function but not whole stacks, so the time of a function
+    in a stack is split among its callees in proportion to the time of each call edge.
+    Recursive calls are not followed.
+    """
+    entries = stats.stats  # type: ignore[attr-defined]
+    callees: dict[Func, list[tuple[Func, float]]] = {}
+    for func, entry in entries.items():
+        for caller, edge in entry[4].items():  # callers with the calls stats of the edge
+            callees.setdefault(caller, []).append((func, edge[3]))
+    stacks: dict[str, float] = {}
+
+    def walk(func: Func, path: str, seconds: float, seen: frozenset[Func]) -> None:
+        _, _, self_seconds, cumulative_seconds, _ = entries[func]
+        share = seconds / cumulative_seconds if cumulative_seconds > 0 else 0
+        stack = f"{path};{func_label(func)}" if path else func_label(func)
+        stacks[stack] = stacks.get(stack, 0) + self_seconds * share
+        for callee, edge_seconds in callees.get(func, []):
+            if callee not in seen and edge_seconds * share >= MIN_STACK_SECONDS:
+                walk(callee, stack, edge_seconds * share, seen | {callee})
+
+    for func, (*_, cumulative_seconds, callers) in entries.items():
+        if not callers:
+            walk(func, "", cumulative_seconds, frozenset((func,)))
+    return stacks
@@ -0,0 +1,148 @@
+"""Icons resized once to their size in pixels on the dashboard figure.
+
+Images of the weeks grid cells, plot labels and weather are drawn in rectangles
+of fixed size, so each icon is resampled to the rectangle size in pixels only once.
+On each render the resized icon is placed on whole pixels and drawn without interpolation.
+If the figure is drawn in other size or dpi, the icons are placed again with `snap()`.
+"""
+
+import weakref
+from collections.abc import Iterable
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+import PIL.Image
+from matplotlib.axes import Axes
+from matplotlib.figure import Figure
+from matplotlib.image import AxesImage
+
+# left, right, bottom, top in the axes data coordinates, like `extent` of `imshow()`
+Extent = tuple[float, float, float, float]
+# left, bottom, width, height in the figure pixels from the bottom left corner
+PixelBox = tuple[int, int, int, int]
+# file name, image, extent
+Icon = tuple[str, npt.NDArray[Any], Extent]
+
+
+def pixel_box(ax: Axes, extent: Extent) -> PixelBox:
+    """Whole pixels rectangle for the extent.
+
+    The size is rounded independently of the position,
+    so rectangles of the same size get the same icon size.
+    """
+    ax.apply_aspect()
+    (left, bottom), (right, top) = ax.transData.transform(
+        [(extent[0], extent[2]), (extent[1], extent[3])],
+    )
+    return round(left), round(bottom), round(right - left), round(top - bottom)
+
+
+def to_rgba(image: npt.NDArray[Any]) -> PIL.Image.Image:
+    """PIL RGBA image from the matplotlib image array."""
+    if image.dtype != np.uint8:  # matplotlib reads PNG as float 0..1
+        image = np.rint(np.clip(image, 0, 1) * 255).astype(np.uint8)
+    return PIL.Image.fromarray(image).convert("RGBA")
+
+
+def blend_over(dest: npt.NDArray[np.uint8], src: npt.NDArray[np.uint8]) -> None:
+    """Alpha compose RGBA src over dest of the same size, in place.
+
+    Colors are not premultiplied, so over a transparent dest the result is src.
+    """
+    src_alpha = src[..., 3:].astype(np.float32) / 255
+    dest_alpha = dest[..., 3:].astype(np.float32) / 255 * (1 - src_alpha)
+    alpha = src_alpha + dest_alpha
+    rgb = (src[..., :3] * src_alpha + dest[..., :3] * dest_alpha) / np.where(alpha > 0, alpha, 1)
+    dest[..., :3] = np.rint(rgb)
+    dest[..., 3:] = np.rint(alpha * 255)
+
+
+class SpriteAtlas:
+    """Icons resized to their sizes in pixels, by file name and size.
+
+    Sizes depend on the figure layout, so the atlas belongs to the figure.
+    """
+
+    def __init__(self) -> None:
+        """Init."""
+        self.sprites: dict[tuple[str, int, int], npt.NDArray[np.uint8]] = {}
+        # icons of the images drawn by the atlas, to fit them to other figure size
+        self.placed: weakref.WeakKeyDictionary[AxesImage, list[Icon]] = weakref.WeakKeyDictionary()
+
+    def sprite(
+        self,
+        file_name: str,
+        image: npt.NDArray[Any],
+        size: tuple[int, int],
+    ) -> npt.NDArray[np.uint8]:
+        """RGBA icon of the size (width, height), the image is resized on the first call."""
+        key = (file_name, *size)
+        if key not in self.sprites:
+            resized = to_rgba(image).resize(size, PIL.Image.Resampling.LANCZOS)
+            self.sprites[key] = np.asarray(resized)
+        return self.sprites[key]
+
+    def build(
+        self,
+        ax: Axes,
+        extent: Extent,
+        images: Iterable[tuple[str, npt.NDArray[Any]]],
+    ) -> None:
+        """Resize the images (file name, image) for the extent in the axes."""
+        ax.set_aspect("equal")  # like imshow()
+        _, _, width, height = pixel_box(ax, extent)
+        if width > 0 and height > 0:
+            for file_name, image in images:
+                self.sprite(file_name, image, (width, height))
+
+    def imshow(
+        self,
+        ax: Axes,
+        file_name: str,
+        image: npt.NDArray[Any],
+        extent: Extent,
+    ) -> None:
+        """Like `imshow()` but with the resized icon on whole pixels, without interpolation."""
+        self.overlay(ax, [(file_name, image, extent)])
+
+    def overlay(self, ax: Axes, icons: Iterable[Icon]) -> None:
+        """Like `imshow()` of each icon, but the icons are blended into one image.
+
+        So the axes get one image for any number of icons.
+        """
+        icons = list(icons)
+        ax.set_aspect("equal")  # imshow() does that, and it changes the axes size in pixels
+        layer = self.layer(ax, icons)
+        if layer is not None:
+            self.placed[ax.imshow(layer[0], extent=layer[1], interpolation="none")] = icons
+
+    def layer(self, ax: Axes, icons: list[Icon]) -> tuple[npt.NDArray[np.uint8], Extent] | None:
+        """Icons blended into one RGBA image on whole pixels, with its extent in the axes."""
+        sprites = []
+        for file_name, image, extent in icons:
+            box = pixel_box(ax, extent)
+            if box[2] > 0 and box[3] > 0:
+                sprites.append((box, self.sprite(file_name, image, (box[2], box[3]))))
+        if not sprites:
+            return None
+        left = min(box[0] for box, _ in sprites)
+        bottom = min(box[1] for box, _ in sprites)
+        right = max(box[0] + box[2] for box, _ in sprites)
+        top = max(box[1] + box[3] for box, _ in sprites)
+        layer = np.zeros((top - bottom, right - left, 4), dtype=np.uint8)
+        for (sprite_left, sprite_bottom, width, height), sprite in sprites:
+            row = top - sprite_bottom - height  # rows from the top
+            column = sprite_left - left
+            blend_over(layer[row : row + height, column : column + width], sprite)
+        (x0, y0), (x1, y1) = ax.transData.inverted().transform([(left, bottom), (right, top)])
+        return layer, (x0, x1, y0, y1)
+
+    def snap(self, figure: Figure) -> None:
+        """Fit the icons in the figure to its pixels after the figure size or dpi changed."""
+        for ax in figure.axes:
+            for axes_image in ax.images:
+                icons = self.placed.get(axes_image)
+                if icons is not None and (layer := self.layer(ax, icons)) is not None:
+                    axes_image.set_data(layer[0])
+                    axes_image.set_extent(layer[1])
@@ -0,0 +1,86 @@
+"""matplotlib rcParams of the dashboard styles, resolved once for each (style, xkcd).
+
+`matplotlib.style.context(style, after_reset=True)` and `plt.xkcd()` reset rcParams
+to defaults, read the style and validate all the values on each call.
+Fonts of xkcd are looked up by the family list for each text drawn, and the families
+that are not installed are searched again and again (failed lookups are not cached).
+
+The registry prepares the rcParams of a style once, with only installed font families,
+and each render just applies them.
+
+rcParams are global for the process so use the registry under the lock of the styles.
+
+Usage
+    with STYLES.context("grayscale", xkcd=True):
+        ...  # create and draw artists
+"""
+
+import contextlib
+from collections.abc import Iterator
+from typing import Any
+
+import matplotlib
+import matplotlib.pyplot as plt  # only for xkcd() rcParams
+import matplotlib.style
+from matplotlib.font_manager import FontProperties, fontManager
+from matplotlib.typing import RcKeyType
+
+GENERIC_FAMILIES = {"serif", "sans-serif", "sans serif", "sans", "cursive", "fantasy", "monospace"}
+
+
+def installed_families(families: list[str]) -> list[str]:
+    """Families that have fonts, generic families are resolved by matplotlib itself.
+
+    If there is no font, the list has the matplotlib default family,
+    the same font that matplotlib falls back to.
+    """
+    installed = []
+    for family in families:
+        if family.lower() in GENERIC_FAMILIES:
+            installed.append(family)
+            continue
+        try:
+            fontManager.findfont(FontProperties(family=family), fallback_to_default=False)
+        except ValueError:
+            continue
+        installed.append(family)
+    return installed or [fontManager.defaultFamily["ttf"]]
+
+
+def resolve_style(style: str, xkcd: bool) -> dict[RcKeyType, Any]:
+    """rcParams of the style on top of the defaults, with installed font families only."""
+    with matplotlib.style.context(style, after_reset=True):  # type: ignore[union-attr]
+        if xkcd:
+            plt.xkcd()  # reverted by the style context
+        rc = dict(matplotlib.rcParams.copy())
+    del rc["backend"]  # like `matplotlib.rc_context()`, do not switch backend
+    rc["font.family"] = installed_families(rc["font.family"])
+    return rc
+
+
+class StyleRegistry:
+    """rcParams by (style, xkcd)."""
+
+    def __init__(self) -> None:
+        """Init."""
+        self.styles: dict[tuple[str, bool], dict[RcKeyType, Any]] = {}
+
+    def rc(self, style: str, xkcd: bool) -> dict[RcKeyType, Any]:
+        """rcParams of the style, resolved on the first call."""
+        key = (style, xkcd)
+        if key not in self.styles:
+            self.styles[key] = resolve_style(style, xkcd)
+        return self.styles[key]
+
+    @contextlib.contextmanager
+    def context(self, style: str, xkcd: bool) -> Iterator[None]:
+        """Use the style, previous rcParams are restored on exit."""
+        with matplotlib.rc_context(self.rc(style, xkcd)):
+            yield
+
+    def clear(self) -> None:
+        """Forget resolved styles, for example after new fonts are installed."""
+        self.styles.clear()
+
+
+STYLES = StyleRegistry()
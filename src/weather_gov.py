@@ -12,8 +12,11 @@ from xml.dom import minidom
 from xml.dom.minicompat import NodeList
 from xml.dom.minidom import Document, Element
 
+from metrics import UPSTREAM_ERRORS, upstream_request
 from models import WeatherData
 
+WEATHER_GOV_URL = "http://graphical.weather.gov/xml/SOAP_server/ndfdSOAPclientByDay.php"
+
 
 class InvalidXMLDataError(Exception):
     """Invalid XML data."""
@@ -35,14 +38,15 @@ class Weather:
         """
         try:
             url = (
-                f"http://graphical.weather.gov/xml/SOAP_server/ndfdSOAPclientByDay.php?"
+                f"{WEATHER_GOV_URL}?"
                 f"whichClient=NDFDgenByDay&lat={latitude}&lon={longitude}"
                 f"&format=24+hourly&numDays={days}&Unit={units}"
             )
-            with urlopen(url) as response:  # noqa: S310
+            with upstream_request("weather_gov"), urlopen(url) as response:  # noqa: S310
                 weather_xml = response.read()
             dom = minidom.parseString(weather_xml)  # noqa: S318
             if error := dom.getElementsByTagName("error"):
+                UPSTREAM_ERRORS.inc(service="weather_gov")
                 print(
                     f"Error getting weather from weather.gov: "
                     f"{error}\n{dom.toprettyxml(indent='  ')}",
@@ -6,7 +6,7 @@ from dateutil.tz import tzoffset
 
 # Assuming calendar_data.py includes preprocess_actions function
 from calendar_data import dashboard_absent_events_list, preprocess_actions
-from iot_calendar import calendar_events_list, events_to_array, events_to_weeks_grid
+from calendar_data import calendar_events_list, events_to_array, events_to_weeks_grid
 
 
 def test_preprocess_actions(button_settings):
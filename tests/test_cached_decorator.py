@@ -1,3 +1,4 @@
+import pickle
 import sys
 import time
 from io import BytesIO, TextIOWrapper
@@ -278,3 +279,42 @@ def test_cache_none():
     # Call func2 again with x=0, the result should be cached because cache_none is True
     assert func2(0) is None
     assert counter[0] == 3
+
+
+@cached(seconds=0.1)
+def module_level_cached(x):
+    return x * 2
+
+
+def test_cached_function_is_picklable():
+    # process pool executors pickle functions by reference
+    assert module_level_cached.__name__ == "module_level_cached"
+    assert pickle.loads(pickle.dumps(module_level_cached)) is module_level_cached
+
+
+def test_clear_all_caches():
+    calls = []
+
+    @cached(seconds=10)
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    assert double(2) == 4
+    assert double(2) == 4
+    cached.clear_all_caches()
+    assert double(2) == 4
+    assert calls == [2, 2]
+
+
+def test_hits_and_misses():
+    @cached(seconds=10)
+    def double(x):
+        return x * 2
+
+    double(1)
+    double(1)
+    double(2)
+
+    instance = next(instance for instance in cached.instances if instance.func is double)
+    assert (instance.hits, instance.misses) == (1, 2)
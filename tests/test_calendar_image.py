@@ -1,13 +1,35 @@
+import copy
+import io
+import json
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock, Mock, call, patch
 
+import numpy as np
+import PIL.Image
 import pytest
+from dateutil import parser
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties
+from matplotlib.axes import Axes
+from matplotlib.textpath import TextToPath
+from matplotlib.transforms import Bbox
 
 import calendar_image
 from calendar_image import (
+    build_sprites,
+    cell_image_extent,
+    DashboardFigure,
+    DEVICES,
+    ENCODER_PROFILES,
+    FigurePool,
     ImageLoader,
+    ImageParams,
+    create_image,
     draw_calendar,
+    draw_calendar_encodings,
     draw_day_headers,
     draw_empty_pie,
     draw_pie,
@@ -15,16 +37,21 @@ from calendar_image import (
     draw_plot,
     draw_weather,
     draw_week_headers,
+    encode_image,
     highlight_today,
     pie_col_header_height,
     pie_height,
     pie_row_header_width,
     pie_scale,
     pie_width,
+    regions_mask,
+    TextPathCache,
     WEEKS,
     width_aspect,
 )
+from eink import EINK_MODES, EINK_ORDERED, to_eink
 from models import WeatherData, WeatherLabel
+from render_profiler import PROFILE_DIR_ENV
 
 
 @pytest.mark.parametrize(
@@ -48,19 +75,42 @@ def test_draw_day_headers(input_grid):
         call(
             (pie_row_header_width + (day + 0.5) * pie_width) * width_aspect,
             WEEKS * pie_height + 0.5 * pie_col_header_height,
-            day_name,
+            "",
             horizontalalignment="center",
             verticalalignment="center",
             fontsize=12,
         )
-        for day, day_name in enumerate(
-            ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-        )
+        for day in range(7)
     ]
+    ax = MagicMock()
+
+    headers = draw_day_headers(ax, input_grid)
+
+    ax.text.assert_has_calls(expected_calls, any_order=False)
+    assert len(headers) == 7
+    headers[0].set_text.assert_called_with("Sunday")  # the same mock for all calls
 
-    with patch("matplotlib.pyplot.text") as mock_text:
-        draw_day_headers(input_grid)
-        mock_text.assert_has_calls(expected_calls, any_order=False)
+
+def test_draw_day_headers_update():
+    grid = [[{"date": datetime(2023, 8, 7 + day)} for day in range(7)]]
+    ax = MagicMock()
+    headers = [Mock() for _ in range(7)]
+
+    assert draw_day_headers(ax, grid, headers) is headers
+
+    ax.text.assert_not_called()
+    assert [header.set_text.call_args for header in headers] == [
+        call(day_name)
+        for day_name in [
+            "Monday",
+            "Tuesday",
+            "Wednesday",
+            "Thursday",
+            "Friday",
+            "Saturday",
+            "Sunday",
+        ]
+    ]
 
 
 @pytest.mark.parametrize(
@@ -77,7 +127,7 @@ def test_draw_day_headers(input_grid):
                 call(
                     pie_row_header_width * 0.5,
                     0.5 * pie_height,
-                    "07\nAug",
+                    "",
                     horizontalalignment="center",
                     verticalalignment="center",
                     fontsize=14,
@@ -85,7 +135,7 @@ def test_draw_day_headers(input_grid):
                 call(
                     pie_row_header_width * 0.5,
                     1.5 * pie_height,
-                    "14\nAug",
+                    "",
                     horizontalalignment="center",
                     verticalalignment="center",
                     fontsize=14,
@@ -93,7 +143,7 @@ def test_draw_day_headers(input_grid):
                 call(
                     pie_row_header_width * 0.5,
                     2.5 * pie_height,
-                    "21\nAug",
+                    "",
                     horizontalalignment="center",
                     verticalalignment="center",
                     fontsize=14,
@@ -101,7 +151,7 @@ def test_draw_day_headers(input_grid):
                 call(
                     pie_row_header_width * 0.5,
                     3.5 * pie_height,
-                    "28\nAug",
+                    "",
                     horizontalalignment="center",
                     verticalalignment="center",
                     fontsize=14,
@@ -111,9 +161,18 @@ def test_draw_day_headers(input_grid):
     ],
 )
 def test_draw_week_headers(input_grid, expected_calls):
-    with patch("matplotlib.pyplot.text") as mock_text:
-        draw_week_headers(input_grid)
-        mock_text.assert_has_calls(expected_calls, any_order=False)
+    ax = MagicMock()
+    ax.text.side_effect = lambda *args, **kwargs: Mock()
+
+    headers = draw_week_headers(ax, input_grid)
+
+    ax.text.assert_has_calls(expected_calls, any_order=False)
+    assert [header.set_text.call_args for header in headers] == [
+        call("07\nAug"),
+        call("14\nAug"),
+        call("21\nAug"),
+        call("28\nAug"),
+    ]
 
 
 @pytest.mark.parametrize(
@@ -135,9 +194,9 @@ def test_draw_week_headers(input_grid, expected_calls):
     ],
 )
 def test_draw_pie(week, day, values, daily_max, expected_call):
-    with patch("matplotlib.pyplot.pie") as mock_pie:
-        draw_pie(week, day, values, daily_max)
-        mock_pie.assert_called_once_with(*expected_call.args, **expected_call.kwargs)
+    ax = MagicMock()
+    draw_pie(ax, week, day, values, daily_max)
+    ax.pie.assert_called_once_with(*expected_call.args, **expected_call.kwargs)
 
 
 @pytest.mark.parametrize(
@@ -182,25 +241,35 @@ def test_draw_empty_pie(
     image_mock = MagicMock()
     image_loader.by_file_name.return_value = image_mock
 
-    with patch("matplotlib.pyplot.imshow") as mock_imshow:
-        draw_empty_pie(
-            grid, image_loader, week, day, absent_grid_images, empty_image_file_name, tomorrow
-        )
+    ax = MagicMock()
+    sprites = Mock()
+    draw_empty_pie(
+        ax,
+        grid,
+        image_loader,
+        week,
+        day,
+        absent_grid_images,
+        empty_image_file_name,
+        tomorrow,
+        sprites=sprites,
+    )
 
-        # Asserting the expected call to plt.imshow
-        mock_imshow.assert_called_once_with(
-            image_mock,
-            extent=(
-                (pie_row_header_width + day * pie_width + pie_width / 5) * width_aspect,
-                (pie_row_header_width + (day + 1) * pie_width - pie_width / 5) * width_aspect,
-                week * pie_height + pie_width / 5,
-                (week + 1) * pie_height - pie_width / 5,
-            ),
-            interpolation="bicubic",
-        )
+    # Asserting the expected call to imshow
+    sprites.imshow.assert_called_once_with(
+        ax,
+        expected_image_filename,
+        image_mock,
+        (
+            (pie_row_header_width + day * pie_width + pie_width / 5) * width_aspect,
+            (pie_row_header_width + (day + 1) * pie_width - pie_width / 5) * width_aspect,
+            week * pie_height + pie_width / 5,
+            (week + 1) * pie_height - pie_width / 5,
+        ),
+    )
 
-        # Asserting the expected call to image_loader.by_file_name
-        image_loader.by_file_name.assert_called_once_with(expected_image_filename)
+    # Asserting the expected call to image_loader.by_file_name
+    image_loader.by_file_name.assert_called_once_with(expected_image_filename)
 
 
 def test_draw_today():
@@ -216,27 +285,26 @@ def test_draw_today():
         ],
     ]
 
-    # Mocking required objects
-    with patch("matplotlib.pyplot.gca") as mock_gca:
-        ax_mock = MagicMock()
-        mock_gca.return_value = ax_mock
+    ax_mock = MagicMock()
 
-        # Call the function
-        highlight_today(grid, datetime(2023, 8, 17))
+    # Call the function
+    rect = highlight_today(ax_mock, grid, datetime(2023, 8, 17))
 
-        # Assert if add_patch was called on the Axes object
-        ax_mock.add_patch.assert_called_once()
+    # Assert if add_patch was called on the Axes object
+    ax_mock.add_patch.assert_called_once_with(rect)
 
-        # Extract the first argument passed (which should be a Rectangle) and check its properties
-        rect = ax_mock.add_patch.call_args[0][0]
+    # Here we only check a few properties, but more can be added as needed
+    assert rect.get_xy() == (
+        (pie_row_header_width + 1 * pie_width) * width_aspect,
+        1 * pie_height,
+    )
+    assert rect.get_width() == pie_width * width_aspect * 0.98
+    assert rect.get_height() == pie_height
 
-        # Here we only check a few properties, but more can be added as needed
-        assert rect.get_xy() == (
-            (pie_row_header_width + 1 * pie_width) * width_aspect,
-            1 * pie_height,
-        )
-        assert rect.get_width() == pie_width * width_aspect * 0.98
-        assert rect.get_height() == pie_height
+    # Move the rectangle on the next day
+    assert highlight_today(ax_mock, grid, datetime(2023, 8, 16), rect) is rect
+    ax_mock.add_patch.assert_called_once()
+    assert rect.get_xy() == (pie_row_header_width * width_aspect, 1 * pie_height)
 
 
 def test_draw_pies():
@@ -265,20 +333,16 @@ def test_draw_pies():
     absent_images = {"AbsentA": "file1.jpg"}
     empty_image = "empty.jpg"
 
-    # Mocking plt functions and your draw_pie and draw_empty_pie functions
-    import matplotlib.pyplot as plt
+    mock_figure = Mock()
 
     with (
-        patch.object(plt, "gcf", return_value=Mock()),
         patch("calendar_image.draw_pie") as mock_draw_pie,
         patch("calendar_image.draw_empty_pie") as mock_draw_empty_pie,
-        patch("calendar_image.highlight_today") as mock_highlight_today,
-        patch("calendar_image.draw_day_headers") as mock_draw_day_headers,
-        patch("calendar_image.draw_week_headers") as mock_draw_week_headers,
     ):
         draw_pies(
             sample_grid,
-            mock_image_loader,
+            mock_figure,
+            image_loader=mock_image_loader,
             absent_grid_images=absent_images,
             empty_image_file_name=empty_image,
             weeks=2,
@@ -289,14 +353,13 @@ def test_draw_pies():
     # Assert draw_empty_pie was called for days with zero values
     assert mock_draw_empty_pie.call_count == 6
 
-    mock_highlight_today.assert_called_once()
-    mock_draw_day_headers.assert_called_once()
-    mock_draw_week_headers.assert_called_once()
+    mock_figure.update_layout.assert_called_once()
 
     expected_values = [[10, 20], [15], [10], [25], [10, 20], [15], [10], [25]]
     for idx, call in enumerate(mock_draw_pie.call_args_list):
         args, _ = call
-        assert args[2] == expected_values[idx]
+        assert args[0] is mock_figure.pies_axes
+        assert args[3] == expected_values[idx]
 
 
 def test_draw_weather():
@@ -308,20 +371,12 @@ def test_draw_weather():
         icon=["sample_icon"],
         day=[],
     )
-    rect = [0, 0, 1, 1]
+    mock_figure = Mock()
 
     mock_image_loader = Mock(spec=ImageLoader)
     mock_image_loader.by_file_name.return_value = "test_image_path"
 
-    # Mock plt functions
-    import matplotlib.pyplot as plt
-
-    with (
-        patch.object(plt, "axes", return_value=Mock()),
-        patch.object(plt, "axis"),
-        patch.object(plt, "imshow") as mock_imshow,
-    ):
-        draw_weather(weather_data, rect, mock_image_loader)
+    draw_weather(weather_data, mock_figure, mock_image_loader)
 
     # Asserts
     # Check if the image cache was called with the expected path
@@ -329,11 +384,48 @@ def test_draw_weather():
     mock_image_loader.by_file_name.assert_called_with(expected_path)
 
     # Assert the image was drawn at the expected extent
-    mock_imshow.assert_called_once_with(
-        "test_image_path", extent=(0.15, 0.85, 0.15, 0.85), interpolation="bilinear"
+    mock_figure.sprites.imshow.assert_called_once_with(
+        mock_figure.weather_axes, expected_path, "test_image_path", (0.15, 0.85, 0.15, 0.85)
     )
 
 
+def test_build_sprites(tmp_path):
+    for file_name in ("sct.png", "ra1.png", "readme.txt"):
+        (tmp_path / file_name).touch()
+    mock_figure = Mock()
+    mock_image_loader = Mock()
+    mock_image_loader.by_file_name.side_effect = lambda file_name: f"image {file_name}"
+
+    build_sprites(
+        mock_figure,
+        mock_image_loader,
+        cell_images=["empty.png", "ill.png"],
+        label_images=["run.png"],
+        weather_images_folder=str(tmp_path),
+    )
+
+    builds = [
+        (build.args[0], build.args[1], list(build.args[2]))
+        for build in mock_figure.sprites.build.call_args_list
+    ]
+    assert builds == [
+        (
+            mock_figure.pies_axes,
+            cell_image_extent(0, 0),
+            [("empty.png", "image empty.png"), ("ill.png", "image ill.png")],
+        ),
+        (mock_figure.labels_axes, (0, 0.2, 0, 0.2), [("run.png", "image run.png")]),
+        (
+            mock_figure.weather_axes,
+            (0.15, 0.85, 0.15, 0.85),
+            [
+                (str(tmp_path / file_name), f"image {tmp_path / file_name}")
+                for file_name in ("ra1.png", "sct.png")
+            ],
+        ),
+    ]
+
+
 def test_draw_plot():
     x = [datetime(2023, 1, 1), datetime(2023, 1, 2), datetime(2023, 1, 3)]
     y = [[1, 2, 3], [1, 2, 3]]
@@ -341,7 +433,6 @@ def test_draw_plot():
         WeatherLabel(summary="Label1", image="image1.png"),
         WeatherLabel(summary="Label2", image="image2.png"),
     ]
-    rect = [0.1, 0.1, 0.8, 0.8]
     mock_image_loader = Mock()
     mock_image_loader.by_file_name.return_value = "some_image.png"
 
@@ -349,16 +440,9 @@ def test_draw_plot():
     mock_axes.get_xlim.return_value = (0, 10)  # Sample xlim values
     mock_axes.get_ylim.return_value = (0, 20)  # Sample ylim values
 
-    import matplotlib.pyplot as plt
+    mock_figure = Mock(plot_axes=mock_axes)
 
-    with (
-        patch.object(plt, "axes", return_value=mock_axes),
-        patch.object(plt, "axis", return_value=Mock()),
-        patch.object(plt, "imshow", return_value=Mock()),
-        patch.object(plt, "legend", return_value=Mock()),
-        patch.object(plt, "text", return_value=Mock()),
-    ):
-        draw_plot(x, y, labels, rect, mock_image_loader)
+    draw_plot(x, y, labels, mock_figure, mock_image_loader)
 
     # Assert that xlim and ylim were accessed twice each
     mock_axes.get_xlim.assert_called()
@@ -378,7 +462,14 @@ def test_draw_plot():
         ]
     )
 
-    # Assuming you have other mockable functions, you can add similar assertions
+    # Assert images were drawn over the plot in one overlay
+    mock_figure.sprites.overlay.assert_called_once()
+    labels_axes, icons = mock_figure.sprites.overlay.call_args[0]
+    assert labels_axes is mock_figure.labels_axes
+    assert [icon[:2] for icon in icons] == [
+        ("image1.png", "some_image.png"),
+        ("image2.png", "some_image.png"),
+    ]
 
 
 def test_draw_calendar():
@@ -410,54 +501,417 @@ def test_draw_calendar():
     )  # This will need to be an instance of ImageParams or a Mock object representing it
     params.xkcd = "0"
     params.rotate = "0"
+    params.pies = "matplotlib"
+    params.target = "kindle"
+    params.eink = "off"
+    params.compression = "default"
 
     # Mocking plt and other external calls
     with (
-        patch("matplotlib.pyplot.clf"),
-        patch("matplotlib.pyplot.figure"),
-        patch("matplotlib.pyplot.rcParams.update"),
-        patch("matplotlib.pyplot.style.context"),
+        patch("calendar_image.FIGURES") as mock_figures,
+        patch("calendar_image.STYLES"),
         patch("calendar_image.draw_weather") as mock_draw_weather,
         patch("calendar_image.draw_plot") as mock_draw_plot,
         patch("calendar_image.draw_pies") as mock_draw_pies,
         patch("calendar_image.ImageLoader") as mock_image_loader,
-        patch("numpy.rot90") as mock_np_rot90,
-        patch("PIL.Image.fromarray") as mock_fromarray,
-        patch("PIL.Image.open") as mock_image_open,
+        patch("calendar_image.create_image") as mock_create_image,
     ):
         mock_image_loader.return_value = Mock()
-        mock_np_rot90.return_value = Mock()
-        mock_fromarray.return_value = Mock(save=Mock())
+
+        figure = mock_figures.use.return_value.__enter__.return_value
+        figure.changed_parts.return_value = None  # first render of the figure
 
         result = draw_calendar(grid, x, y, weather, dashboard, events, absent_labels, params)
 
+        mock_figures.use.assert_called_once_with(params)
+        figure.use_device.assert_called_once_with(DEVICES["kindle"])
+        figure.clear_data.assert_called_once()
         mock_draw_weather.assert_called_once_with(
             weather,
-            rect=(0, 0.6833333333333333, 0.24, 0.29166666666666663),
+            figure,
             image_loader=mock_image_loader.return_value,
         )
         mock_draw_plot.assert_called_once_with(
             x,
             y,
             [WeatherLabel(summary=event["summary"], image=event["image"]) for event in events],
-            rect=(0.3, 0.6833333333333333, 0.6749999999999999, 0.29166666666666663),
+            figure,
             image_loader=mock_image_loader.return_value,
         )
         mock_draw_pies.assert_called_once_with(
             grid,
+            figure,
             image_loader=mock_image_loader.return_value,
             weeks=4,
             absent_grid_images={"Holiday": "path/to/holiday.jpg"},
             empty_image_file_name="path/to/image.jpg",
+            raster=None,
+            cells=None,
         )
 
         assert isinstance(result, bytes)
         mock_image_loader.assert_called_once()
-        mock_np_rot90.assert_called_once()
-        mock_fromarray.assert_called_once()
-        mock_image_open.assert_called_once()
+        mock_create_image.assert_called_once_with(figure.figure, rotation_degrees=0)
+        mock_create_image.return_value.save.assert_called_once()
+
+
+def get_pool_figure(pool, params):
+    with pool.use(params) as figure:
+        return figure
+
+
+def test_figure_pool_reuses_figures():
+    pool = FigurePool(size=2)
+    with patch("calendar_image.DashboardFigure", side_effect=lambda: Mock()) as mock_figure:
+        first = get_pool_figure(pool, ImageParams("home", "png", "grayscale", "0", "0"))
+        assert get_pool_figure(pool, ImageParams("home", "gif", "grayscale", "0", "90")) is first
+        assert get_pool_figure(pool, ImageParams("home", "png", "grayscale", "1", "0")) is not first
+        assert get_pool_figure(pool, ImageParams("work", "png", "grayscale", "0", "0")) is not first
+
+    assert mock_figure.call_count == 3
+
+
+def test_figure_pool_figure_in_use():
+    pool = FigurePool(size=2)
+    params = ImageParams("home", "png", "grayscale", "0", "0")
+    with patch("calendar_image.DashboardFigure", side_effect=lambda: Mock()):
+        with pool.use(params) as first, pool.use(params) as second:
+            assert first is not second
+        assert get_pool_figure(pool, params) is second  # returned to the pool first
+
+    first.close.assert_called_once()
+    second.close.assert_not_called()
+
+
+def test_figure_pool_closes_least_recently_used():
+    pool = FigurePool(size=2)
+    with patch("calendar_image.DashboardFigure", side_effect=lambda: Mock()):
+        home = get_pool_figure(pool, ImageParams("home", "png", "grayscale", "0", "0"))
+        work = get_pool_figure(pool, ImageParams("work", "png", "grayscale", "0", "0"))
+        get_pool_figure(pool, ImageParams("home", "png", "grayscale", "0", "0"))
+        get_pool_figure(pool, ImageParams("home", "png", "bw", "0", "0"))
+
+        work.close.assert_called_once()
+        home.close.assert_not_called()
+
+        pool.clear()
+
+    home.close.assert_called_once()
+    assert not pool.figures
+
+
+def test_text_path_cache():
+    cache = TextPathCache(size=2)
+    prop = FontProperties(size=10)
+
+    vertices, codes = cache.get_text_path(prop, "Mo")
+    expected_vertices, expected_codes = TextToPath().get_text_path(prop, "Mo")
+    np.testing.assert_array_equal(vertices, expected_vertices)
+    np.testing.assert_array_equal(codes, expected_codes)
+    assert not vertices.flags.writeable
+
+    with patch.object(TextToPath, "get_text_path", autospec=True) as get_text_path:
+        get_text_path.return_value = ([], [])
+        assert cache.get_text_path(prop, "Mo")[0] is vertices
+        cache.get_text_path(FontProperties(size=12), "Mo")
+        cache.get_text_path(prop, "Tu")
+        cache.get_text_path(prop, "Mo")  # evicted by the text of other size
+        assert get_text_path.call_count == 3
+    assert cache.get_text_path(prop, "")[0].shape == (0, 2)
+
+
+@pytest.fixture
+def agg_figure():
+    figure = Figure(figsize=(0.03, 0.02), dpi=100)  # 3 x 2 pixels
+    FigureCanvasAgg(figure)
+    pixels = np.ones((2, 3))
+    pixels[0, 0] = 0  # top left is black
+    figure.figimage(pixels, cmap="gray", origin="upper")
+    figure.canvas.draw()
+    return figure
+
+
+@pytest.mark.parametrize(
+    "rotation_degrees, size, black_pixel",
+    [(0, (3, 2), (0, 0)), (90, (2, 3), (0, 2)), (180, (3, 2), (2, 1)), (-90, (2, 3), (1, 0))],
+)
+def test_create_image(agg_figure, rotation_degrees, size, black_pixel):
+    image = create_image(agg_figure, rotation_degrees)
+
+    assert image.size == size
+    assert image.getpixel(black_pixel) == (0, 0, 0, 255)
+    assert (np.asarray(image) == (0, 0, 0, 255)).all(axis=2).sum() == 1
+
+
+def test_create_image_wrong_rotation(agg_figure):
+    with pytest.raises(ValueError):
+        create_image(agg_figure, 45)
+
+
+@pytest.mark.parametrize("format, mode", [("png", "RGBA"), ("gif", "P"), ("jpg", "RGB")])
+def test_encode_image(agg_figure, format, mode):
+    data = encode_image(create_image(agg_figure, 90), format)
+
+    image = PIL.Image.open(io.BytesIO(data))
+    assert image.format == {"jpg": "JPEG"}.get(format, format.upper())
+    assert image.mode == mode
+    assert image.size == (2, 3)
+
+
+@pytest.mark.parametrize("format", ["png", "gif", "jpg"])
+def test_encode_image_compression(agg_figure, format):
+    image = create_image(agg_figure, 0)
+    decoded = [
+        np.asarray(PIL.Image.open(io.BytesIO(encode_image(image, format, compression))))
+        for compression in ENCODER_PROFILES
+    ]
+
+    assert all((pixels == decoded[0]).all() for pixels in decoded)
+
+
+def load_draw_calendar_params(file_name, style, pies="matplotlib"):
+    with open(os.path.join(os.path.dirname(__file__), "resources", file_name)) as file:
+        call_params = json.load(file)
+    for row in call_params["grid"]:
+        for col in row:
+            col["date"] = parser.parse(col["date"])
+    return (
+        call_params["grid"],
+        [parser.parse(x) for x in call_params["x"]],
+        call_params["y"],
+        WeatherData(**call_params["weather"]) if call_params["weather"] else None,
+        call_params["dashboard"],
+        call_params["labels"],
+        call_params["absent_labels"],
+        ImageParams(file_name, "png", style, "0", "0", pies),
+    )
+
+
+@pytest.fixture
+def pooled_figures(monkeypatch):
+    """Empty `FIGURES` pool for the test, cleared after it even if the test failed."""
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), "../src"))  # images paths
+    calendar_image.FIGURES.clear()
+    yield calendar_image.FIGURES
+    calendar_image.FIGURES.clear()
+
+
+def test_draw_calendar_in_threads(pooled_figures):
+    calls = [
+        load_draw_calendar_params("draw_calendar_params_1.json", "grayscale"),
+        load_draw_calendar_params("draw_calendar_params_2.json", "seaborn-v0_8-talk"),
+        load_draw_calendar_params("draw_calendar_params_2.json", "grayscale"),
+        load_draw_calendar_params("draw_calendar_params_2.json", "grayscale", pies="numpy"),
+    ]
+    render = lambda args: draw_calendar.__wrapped__(*args)  # noqa: E731
+    sequential = [render(args) for args in calls]
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        parallel = list(executor.map(render, calls * 3))
+
+    assert parallel == sequential * 3
+
+
+def test_draw_calendar_background(pooled_figures):
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale")
+    other_data = load_draw_calendar_params("draw_calendar_params_1.json", "grayscale")
+    other_data = (*other_data[:-1], args[-1])  # the same figure
+    next_week = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale")
+    for week in next_week[0]:
+        for day in week:
+            day["date"] += timedelta(days=7)
+    with patch.object(
+        FigureCanvasAgg, "draw", autospec=True, side_effect=FigureCanvasAgg.draw
+    ) as canvas_draw:
+        draw_calendar.__wrapped__(*args)
+        other_data_image = draw_calendar.__wrapped__(*other_data)
+        assert canvas_draw.call_count == 1  # the background is reused
+
+        next_week_image = draw_calendar.__wrapped__(*next_week)
+        assert canvas_draw.call_count == 2  # other week headers
+
+    for call_args, image in ((other_data, other_data_image), (next_week, next_week_image)):
+        pooled_figures.clear()
+        assert draw_calendar.__wrapped__(*call_args) == image
+
+
+def test_draw_calendar_pies_renderers(pooled_figures):
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale")
+    images = [
+        np.asarray(PIL.Image.open(io.BytesIO(draw_calendar.__wrapped__(*args[:-1], params))))
+        for params in (args[-1], args[-1]._replace(pies="numpy"))
+    ]
+
+    assert images[0].shape == images[1].shape
+    assert 0 < np.abs(images[0].astype(int) - images[1]).mean() < 2
+
+
+def test_draw_calendar_xkcd_deterministic(pooled_figures):
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale")
+    args = (*args[:-1], args[-1]._replace(xkcd="1"))
+    other = load_draw_calendar_params("draw_calendar_params_1.json", "grayscale")
+    other = (*other[:-1], args[-1])
+
+    image = draw_calendar.__wrapped__(*args)
+    draw_calendar.__wrapped__(*other)
+    with patch.object(
+        TextToPath, "get_text_path", autospec=True, side_effect=TextToPath.get_text_path
+    ) as get_text_path:
+        assert draw_calendar.__wrapped__(*args) == image  # on the figure with the background
+        get_text_path.assert_not_called()  # the texts outlines are cached by the figure
+
+    pooled_figures.clear()
+    assert draw_calendar.__wrapped__(*args) == image  # on new figure
+
+
+def test_draw_calendar_profile(pooled_figures, monkeypatch, tmp_path):
+    monkeypatch.setenv(PROFILE_DIR_ENV, str(tmp_path))
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale", pies="numpy")
+
+    draw_calendar.__wrapped__(*args)
+
+    stages = {path.stem.rsplit("-", 1)[-1] for path in tmp_path.glob("*.prof")}
+    assert stages == {"weather", "plot", "pies", "canvas", "raster", "encode"}
+
+
+def test_draw_calendar_devices(pooled_figures):
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale", pies="numpy")
+    changed = changed_draw_calendar_params(args, "cell")
+    calls = [
+        (args, "kindle"),
+        (args, "paperwhite"),
+        (changed, "kindle"),  # the artists are already for the changed data
+        (changed, "paperwhite"),
+    ]
+
+    def draw(call_args, target):
+        return draw_calendar.__wrapped__(*call_args[:-1], call_args[-1]._replace(target=target))
+
+    images = [draw(call_args, target) for call_args, target in calls]  # on the same figure
+
+    for image, (call_args, target) in zip(images, calls):
+        pooled_figures.clear()
+        assert image == draw(call_args, target)  # the same as drawn on new figure
+        assert PIL.Image.open(io.BytesIO(image)).size == DEVICES[target][:2]
+
+    with pytest.raises(ValueError, match="Unknown target"):
+        draw(args, "tv")
+
+
+def test_changed_parts():
+    figure = DashboardFigure()
+    inputs = {"figure": 1, "weather": "sunny", (0, 0): [1]}
+
+    assert figure.changed_parts(inputs) is None  # no artists yet
+    assert figure.changed_parts(inputs) == set()
+    inputs[0, 0].append(2)  # the figure keeps a copy
+    assert figure.changed_parts(inputs) == {(0, 0)}
+    assert figure.changed_parts({**inputs, "weather": "rain"}) == {"weather"}
+    assert figure.changed_parts({**inputs, "figure": 2}) is None
+    assert figure.changed_parts({"figure": 2}) is None
+    figure.close()
+
+
+def test_regions_mask():
+    mask = regions_mask([Bbox.from_extents(0.5, 1, 2, 3), Bbox.from_extents(-5, -5, 1, 1)], (4, 5))
+
+    assert mask.tolist() == [
+        [False, False, False, False, False],
+        [True, True, False, False, False],
+        [True, True, False, False, False],
+        [True, False, False, False, False],
+    ]
+
+
+def changed_draw_calendar_params(args, change):
+    grid, x, y, weather, *rest = copy.deepcopy(args)
+    if change == "cell":
+        grid[1][2]["values"] = [value + 1 for value in grid[1][2]["values"]]
+    elif change == "plot":
+        y = [values[:-1] + [values[-1] + 3] for values in y]
+    elif change == "weather":
+        weather = weather.model_copy(update={"temp_max": [temp + 5 for temp in weather.temp_max]})
+    return grid, x, y, weather, *rest
+
+
+@pytest.mark.parametrize("change", ["cell", "plot", "weather"])
+@pytest.mark.parametrize("pies", ["matplotlib", "numpy"])
+@pytest.mark.parametrize("xkcd", ["0", "1"])
+def test_draw_calendar_incremental(pooled_figures, change, pies, xkcd):
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale", pies=pies)
+    args = (*args[:-1], args[-1]._replace(xkcd=xkcd))
+    changed = changed_draw_calendar_params(args, change)
+    draw_calendar.__wrapped__(*args)
+
+    with patch.object(Axes, "pie", autospec=True, side_effect=Axes.pie) as pie:
+        image = draw_calendar.__wrapped__(*changed)
+    assert pie.call_count == (1 if change == "cell" and pies == "matplotlib" else 0)
+
+    pooled_figures.clear()
+    assert draw_calendar.__wrapped__(*changed) == image  # the same as drawn from scratch
+
+
+def test_draw_calendar_unknown_pies():
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale", pies="svg")
+    with pytest.raises(ValueError, match="Unknown pies renderer"):
+        draw_calendar.__wrapped__(*args)
 
 
 @pytest.mark.benchmark
 def test_draw_benchmark(benchmark):
     benchmark(calendar_image.check, show=False)
+
+
+def test_draw_calendar_eink(pooled_figures):
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale")
+
+    data = draw_calendar.__wrapped__(*args[:-1], args[-1]._replace(eink=EINK_ORDERED))
+
+    image = PIL.Image.open(io.BytesIO(data))
+    assert image.mode == "P"
+    assert image.size == (800, 600)
+    with pytest.raises(ValueError, match="Unknown e-ink mode"):
+        draw_calendar.__wrapped__(*args[:-1], args[-1]._replace(eink="color"))
+
+
+def test_draw_calendar_encodings(pooled_figures):
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale")
+    encodings = [("png", "default"), ("png", "fast"), ("png", "small"), ("gif", "default")]
+
+    encoded = draw_calendar_encodings(*args, encodings)
+
+    assert list(encoded) == encodings
+    assert encoded["png", "default"] == draw_calendar.__wrapped__(*args)
+    pixels = [
+        np.asarray(PIL.Image.open(io.BytesIO(encoded[encoding]))) for encoding in encodings[:3]
+    ]
+    assert all((image == pixels[0]).all() for image in pixels)
+    assert PIL.Image.open(io.BytesIO(encoded["gif", "default"])).format == "GIF"
+    with pytest.raises(ValueError, match="Unknown compression"):
+        draw_calendar_encodings(*args, [("png", "zip")])
+
+
+@pytest.fixture
+def kindle_image(pooled_figures):
+    """Decoded Kindle PNG of the dashboard, in the xkcd style and rotated."""
+    args = load_draw_calendar_params("draw_calendar_params_2.json", "grayscale")
+    params = args[-1]._replace(xkcd="1", rotate="90")
+    return PIL.Image.open(io.BytesIO(draw_calendar.__wrapped__(*args[:-1], params)))
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("compression", ENCODER_PROFILES)
+def test_encoder_benchmark(benchmark, kindle_image, compression):
+    """Encode time and size of the Kindle PNG for the encoder profiles."""
+    data = benchmark(lambda: encode_image(kindle_image, "png", compression))
+
+    benchmark.extra_info["bytes"] = len(data)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("mode", EINK_MODES)
+def test_eink_benchmark(benchmark, kindle_image, mode):
+    """Encode time and size of the Kindle image, `off` is the full color PNG."""
+    data = benchmark(lambda: encode_image(to_eink(kindle_image, mode), "png"))
+
+    benchmark.extra_info["bytes"] = len(data)
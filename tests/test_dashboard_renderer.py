@@ -0,0 +1,515 @@
+import asyncio
+import concurrent.futures
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from calendar_image import ImageParams
+from dashboard_renderer import (
+    PRERENDER_PARAMS,
+    DashboardData,
+    DashboardRenderer,
+    FileImageStore,
+    PrerenderScheduler,
+    RenderQueueFullError,
+    inputs_hash,
+    prerender_keys,
+    raster_key,
+    render_key,
+)
+from metrics import StageTimer
+from models import RenderedImage, WeatherData
+
+SETTINGS = {
+    "dashboards": {"default": {}, "other": {"images_folder": "other_folder"}},
+    "latitude": "mock_latitude",
+    "longitude": "mock_longitude",
+    "images_folder": "mock_images_folder",
+}
+
+
+class MockWeather:
+    def __init__(self, settings):
+        pass
+
+    def get_weather(self, latitude, longitude):
+        return WeatherData(
+            images_folder="mock/path",
+            temp_min=[1, 2, 3],
+            temp_max=[4, 5, 6],
+            icon=["mock_icon"],
+            day=[datetime(2020, 1, 1)],
+        )
+
+
+def mock_encodings(*args):
+    return {encoding: b"mock_image_data" for encoding in args[-1]}
+
+
+@pytest.fixture
+def mock_pipeline():
+    with (
+        patch("dashboard_renderer.draw_calendar_encodings", side_effect=mock_encodings) as draw,
+        patch("dashboard_renderer.Weather", MockWeather),
+        patch(
+            "dashboard_renderer.collect_events", return_value=("mock_events", "mock_absents")
+        ) as collect,
+        patch("dashboard_renderer.events_to_weeks_grid", return_value="mock_grid"),
+        patch("dashboard_renderer.events_to_array", return_value=("mock_x", "mock_y")),
+        patch(
+            "dashboard_renderer.dashboard_absent_events_list", return_value="mock_absent_events"
+        ) as absent_list,
+        patch("dashboard_renderer.calendar_events_list", return_value="mock_calendar_events"),
+    ):
+        yield MagicMock(
+            draw_calendar_encodings=draw, collect_events=collect, absent_list=absent_list
+        )
+
+
+def test_render_key():
+    assert render_key(ImageParams("d", "PNG", "grayscale", 1, 90)) == ImageParams(
+        "d", "png", "grayscale", "1", "90"
+    )
+
+
+def test_inputs_hash_depends_on_data_and_params():
+    data = DashboardData([], [], [], None, {}, [], [])
+    params = ImageParams("d", "png", "grayscale", "1", "90")
+    assert inputs_hash(data, params) == inputs_hash(data, params)
+    assert inputs_hash(data, params) != inputs_hash(data, params._replace(xkcd="0"))
+    assert inputs_hash(data, params) != inputs_hash(data._replace(y=[[1]]), params)
+
+
+def test_load_data(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    data = asyncio.run(renderer.load_data("default"))
+
+    assert data.grid == "mock_grid"
+    assert (data.x, data.y) == ("mock_x", "mock_y")
+    assert data.weather.images_folder == "mock_images_folder"
+    assert data.dashboard["images_folder"] == "mock_images_folder"
+    mock_pipeline.absent_list.assert_called_once_with(SETTINGS, "default")
+    mock_pipeline.collect_events.assert_called_once_with(
+        "mock_calendar_events", "mock_absent_events", SETTINGS
+    )
+
+
+def test_render_skips_unchanged_inputs(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    params = ImageParams("default", "png", "grayscale", 1, 90)
+
+    async def render_twice():
+        return await renderer.render(params), await renderer.render(params)
+
+    first, second = asyncio.run(render_twice())
+
+    assert first.data == b"mock_image_data"
+    assert (second.etag, second.rendered_at) == (first.etag, first.rendered_at)
+    mock_pipeline.draw_calendar_encodings.assert_called_once()
+    assert mock_pipeline.draw_calendar_encodings.call_args[0][-2] == render_key(params)
+
+
+def test_render_encodes_variants_side_by_side(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    png = render_key(ImageParams("default", "png", "grayscale", 1, 90))
+    gif = png._replace(format="gif")
+    small = png._replace(compression="small")
+    assert raster_key(png) == raster_key(gif) == raster_key(small)
+
+    async def render_all():
+        await renderer.render(png)
+        await renderer.render(gif)  # the drawing is encoded as png too
+        await renderer.render(png)
+        await renderer.render(small)
+
+    asyncio.run(render_all())
+
+    encodings = [call.args[-1] for call in mock_pipeline.draw_calendar_encodings.call_args_list]
+    assert encodings == [
+        (("png", "default"),),
+        (("gif", "default"), ("png", "default")),
+        (("gif", "default"), ("png", "default"), ("png", "small")),
+    ]
+    assert set(renderer.images) == {png, gif, small}
+    assert renderer.images[gif].inputs_hash != renderer.images[png].inputs_hash
+
+
+def test_failed_encoding_is_not_kept(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    params = ImageParams("default", "png", "grayscale", 1, 90)
+    mock_pipeline.draw_calendar_encodings.side_effect = ValueError("Unknown compression")
+
+    with pytest.raises(ValueError):
+        asyncio.run(renderer.render(params._replace(compression="zip")))
+
+    assert renderer.encodings == {raster_key(params): set()}
+
+
+def test_concurrent_renders_are_coalesced(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    params = ImageParams("default", "png", "grayscale", 1, 90)
+
+    async def render_concurrently():
+        return await asyncio.gather(
+            *(renderer.render(params._replace(xkcd=xkcd)) for xkcd in (1, "1", 1, "1", 1))
+        )
+
+    images = asyncio.run(render_concurrently())
+
+    assert all(image is images[0] for image in images)
+    mock_pipeline.collect_events.assert_called_once()
+    mock_pipeline.draw_calendar_encodings.assert_called_once()
+    assert renderer.in_flight == {}
+
+
+def test_concurrent_renders_share_error(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    params = ImageParams("default", "png", "grayscale", 1, 90)
+    mock_pipeline.draw_calendar_encodings.side_effect = ValueError("boom")
+
+    async def render_concurrently():
+        return await asyncio.gather(
+            renderer.render(params), renderer.render(params), return_exceptions=True
+        )
+
+    errors = asyncio.run(render_concurrently())
+
+    assert all(isinstance(error, ValueError) for error in errors)
+    mock_pipeline.draw_calendar_encodings.assert_called_once()
+    assert renderer.in_flight == {}
+
+
+def test_get_returns_scheduled_image_without_loading_data(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    params = ImageParams("default", "png", "grayscale", 1, 90)
+    asyncio.run(renderer.render(params))
+    renderer.scheduled.add(render_key(params))
+
+    image = asyncio.run(renderer.get(params))
+
+    assert image.data == b"mock_image_data"
+    mock_pipeline.collect_events.assert_called_once()
+
+
+def test_get_renders_not_scheduled_image(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    params = ImageParams("default", "png", "grayscale", 1, 90)
+    asyncio.run(renderer.render(params))
+
+    asyncio.run(renderer.get(params))
+
+    assert mock_pipeline.collect_events.call_count == 2
+
+
+def test_run_render_in_executor():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        renderer = DashboardRenderer(SETTINGS, executor=executor)
+        assert asyncio.run(renderer.run_render(pow, 2, 10)) == 1024
+
+
+def test_run_render_without_executor():
+    assert asyncio.run(DashboardRenderer(SETTINGS).run_render(pow, 2, 3)) == 8
+
+
+def test_scheduler_renders_every_dashboard(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    scheduler = PrerenderScheduler(renderer, interval_seconds=60)
+    assert len(renderer.scheduled) == len(SETTINGS["dashboards"]) * len(PRERENDER_PARAMS)
+
+    asyncio.run(scheduler.refresh())
+
+    assert set(renderer.images) == renderer.scheduled
+    assert mock_pipeline.draw_calendar_encodings.call_count == len(renderer.scheduled)
+
+
+def test_dashboard_data_loaded_once(mock_pipeline):
+    with patch("dashboard_renderer.Weather", wraps=MockWeather) as weather:
+        renderer = DashboardRenderer(SETTINGS)
+        scheduler = PrerenderScheduler(renderer, interval_seconds=60)
+
+        asyncio.run(renderer.warm_up())
+        asyncio.run(scheduler.refresh())
+
+    weather.assert_called_once_with(SETTINGS)
+    assert mock_pipeline.collect_events.call_count == 2 * len(SETTINGS["dashboards"])
+    assert set(renderer.images) == renderer.scheduled
+
+
+def test_scheduler_continues_after_error(mock_pipeline, capsys):
+    renderer = DashboardRenderer(SETTINGS)
+    scheduler = PrerenderScheduler(renderer, interval_seconds=60)
+    mock_pipeline.draw_calendar_encodings.side_effect = [ValueError("boom")] + [
+        {("png", "default"): b"image"}
+    ] * 10
+
+    asyncio.run(scheduler.refresh())
+
+    assert len(renderer.images) == len(renderer.scheduled) - 1
+    assert "boom" in capsys.readouterr().out
+
+
+def make_image(data=b"image", age_seconds=0):
+    return RenderedImage(
+        data=data,
+        etag="etag",
+        inputs_hash="hash",
+        rendered_at=datetime(2020, 1, 1, 10, 30, tzinfo=timezone.utc),
+        checked_at=datetime.now(timezone.utc) - timedelta(seconds=age_seconds),
+    )
+
+
+KEY = ImageParams("default", "png", "grayscale", "1", "90")
+
+
+def test_render_updates_checked_at_of_unchanged_image(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+
+    async def render_twice():
+        first = await renderer.render(KEY)
+        renderer.images[KEY] = first.model_copy(
+            update={"checked_at": first.checked_at - timedelta(seconds=100)}
+        )
+        return first, await renderer.render(KEY)
+
+    first, second = asyncio.run(render_twice())
+
+    assert second.etag == first.etag
+    assert second.checked_at >= first.checked_at
+    mock_pipeline.draw_calendar_encodings.assert_called_once()
+
+
+def test_stale_while_revalidate_returns_stale_image(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS, stale_while_revalidate=True, max_stale_seconds=600)
+    stale = make_image(b"stale", age_seconds=100)
+    renderer.images[KEY] = stale
+
+    async def get_and_wait_refresh():
+        image = await renderer.get(KEY)
+        refreshing = KEY in renderer.in_flight
+        await renderer.in_flight[KEY]
+        return image, refreshing
+
+    image, refreshing = asyncio.run(get_and_wait_refresh())
+
+    assert image is stale
+    assert refreshing
+    assert renderer.images[KEY].data == b"mock_image_data"
+
+
+def test_stale_while_revalidate_does_not_refresh_recently_checked_image(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS, stale_while_revalidate=True)
+    renderer.images[KEY] = make_image(b"fresh", age_seconds=1)
+
+    assert asyncio.run(renderer.get(KEY)).data == b"fresh"
+    assert renderer.in_flight == {}
+    mock_pipeline.collect_events.assert_not_called()
+
+
+@pytest.mark.parametrize("stale_while_revalidate,scheduled", [(True, False), (False, True)])
+def test_too_stale_image_is_rendered(mock_pipeline, stale_while_revalidate, scheduled):
+    renderer = DashboardRenderer(
+        SETTINGS, stale_while_revalidate=stale_while_revalidate, max_stale_seconds=60
+    )
+    if scheduled:
+        renderer.scheduled.add(KEY)
+    renderer.images[KEY] = make_image(b"stale", age_seconds=100)
+
+    assert asyncio.run(renderer.get(KEY)).data == b"mock_image_data"
+
+
+def test_file_image_store(tmp_path):
+    store = FileImageStore(str(tmp_path / "images"))
+    key = ImageParams("default", "png", "grayscale", "1", "90")
+    image = make_image(b"\x89PNG\n\x00binary\n")
+
+    store[key] = image
+
+    assert store[key] == image
+    assert FileImageStore(str(tmp_path / "images")).get(key) == image  # other process
+    assert list(store) == [key]
+    assert len(store) == 1
+    assert store.get(key._replace(xkcd="0")) is None
+
+    store[key] = make_image(b"new")
+    assert store[key].data == b"new"
+    assert len(store) == 1
+
+    del store[key]
+    assert key not in store
+    assert list(tmp_path.joinpath("images").iterdir()) == []
+
+
+def test_renderer_with_file_image_store(tmp_path, mock_pipeline):
+    params = ImageParams("default", "png", "grayscale", 1, 90)
+    renderer = DashboardRenderer(SETTINGS, images=FileImageStore(str(tmp_path)))
+    image = asyncio.run(renderer.render(params))
+
+    # other worker sees the image and does not render it again
+    other_renderer = DashboardRenderer(SETTINGS, images=FileImageStore(str(tmp_path)))
+    assert asyncio.run(other_renderer.render(params)).rendered_at == image.rendered_at
+    mock_pipeline.draw_calendar_encodings.assert_called_once()
+
+
+def test_revalidate_reports_error(mock_pipeline, capsys):
+    renderer = DashboardRenderer(SETTINGS)
+    mock_pipeline.draw_calendar_encodings.side_effect = ValueError("boom")
+
+    async def revalidate():
+        renderer.revalidate(KEY)
+        await asyncio.wait([renderer.in_flight[KEY]])
+
+    asyncio.run(revalidate())
+
+    assert "boom" in capsys.readouterr().out
+    assert renderer.in_flight == {}
+
+
+def test_render_reports_stage_durations(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    with patch("dashboard_renderer.STAGE_SECONDS") as stage_seconds:
+        asyncio.run(renderer.render(KEY))
+
+    durations = stage_seconds.observe_all.call_args[0][0]
+    assert set(durations) == {
+        "queue",
+        "settings",
+        "collect_events",
+        "fetch",
+        "get_weather",
+        "events_to_grid",
+        "render",
+    }
+
+
+def test_timer_receives_cache_status(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    first, second, scheduled = StageTimer(), StageTimer(), StageTimer()
+
+    async def render_concurrently():
+        return await asyncio.gather(renderer.render(KEY, first), renderer.render(KEY, second))
+
+    asyncio.run(render_concurrently())
+    renderer.scheduled.add(KEY)
+    asyncio.run(renderer.get(KEY, scheduled))
+
+    assert first.cache == "miss"
+    assert "fetch" in first.durations
+    assert second.cache == "coalesced"
+    assert second.durations == first.durations
+    assert scheduled.cache == "hit"
+    assert scheduled.durations == {}
+
+
+def test_timer_receives_unchanged_and_stale_status(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS, stale_while_revalidate=True)
+    asyncio.run(renderer.render(KEY))
+    unchanged = StageTimer()
+    asyncio.run(renderer.render(KEY, unchanged))
+    renderer.images[KEY] = make_image(b"mock_image_data", age_seconds=60)
+    stale = StageTimer()
+
+    async def get_stale():
+        image = await renderer.get(KEY, stale)
+        await asyncio.gather(*renderer.in_flight.values())
+        return image
+
+    asyncio.run(get_stale())
+
+    assert unchanged.cache == "unchanged"
+    assert stale.cache == "stale"
+
+
+def test_prerender_keys():
+    keys = prerender_keys(SETTINGS)
+
+    assert len(keys) == len(SETTINGS["dashboards"]) * len(PRERENDER_PARAMS)
+    assert ImageParams("other", "png", "grayscale", "1", "90") in keys
+
+
+def test_warm_up_renders_all_dashboards(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS)
+    assert not renderer.ready
+
+    asyncio.run(renderer.warm_up())
+
+    assert set(renderer.images) == set(prerender_keys(SETTINGS))
+    assert renderer.ready
+
+
+def test_warm_up_is_shared_by_file_image_store(tmp_path, mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS, images=FileImageStore(str(tmp_path)))
+    other_renderer = DashboardRenderer(SETTINGS, images=FileImageStore(str(tmp_path)))
+    assert not other_renderer.ready
+
+    asyncio.run(renderer.warm_up())
+
+    assert other_renderer.ready  # other worker does not warm up
+    FileImageStore(str(tmp_path)).clear()
+    assert not other_renderer.ready  # the mark of the previous run is removed on start
+
+
+def test_warm_up_does_not_fill_render_queue(mock_pipeline, capsys):
+    settings = {**SETTINGS, "dashboards": {f"d{index}": {} for index in range(4)}}
+    renderer = DashboardRenderer(settings, max_renders=1, max_queued_renders=1)
+
+    asyncio.run(renderer.warm_up())
+
+    assert set(renderer.images) == set(prerender_keys(settings))
+    assert "Error" not in capsys.readouterr().out
+
+
+def test_warm_up_is_ready_after_error(mock_pipeline, capsys):
+    renderer = DashboardRenderer(SETTINGS)
+    mock_pipeline.draw_calendar_encodings.side_effect = ValueError("boom")
+
+    asyncio.run(renderer.warm_up())
+
+    assert "boom" in capsys.readouterr().out
+    assert renderer.ready
+
+
+def render_concurrently(renderer, method, keys, timers=None):
+    async def run():
+        return await asyncio.gather(
+            *(method(key, timer) for key, timer in zip(keys, timers or [None] * len(keys))),
+            return_exceptions=True,
+        )
+
+    return asyncio.run(run())
+
+
+def test_render_queue_full(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS, max_renders=1, max_queued_renders=1)
+    keys = [KEY._replace(rotate=rotate) for rotate in ("0", "90", "180")]
+
+    results = render_concurrently(renderer, renderer.render, keys)
+
+    assert [image.data for image in results[:2]] == [b"mock_image_data"] * 2
+    assert isinstance(results[2], RenderQueueFullError)
+    assert renderer.in_flight == {}
+
+
+def test_get_with_full_queue_returns_last_image(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS, max_renders=1, max_queued_renders=1)
+    keys = [KEY._replace(rotate=rotate) for rotate in ("0", "90", "180")]
+    renderer.images[keys[2]] = make_image(b"old", age_seconds=renderer.max_stale_seconds + 1)
+    timer = StageTimer()
+
+    results = render_concurrently(renderer, renderer.get, keys, [None, None, timer])
+
+    assert results[2].data == b"old"
+    assert timer.cache == "shed"
+
+
+def test_revalidate_with_full_queue(mock_pipeline):
+    renderer = DashboardRenderer(SETTINGS, max_renders=1, max_queued_renders=0)
+
+    async def revalidate():
+        renderer.start_render(KEY._replace(rotate="0"))
+        renderer.revalidate(KEY)
+        await asyncio.gather(*renderer.in_flight.values())
+
+    asyncio.run(revalidate())
+
+    assert KEY not in renderer.images
@@ -0,0 +1,94 @@
+import numpy as np
+import PIL.Image
+import pytest
+
+from calendar_image import encode_image
+from eink import (
+    EINK_FLOYD,
+    EINK_GRAY,
+    EINK_OFF,
+    EINK_ORDERED,
+    floyd_steinberg,
+    luminance,
+    ordered_dither,
+    quantize,
+    to_eink,
+)
+
+
+def floyd_steinberg_pixel_by_pixel(gray, levels):
+    step = np.float32(255 / (levels - 1))
+    height, width = gray.shape
+    errors = np.zeros((height + 1, width + 2), dtype=np.float32)
+    indices = np.zeros((height, width), dtype=np.uint8)
+    for y in range(height):
+        for x in range(width):
+            value = (
+                gray[y, x]
+                + errors[y + 1, x] * np.float32(7 / 16)
+                + errors[y, x] * np.float32(1 / 16)
+                + errors[y, x + 1] * np.float32(5 / 16)
+                + errors[y, x + 2] * np.float32(3 / 16)
+            )
+            level = np.clip(np.rint(value / step), 0, levels - 1)
+            indices[y, x] = level
+            errors[y + 1, x + 1] = value - level * step
+    return indices
+
+
+def test_luminance():
+    image = PIL.Image.fromarray(
+        np.array([[[255, 0, 0, 255], [0, 0, 0, 0], [0, 0, 0, 128]]], dtype=np.uint8),
+    )
+
+    assert luminance(image)[0].tolist() == pytest.approx([0.299 * 255, 255, 127], abs=0.5)
+
+
+def test_quantize():
+    gray = np.array([[0, 8, 9, 127, 128, 255]], dtype=np.float32)
+
+    assert quantize(gray, 16).tolist() == [[0, 0, 1, 7, 8, 15]]
+    assert quantize(gray, 2).tolist() == [[0, 0, 0, 0, 1, 1]]
+
+
+@pytest.mark.parametrize("dither", [ordered_dither, floyd_steinberg])
+def test_dither_keeps_gray(dither):
+    gray = np.full((16, 16), 17 * 7.5, dtype=np.float32)  # between levels 7 and 8
+
+    indices = dither(gray, 16)
+
+    assert set(np.unique(indices)) == {7, 8}
+    assert indices.mean() == pytest.approx(7.5, abs=0.05)
+
+
+def test_floyd_steinberg():
+    gray = np.random.default_rng(1).uniform(0, 255, (13, 17)).astype(np.float32)
+
+    np.testing.assert_array_equal(
+        floyd_steinberg(gray, 16),
+        floyd_steinberg_pixel_by_pixel(gray, 16),
+    )
+
+
+@pytest.mark.parametrize("mode", [EINK_GRAY, EINK_ORDERED, EINK_FLOYD])
+def test_to_eink(mode):
+    image = PIL.Image.new("RGBA", (5, 3), (255, 255, 255, 255))
+    image.putpixel((1, 1), (0, 0, 0, 255))
+
+    eink = to_eink(image, mode)
+
+    assert eink.mode == "P"
+    assert eink.size == (5, 3)
+    assert eink.getpalette()[:6] == [0, 0, 0, 17, 17, 17]
+    assert len(eink.getpalette()) == 16 * 3
+    assert np.asarray(eink).tolist() == [[15] * 5, [15, 0, 15, 15, 15], [15] * 5]
+    data = encode_image(eink, "png")
+    assert data[24] == 4  # bit depth in the PNG header
+
+
+def test_to_eink_off_and_unknown():
+    image = PIL.Image.new("RGBA", (2, 2))
+
+    assert to_eink(image, EINK_OFF) is image
+    with pytest.raises(ValueError, match="Unknown e-ink mode"):
+        to_eink(image, "color")
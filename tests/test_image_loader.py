@@ -1,3 +1,4 @@
+import os
 from unittest.mock import patch
 
 import numpy as np
@@ -47,3 +48,18 @@ class TestImageLoader:
 
         captured = capsys.readouterr()
         assert "Error reading image from error.png" in captured.out
+
+    @pytest.mark.skipif(not hasattr(os, "fork"), reason="fork is not supported")
+    def test_cache_reset_after_fork(self, loader):
+        fake_image = np.array([[[0, 0, 0]]], dtype=np.uint8)
+        with patch("image_loader.mpimg.imread", return_value=fake_image):
+            loader.by_file_name("exists.png")
+        assert ImageLoader()._cache
+
+        pid = os.fork()
+        if pid == 0:  # child
+            os._exit(0 if not ImageLoader()._cache else 1)
+        _, status = os.waitpid(pid, 0)
+
+        assert os.waitstatus_to_exitcode(status) == 0
+        assert ImageLoader()._cache
@@ -1,13 +1,26 @@
+import asyncio
+import concurrent.futures
 import os
-from datetime import datetime
-from unittest.mock import MagicMock, patch
+import tempfile
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 import tornado.httputil
 import tornado.web
 
-from iot_calendar import Application, DashboardImageHandler, DashboardListHandler
-from models import WeatherData
+from iot_calendar import (
+    Application,
+    DashboardImageHandler,
+    DashboardListHandler,
+    HealthHandler,
+    MetricsHandler,
+    ReadyHandler,
+    create_image_store,
+    create_render_executor,
+)
+from dashboard_renderer import RETRY_AFTER_SECONDS, FileImageStore, RenderQueueFullError
+from models import RenderedImage
 
 
 class MockConnection:
@@ -58,20 +71,6 @@ def test_dashboard_list_handler_renders_properly(mock_request_list_handler):
     mock_request_list_handler.render.assert_called_once()
 
 
-class MockWeather:
-    def __init__(self, settings):
-        pass
-
-    def get_weather(self, latitude, longitude):
-        return WeatherData(
-            images_folder="mock/path",
-            temp_min=[1, 2, 3],
-            temp_max=[4, 5, 6],
-            icon=["mock_icon"],
-            day=[datetime(2020, 1, 1)],
-        )
-
-
 def test_load_params_default_values(mock_request_list_handler):
     params = mock_request_list_handler.load_params()
 
@@ -88,15 +87,29 @@ def test_load_params_overrides(mock_request_list_handler):
 
 
 @pytest.fixture
-def mock_request_image_handler():
+def mock_renderer():
+    renderer = MagicMock()
+    renderer.get = AsyncMock(
+        return_value=RenderedImage(
+            data=b"mock_image_data",
+            etag="mock_etag",
+            inputs_hash="mock_hash",
+            rendered_at=datetime(2020, 1, 1, tzinfo=timezone.utc),
+            checked_at=datetime.now(timezone.utc) - timedelta(seconds=42),
+        )
+    )
+    return renderer
+
+
+def make_image_handler(renderer, **request_headers):
     mock_settings = dict(
         template_path=os.path.join(os.path.dirname(__file__), "../templates"),
         debug=True,
     )
-    application = tornado.web.Application(settings=mock_settings)
+    application = Application(server_settings=mock_settings, renderer=renderer)
     connection = MockConnection()
     # Create headers with Host value for HTTP/1.1
-    headers = tornado.httputil.HTTPHeaders({"Host": "localhost"})
+    headers = tornado.httputil.HTTPHeaders({"Host": "localhost", **request_headers})
     request = tornado.httputil.HTTPServerRequest(
         method="GET", uri="/", version="HTTP/1.1", headers=headers, body=None, connection=connection
     )
@@ -107,33 +120,128 @@ def mock_request_image_handler():
     return handler
 
 
-@patch("iot_calendar.draw_calendar", return_value="mock_image_data")
-@patch("iot_calendar.Weather", return_value=MockWeather({}))
-@patch("iot_calendar.collect_events", return_value=("mock_events", "mock_absents"))
-@patch("iot_calendar.events_to_weeks_grid", return_value="mock_grid")
-@patch("iot_calendar.events_to_array", return_value=("mock_x", "mock_y"))
-@patch("iot_calendar.dashboard_absent_events_list", return_value="mock_absent_events")
-@patch("iot_calendar.calendar_events_list", return_value="mock_calendar_events")
-@patch(
-    "iot_calendar.settings",
-    {
-        "dashboards": {"default": {}},
-        "latitude": "mock_latitude",
-        "longitude": "mock_longitude",
-        "images_folder": "mock_images_folder",
-    },
-)
-def test_dashboard_image_handler(
-    mock_calendar_events_list,
-    mock_dashboard_absent_events_list,
-    mock_events_to_array,
-    mock_events_to_weeks_grid,
-    mock_collect_events,
-    MockWeather,
-    mock_draw_calendar,
-    mock_request_image_handler,
-):
-    mock_request_image_handler.get("png")
-
-    mock_draw_calendar.assert_called_once()
+@pytest.fixture
+def mock_request_image_handler(mock_renderer):
+    return make_image_handler(mock_renderer)
+
+
+@patch("iot_calendar.settings", {"dashboards": {"default": {}}})
+def test_dashboard_image_handler(mock_renderer, mock_request_image_handler):
+    asyncio.run(mock_request_image_handler.get("png"))
+
+    mock_renderer.get.assert_called_once()
+    params = mock_renderer.get.call_args[0][0]
+    assert params.dashboard == "default"
+    assert params.format == "png"
     assert mock_request_image_handler._headers.get("Content-type") == "image/png"
+    assert mock_request_image_handler._headers.get("Etag") == '"mock_etag"'
+    assert mock_request_image_handler._headers.get("Cache-Control") == "no-cache"
+    assert mock_request_image_handler._headers.get("Age") in ("42", "43")
+    assert "Server-Timing" not in mock_request_image_handler._headers
+    assert mock_request_image_handler.get_status() == 200
+    assert b"".join(mock_request_image_handler._write_buffer) == b"mock_image_data"
+
+
+@pytest.mark.parametrize(
+    "if_none_match,status",
+    [('"mock_etag"', 304), ('W/"mock_etag"', 304), ('"other", "mock_etag"', 304), ('"other"', 200)],
+)
+@patch("iot_calendar.settings", {"dashboards": {"default": {}}})
+def test_dashboard_image_handler_if_none_match(mock_renderer, if_none_match, status):
+    handler = make_image_handler(mock_renderer, **{"If-None-Match": if_none_match})
+
+    asyncio.run(handler.get("png"))
+
+    assert handler.get_status() == status
+    assert handler._headers.get("Etag") == '"mock_etag"'
+    assert bool(handler._write_buffer) == (status == 200)
+
+
+@patch("iot_calendar.settings", {"dashboards": {"default": {}}})
+def test_dashboard_image_handler_server_timing(mock_renderer):
+    async def get(params, timer):
+        timer.durations["draw"] = 0.5
+        timer.cache = "miss"
+        return mock_renderer.get.return_value
+
+    handler = make_image_handler(MagicMock(get=get))
+
+    asyncio.run(handler.get("png"))
+
+    assert handler._headers.get("Server-Timing") == (
+        'draw;dur=500.0;desc="Matplotlib drawing", cache;desc="miss"'
+    )
+
+
+@patch("iot_calendar.settings", {"dashboards": {"default": {}}})
+def test_dashboard_image_handler_render_queue_full(mock_renderer):
+    mock_renderer.get.side_effect = RenderQueueFullError()
+    handler = make_image_handler(mock_renderer)
+
+    asyncio.run(handler.get("png"))
+
+    assert handler.get_status() == 503
+    assert handler._headers.get("Retry-After") == str(RETRY_AFTER_SECONDS)
+
+
+def test_create_render_executor():
+    assert create_render_executor(0) is None
+    executor = create_render_executor(2)
+    try:
+        assert isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+    finally:
+        executor.shutdown()
+
+
+def test_create_image_store(tmp_path):
+    assert create_image_store(None, workers=1) is None
+
+    (tmp_path / "old.image").write_bytes(b'{"key": ["d", "png", "grayscale", "1", "90"], ')
+    store = create_image_store(str(tmp_path), workers=1)
+    assert isinstance(store, FileImageStore)
+    assert not list(tmp_path.iterdir())  # images from previous run are removed
+
+
+def test_create_image_store_default_folder(monkeypatch, tmp_path):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+
+    first = create_image_store(None, workers=2)
+    second = create_image_store(None, workers=2)
+
+    assert first.folder.parent == second.folder.parent == tmp_path
+    assert first.folder != second.folder  # other servers on the host do not share the images
+
+
+def test_metrics_handler(mock_request_list_handler):
+    handler = MetricsHandler(
+        mock_request_list_handler.application, mock_request_list_handler.request
+    )
+    handler._transforms = []
+
+    handler.get()
+
+    assert handler._headers.get("Content-Type").startswith("text/plain")
+    assert b"iot_calendar_stage_seconds" in b"".join(handler._write_buffer)
+
+
+def test_health_handler(mock_request_list_handler):
+    handler = HealthHandler(
+        mock_request_list_handler.application, mock_request_list_handler.request
+    )
+    handler._transforms = []
+
+    handler.get()
+
+    assert handler.get_status() == 200
+
+
+@pytest.mark.parametrize("ready,status", [(False, 503), (True, 200)])
+def test_ready_handler(mock_renderer, ready, status):
+    mock_renderer.ready = ready
+    image_handler = make_image_handler(mock_renderer)
+    handler = ReadyHandler(image_handler.application, image_handler.request)
+    handler._transforms = []
+
+    handler.get()
+
+    assert handler.get_status() == status
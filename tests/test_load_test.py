@@ -0,0 +1,82 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+import openweathermap_org
+import weather_gov
+from google_calendar import GOOGLE_CREDENTIALS_PARAM, Calendar
+from load_test import percentiles, start_fake_upstream, write_fake_secrets
+
+
+@pytest.fixture
+def api_endpoints():
+    with (
+        patch("google_calendar.GOOGLE_API_ENDPOINT"),
+        patch("openweathermap_org.OPENWEATHERMAP_FORECAST_URL"),
+        patch("weather_gov.WEATHER_GOV_URL"),
+    ):
+        yield
+
+
+def call_fake_upstream(func, error_rate=0.0):
+    """Run blocking API client call in thread while the fake APIs answer in the IOLoop."""
+
+    async def call():
+        url = start_fake_upstream(latency=0.001, error_rate=error_rate)
+        return await asyncio.get_running_loop().run_in_executor(None, func, url)
+
+    return asyncio.run(call())
+
+
+def test_fake_google_calendar_pages(api_endpoints, tmp_path):
+    def get_events(url):
+        settings = write_fake_secrets(str(tmp_path), url)
+        return Calendar(settings, "calendar@example.com").get_last_events("Work-out", days=31)
+
+    events = call_fake_upstream(get_events)
+
+    assert len(events) in (31, 32)  # more than one page
+    assert all(event["summary"] == "Work-out" for event in events)
+    assert all(event["start"] < event["end"] for event in events)
+
+
+def test_fake_google_calendar_credentials(tmp_path):
+    settings = write_fake_secrets(str(tmp_path), "http://127.0.0.1")
+
+    assert Calendar(settings, "calendar@example.com").credentials is not None
+    assert settings[GOOGLE_CREDENTIALS_PARAM].startswith(str(tmp_path))
+
+
+def test_fake_openweathermap(api_endpoints):
+    def get_weather(url):
+        weather = openweathermap_org.Weather({})
+        weather.key = "fake-key"
+        return weather.get_weather(1.0, 2.0, days=3)
+
+    weather = call_fake_upstream(get_weather)
+
+    assert len(weather.temp_max) == 3
+    assert weather.icon == ["sct"] * 3
+
+
+def test_fake_weather_gov(api_endpoints):
+    weather = call_fake_upstream(lambda url: weather_gov.Weather().get_weather("1", "2"))
+
+    assert weather.temp_max == [30]
+    assert weather.icon == ["sct"]
+
+
+def test_fake_upstream_errors(api_endpoints):
+    weather = call_fake_upstream(
+        lambda url: weather_gov.Weather().get_weather("1", "2"),
+        error_rate=1.0,
+    )
+
+    assert weather is None
+
+
+def test_percentiles():
+    assert percentiles(list(range(101))) == {50: 50, 95: 95, 99: 99}
+    assert percentiles([0.5]) == {50: 0.5, 95: 0.5, 99: 0.5}
+    assert percentiles([]) == {50: 0.0, 95: 0.0, 99: 0.0}
@@ -0,0 +1,160 @@
+import threading
+
+import pytest
+
+from cached_decorator import cached
+from metrics import (
+    UPSTREAM_ERRORS,
+    UPSTREAM_REQUESTS,
+    Counter,
+    Histogram,
+    StageTimer,
+    exposition,
+    run_timed,
+    server_timing,
+    stage,
+    upstream_request,
+)
+
+
+def test_counter():
+    counter = Counter("test_total", "Test counter")
+    counter.inc(service="a")
+    counter.inc(2, service="a")
+    counter.inc(service="b")
+
+    assert counter.exposition() == [
+        "# HELP test_total Test counter",
+        "# TYPE test_total counter",
+        'test_total{service="a"} 3',
+        'test_total{service="b"} 1',
+    ]
+
+
+def test_histogram():
+    histogram = Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+    histogram.observe(0.05, stage="draw")
+    histogram.observe(0.5, stage="draw")
+    histogram.observe(5, stage="draw")
+
+    assert histogram.exposition() == [
+        "# HELP test_seconds Test histogram",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{stage="draw",le="0.1"} 1',
+        'test_seconds_bucket{stage="draw",le="1.0"} 2',
+        'test_seconds_bucket{stage="draw",le="+Inf"} 3',
+        'test_seconds_sum{stage="draw"} 5.55',
+        'test_seconds_count{stage="draw"} 3',
+    ]
+
+
+def test_histogram_observe_all():
+    histogram = Histogram("test_seconds", "Test histogram", buckets=(1.0,))
+    histogram.observe_all({"draw": 0.5, "encode": 2})
+
+    assert histogram.counts == {(("stage", "draw"),): [1, 0], (("stage", "encode"),): [0, 1]}
+
+
+@pytest.mark.parametrize(
+    "metric", [Counter("test_total", "Test counter"), Histogram("test_seconds", "Test histogram")]
+)
+def test_exposition_waits_for_lock(metric):
+    """Labels added by other threads do not change the dict while exposition iterates it."""
+    exposition_thread = threading.Thread(target=metric.exposition)
+    with metric.lock:
+        exposition_thread.start()
+        exposition_thread.join(timeout=0.1)
+        assert exposition_thread.is_alive()
+    exposition_thread.join()
+
+
+def test_stage_timer_sums_repeated_stages():
+    timer = StageTimer()
+    with timer.stage("draw"):
+        pass
+    first = timer.durations["draw"]
+    with timer.stage("draw"):
+        pass
+
+    assert timer.durations["draw"] >= first > 0
+
+
+def test_run_timed_collects_stages():
+    def func(x):
+        with stage("draw"):
+            with stage("encode"):
+                return x * 2
+
+    result, durations = run_timed(func, 21)
+
+    assert result == 42
+    assert set(durations) == {"draw", "encode"}
+
+
+def test_stage_without_run_timed():
+    with stage("draw"):
+        pass  # nothing to collect durations, should not fail
+
+
+def test_upstream_request():
+    requests = UPSTREAM_REQUESTS.values.get((("service", "test"),), 0)
+    errors = UPSTREAM_ERRORS.values.get((("service", "test"),), 0)
+
+    with upstream_request("test"):
+        pass
+    with pytest.raises(ValueError), upstream_request("test"):
+        raise ValueError("boom")
+
+    assert UPSTREAM_REQUESTS.values[(("service", "test"),)] == requests + 2
+    assert UPSTREAM_ERRORS.values[(("service", "test"),)] == errors + 1
+
+
+@cached(seconds=10)
+def metrics_cached_function(x):
+    return x
+
+
+def test_exposition_includes_cache_hits():
+    metrics_cached_function(1)
+    metrics_cached_function(1)
+
+    text = exposition()
+
+    assert "# TYPE iot_calendar_stage_seconds histogram" in text
+    assert (
+        'iot_calendar_cache_requests_total{function="metrics_cached_function",result="hit"} 1'
+        in text
+    )
+    assert (
+        'iot_calendar_cache_requests_total{function="metrics_cached_function",result="miss"} 1'
+        in text
+    )
+
+
+def test_server_timing():
+    timer = StageTimer()
+    timer.durations = {
+        "settings": 0.001,
+        "fetch": 0.25,
+        "collect_events": 0.2,
+        "events_to_grid": 0.002,
+        "render": 0.5,
+        "draw": 0.3,
+        "encode": 0.1,
+    }
+    timer.cache = "miss"
+
+    assert server_timing(timer) == (
+        'fetch;dur=250.0;desc="Google calendar and weather", '
+        'prepare;dur=3.0;desc="Data preparation", '
+        'draw;dur=300.0;desc="Matplotlib drawing", '
+        'encode;dur=100.0;desc="Image encoding", '
+        'cache;desc="miss"'
+    )
+
+
+def test_server_timing_of_cached_image():
+    timer = StageTimer()
+    timer.cache = "hit"
+
+    assert server_timing(timer) == 'cache;desc="hit"'
@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.transforms import Bbox
+
+from pie_raster import PiesRaster, draw_image, draw_pie
+from sprite_atlas import SpriteAtlas
+
+WHITE = (255, 255, 255, 255)
+
+
+def white_pixels(height=40, width=40):
+    return np.full((height, width, 4), 255, dtype=np.uint8)
+
+
+def test_draw_pie_wedges():
+    pixels = white_pixels()
+    colors = np.array([[1, 0, 0, 1], [0, 0, 1, 1]], dtype=np.float64)
+
+    draw_pie(pixels, (20, 20), 10, np.array([1.0, 1.0]), colors, explode=0)
+
+    # the first wedge starts at 3 o'clock and goes counterclockwise
+    assert tuple(pixels[15, 20]) == (255, 0, 0, 255)  # above the center
+    assert tuple(pixels[25, 20]) == (0, 0, 255, 255)  # below
+    assert tuple(pixels[20, 5]) == WHITE  # outside
+    assert tuple(pixels[5, 20]) == WHITE
+    assert 0 < pixels[20, 29, 1] < 255  # antialiased edge
+
+
+def test_draw_pie_explode():
+    pixels = white_pixels()
+    colors = np.array([[1, 0, 0, 1], [0, 0, 1, 1]], dtype=np.float64)
+
+    draw_pie(pixels, (20, 20), 10, np.array([1.0, 1.0]), colors, explode=3)
+
+    assert tuple(pixels[20, 20]) == WHITE  # gap between the wedges
+    assert tuple(pixels[8, 20]) == (255, 0, 0, 255)  # the wedge is shifted up
+    assert tuple(pixels[31, 20]) == (0, 0, 255, 255)
+
+
+def test_draw_pie_skips_zero_values():
+    pixels = white_pixels()
+    colors = np.array([[1, 0, 0, 1], [0, 0, 1, 1]], dtype=np.float64)
+
+    draw_pie(pixels, (20, 20), 10, np.array([2.0, 0.0]), colors, explode=0)
+
+    assert (pixels[..., 2][pixels[..., 0] < 255] == 0).all()  # only red
+    assert tuple(pixels[20, 35]) == WHITE
+
+
+def test_draw_pie_outside():
+    pixels = white_pixels()
+    colors = np.array([[1, 0, 0, 1]], dtype=np.float64)
+
+    draw_pie(pixels, (-20, 20), 10, np.array([1.0]), colors, explode=0)
+
+    assert (pixels == 255).all()
+
+
+def test_draw_image():
+    pixels = white_pixels(height=10, width=10)
+    sprite = np.zeros((4, 4, 4), dtype=np.uint8)
+    sprite[..., 3] = 255  # black
+    sprite[0, 0, 3] = 0  # transparent
+
+    draw_image(pixels, sprite, (2, 0, 4, 4))
+
+    black = (pixels[..., :3] == 0).all(axis=2)
+    assert black[6:10, 2:6].sum() == 15
+    assert black.sum() == 15
+    assert tuple(pixels[6, 2]) == WHITE
+
+
+def test_draw_image_clipped():
+    pixels = white_pixels(height=10, width=10)
+    sprite = np.zeros((4, 4, 4), dtype=np.uint8)
+    sprite[..., 3] = 255
+
+    draw_image(pixels, sprite, (8, -2, 4, 4))
+
+    black = (pixels[..., :3] == 0).all(axis=2)
+    assert black[8:10, 8:10].all()
+    assert black.sum() == 4
+
+
+def test_pies_raster_images():
+    figure = Figure(figsize=(0.2, 0.1), dpi=100)  # 20 x 10 pixels
+    FigureCanvasAgg(figure)
+    ax = figure.add_axes((0, 0, 1, 1), autoscale_on=False)
+    ax.set_axis_off()
+    ax.set_xlim(0, 2)
+    ax.set_ylim(0, 1)
+    figure.canvas.draw()
+    raster = PiesRaster()
+    sprites = SpriteAtlas()
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    raster.add_image("black.png", image, (0.2, 0.6, 0.2, 0.6))  # 4 x 4 pixels
+    raster.add_image("black.png", image, (1.0, 1.4, 0.2, 0.6))
+
+    pixels = np.asarray(figure.canvas.buffer_rgba())
+    raster.draw(ax, pixels, sprites)
+
+    black = (pixels[..., :3] == 0).all(axis=2)
+    assert black[4:8, 2:6].all()
+    assert black[4:8, 10:14].all()
+    assert black.sum() == 32
+    assert list(sprites.sprites) == [("black.png", 4, 4)]
+
+
+def test_pies_raster_regions():
+    figure = Figure(figsize=(0.2, 0.1), dpi=100)  # 20 x 10 pixels
+    FigureCanvasAgg(figure)
+    ax = figure.add_axes((0, 0, 1, 1), autoscale_on=False)
+    ax.set_axis_off()
+    ax.set_xlim(0, 2)
+    ax.set_ylim(0, 1)
+    figure.canvas.draw()
+    raster = PiesRaster()
+    raster.add_image("black.png", np.zeros((8, 8, 3), dtype=np.uint8), (0.2, 0.6, 0.2, 0.6))
+    raster.add_pie((1.5, 0.5), 0.2, [1.0], ["black"], explode=0)
+
+    pixels = np.asarray(figure.canvas.buffer_rgba())
+    raster.draw(ax, pixels, SpriteAtlas(), regions=[Bbox.from_extents(12, 0, 20, 10)])
+
+    black = (pixels[..., :3] == 0).all(axis=2)
+    assert not black[:, :10].any()  # the image is outside of the region
+    assert black[5, 15]  # the pie center
+
+
+def test_pies_raster_as_matplotlib_pie():
+    def figure():
+        figure = Figure(figsize=(1, 1), dpi=100)
+        FigureCanvasAgg(figure)
+        ax = figure.add_axes((0, 0, 1, 1), autoscale_on=False)
+        ax.set_axis_off()
+        ax.set_aspect("equal")
+        return figure, ax
+
+    pie_args = ((0.5, 0.5), 0.4, [1.0, 2.0, 3.0], ["C0", "C1", "C2"])
+    expected, ax = figure()
+    ax.pie(pie_args[2], explode=[0.02] * 3, radius=0.4, colors=pie_args[3], center=pie_args[0])
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    expected.canvas.draw()
+
+    drawn, ax = figure()
+    ax.set_xlim(0, 1)
+    ax.set_ylim(0, 1)
+    raster = PiesRaster()
+    raster.add_pie(*pie_args, explode=0.02)
+    drawn.canvas.draw()
+    raster.draw(ax, np.asarray(drawn.canvas.buffer_rgba()), SpriteAtlas())
+
+    difference = np.abs(
+        np.asarray(expected.canvas.buffer_rgba()).astype(int)
+        - np.asarray(drawn.canvas.buffer_rgba()).astype(int)
+    )
+    assert (difference.max(axis=2) > 64).mean() < 0.01  # only some edge pixels differ
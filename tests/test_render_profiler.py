@@ -0,0 +1,92 @@
+import cProfile
+import pstats
+
+import pytest
+
+from render_profiler import (
+    PROFILE_DIR_ENV,
+    collapsed_stacks,
+    current_profile,
+    func_label,
+    profile_render,
+    profiled,
+)
+
+
+def leaf():
+    return sum(range(20000))
+
+
+def branch():
+    return leaf() + leaf()
+
+
+def root():
+    return branch() + leaf()
+
+
+def test_collapsed_stacks():
+    profile = cProfile.Profile()
+    profile.enable()
+    root()
+    profile.disable()
+    stats = pstats.Stats(profile)
+
+    stacks = collapsed_stacks(stats)
+
+    root_label = func_label((__file__, root.__code__.co_firstlineno, "root"))
+    branch_label = func_label((__file__, branch.__code__.co_firstlineno, "branch"))
+    leaf_label = func_label((__file__, leaf.__code__.co_firstlineno, "leaf"))
+    assert f"{root_label};{branch_label};{leaf_label}" in stacks
+    assert f"{root_label};{leaf_label}" in stacks
+    # the leaf time is split between its callers
+    sum_label = "<built-in method builtins.sum>"
+    [sum_seconds] = [entry[2] for func, entry in stats.stats.items() if func[2] == sum_label]
+    under_branch = stacks[f"{root_label};{branch_label};{leaf_label};{sum_label}"]
+    under_root = stacks[f"{root_label};{leaf_label};{sum_label}"]
+    assert under_branch + under_root == pytest.approx(sum_seconds)
+    assert sum(stacks.values()) == pytest.approx(stats.total_tt, rel=0.1)
+
+
+def test_func_label():
+    assert func_label(("/src/figure.py", 3154, "draw")) == "draw (figure.py:3154)"
+    assert func_label(("~", 0, "<built-in method time.sleep>")) == "<built-in method time.sleep>"
+    assert func_label(("/src/a;b.py", 1, "f")) == "f (a,b.py:1)"
+
+
+def test_profile_render(monkeypatch, tmp_path):
+    monkeypatch.setenv(PROFILE_DIR_ENV, str(tmp_path / "profiles"))
+
+    with profile_render():
+        with profiled("plot"):
+            root()
+        with profiled("plot"):
+            leaf()
+        with profiled("encode"):
+            leaf()
+    assert current_profile.get() is None
+
+    [collapsed] = (tmp_path / "profiles").glob("*.collapsed")
+    render = collapsed.stem
+    assert sorted(path.name for path in (tmp_path / "profiles").iterdir()) == [
+        f"{render}-encode.prof",
+        f"{render}-plot.prof",
+        f"{render}.collapsed",
+    ]
+    stages = {line.split(";", 1)[0] for line in collapsed.read_text().splitlines()}
+    assert stages == {"plot", "encode"}
+    [plot] = (tmp_path / "profiles").glob("*-plot.prof")
+    functions = {name for _, _, name in pstats.Stats(str(plot)).stats}
+    assert {"root", "leaf"} <= functions  # both blocks of the stage
+
+
+def test_profile_render_disabled(monkeypatch, tmp_path):
+    monkeypatch.delenv(PROFILE_DIR_ENV, raising=False)
+    monkeypatch.chdir(tmp_path)
+
+    with profile_render():
+        assert current_profile.get() is None
+        with profiled("plot"):
+            leaf()
+
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from sprite_atlas import SpriteAtlas, blend_over, pixel_box, to_rgba
+
+
+@pytest.fixture
+def ax():
+    figure = Figure(figsize=(0.4, 0.2), dpi=100)  # 40 x 20 pixels
+    FigureCanvasAgg(figure)
+    ax = figure.add_axes((0, 0, 1, 1), autoscale_on=False)
+    ax.set_axis_off()
+    ax.set_xlim(0, 4)
+    ax.set_ylim(0, 2)
+    return ax
+
+
+def test_pixel_box(ax):
+    assert pixel_box(ax, (1, 2, 0.5, 1.5)) == (10, 5, 10, 10)
+    # the size does not depend on the position
+    assert pixel_box(ax, (1.04, 2.04, 0.5, 1.5)) == (10, 5, 10, 10)
+    assert pixel_box(ax, (1.06, 2.06, 0.5, 1.5)) == (11, 5, 10, 10)
+
+
+@pytest.mark.parametrize(
+    "image",
+    [
+        np.ones((3, 3), dtype=np.float32),
+        np.ones((3, 3, 3), dtype=np.float32),
+        np.full((3, 3, 4), 255, dtype=np.uint8),
+    ],
+)
+def test_to_rgba(image):
+    rgba = to_rgba(image)
+
+    assert rgba.mode == "RGBA"
+    assert np.asarray(rgba).min() == 255
+
+
+def test_sprite_resized_once():
+    sprites = SpriteAtlas()
+    image = np.zeros((20, 20, 3), dtype=np.uint8)
+
+    sprite = sprites.sprite("icon.png", image, (5, 4))
+
+    assert sprite.shape == (4, 5, 4)
+    assert sprites.sprite("icon.png", np.ones((1, 1, 3)), (5, 4)) is sprite
+    assert sprites.sprite("icon.png", image, (4, 4)).shape == (4, 4, 4)
+
+
+def test_build(ax):
+    sprites = SpriteAtlas()
+    image = np.zeros((20, 20, 3), dtype=np.uint8)
+
+    sprites.build(ax, (0, 1, 0, 1), [("a.png", image), ("b.png", image)])
+
+    assert set(sprites.sprites) == {("a.png", 10, 10), ("b.png", 10, 10)}
+
+
+def test_imshow(ax):
+    sprites = SpriteAtlas()
+    image = np.zeros((20, 20, 3), dtype=np.uint8)
+
+    sprites.imshow(ax, "icon.png", image, (1.04, 2.04, 0.5, 1.5))
+    ax.figure.canvas.draw()
+
+    [axes_image] = ax.get_images()
+    assert axes_image.get_extent() == pytest.approx([1.0, 2.0, 0.5, 1.5])
+    pixels = np.asarray(ax.figure.canvas.buffer_rgba())
+    black = (pixels[..., :3] == 0).all(axis=2)
+    assert black[5:15, 10:20].all()  # without interpolation on the edges
+    assert black.sum() == 100
+
+
+def test_blend_over():
+    dest = np.array([[[0, 0, 0, 0], [0, 0, 255, 255], [10, 20, 30, 255]]], dtype=np.uint8)
+    src = np.array([[[1, 2, 3, 100], [255, 0, 0, 255], [10, 20, 30, 0]]], dtype=np.uint8)
+
+    blend_over(dest, src)
+
+    assert dest.tolist() == [[[1, 2, 3, 100], [255, 0, 0, 255], [10, 20, 30, 255]]]
+
+
+def test_overlay(ax):
+    sprites = SpriteAtlas()
+    black = np.zeros((20, 20, 3), dtype=np.uint8)
+    white = np.ones((20, 20, 3), dtype=np.uint8) * 255
+
+    sprites.overlay(
+        ax,
+        [
+            ("black.png", black, (0.04, 1.04, 0.5, 1.5)),
+            ("white.png", white, (3, 3.5, 0, 0.5)),
+        ],
+    )
+    ax.figure.canvas.draw()
+
+    [axes_image] = ax.get_images()  # one image for all icons
+    assert axes_image.get_extent() == pytest.approx([0.0, 3.5, 0.0, 1.5])
+    pixels = np.asarray(ax.figure.canvas.buffer_rgba())
+    is_black = (pixels[..., :3] == 0).all(axis=2)
+    assert is_black[5:15, 0:10].all()
+    assert is_black.sum() == 100
+    assert (pixels[15:20, 30:35] == 255).all()
+
+
+def test_overlay_no_icons(ax):
+    SpriteAtlas().overlay(ax, [])
+
+    assert not ax.get_images()
+
+
+def test_snap(ax):
+    sprites = SpriteAtlas()
+    image = np.zeros((20, 20, 3), dtype=np.uint8)
+    sprites.imshow(ax, "icon.png", image, (1.04, 2.04, 0.5, 1.5))
+
+    ax.figure.set_dpi(200)  # 80 x 40 pixels
+    sprites.snap(ax.figure)
+    ax.figure.canvas.draw()
+
+    [axes_image] = ax.get_images()
+    assert axes_image.get_array().shape == (20, 20, 4)
+    assert axes_image.get_extent() == pytest.approx([1.05, 2.05, 0.5, 1.5])
+    pixels = np.asarray(ax.figure.canvas.buffer_rgba())
+    black = (pixels[..., :3] == 0).all(axis=2)
+    assert black[10:30, 21:41].all()
+    assert black.sum() == 400
@@ -0,0 +1,83 @@
+import contextlib
+from unittest.mock import patch
+
+import matplotlib
+import matplotlib.pyplot as plt
+import matplotlib.style
+import pytest
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.font_manager import fontManager
+
+from style_registry import StyleRegistry, installed_families
+
+
+def test_installed_families():
+    assert installed_families(["No Such Font", "DejaVu Sans", "monospace"]) == [
+        "DejaVu Sans",
+        "monospace",
+    ]
+    assert installed_families(["No Such Font"]) == [fontManager.defaultFamily["ttf"]]
+
+
+def test_style_resolved_once():
+    registry = StyleRegistry()
+    with patch("matplotlib.style.context", side_effect=matplotlib.style.context) as style_context:
+        first = registry.rc("grayscale", xkcd=True)
+        assert registry.rc("grayscale", xkcd=True) is first
+        registry.rc("grayscale", xkcd=False)
+
+    assert style_context.call_count == 2
+    assert "backend" not in first
+
+
+def test_style_context():
+    registry = StyleRegistry()
+    before = dict(matplotlib.rcParams.copy())
+
+    with registry.context("grayscale", xkcd=True):
+        assert matplotlib.rcParams["path.sketch"] is not None
+        assert matplotlib.rcParams["axes.facecolor"] == "white"
+        assert matplotlib.rcParams["font.family"] == installed_families(
+            ["xkcd", "xkcd Script", "Comic Neue", "Comic Sans MS"]
+        )
+        assert matplotlib.rcParams["image.cmap"] == "gray"  # from the style
+
+    assert dict(matplotlib.rcParams.copy()) == before
+
+
+def test_style_context_same_as_matplotlib():
+    registry = StyleRegistry()
+    with matplotlib.style.context("seaborn-v0_8-talk", after_reset=True):
+        expected = dict(matplotlib.rcParams.copy())
+
+    with registry.context("seaborn-v0_8-talk", xkcd=False):
+        assert dict(matplotlib.rcParams.copy()) == expected
+
+
+@contextlib.contextmanager
+def matplotlib_style(style):
+    with matplotlib.style.context(style, after_reset=True):
+        plt.xkcd()
+        yield
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("use_registry", [False, True], ids=["style_context", "registry"])
+def test_style_benchmark(benchmark, use_registry):
+    registry = StyleRegistry()
+    figure = Figure(figsize=(2, 1), dpi=100)
+    canvas = FigureCanvasAgg(figure)
+
+    def draw():
+        with (
+            registry.context("grayscale", xkcd=True)
+            if use_registry
+            else matplotlib_style("grayscale")
+        ):
+            figure.clear()
+            for position in range(10):
+                figure.text(position / 10, 0.5, str(position))
+            canvas.draw()
+
+    benchmark(draw)